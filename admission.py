@@ -0,0 +1,127 @@
+"""
+准入控制模块 - 忙不过来时立刻告诉用户，而不是让请求排两分钟队喵～
+
+一条需要调用 Opencode 的消息在入队前要通过三项检查：
+- 用户的请求频率（令牌桶）
+- 队列深度（单个 chat 和全局）
+- 预计等待时间（按最近的处理耗时估算）
+入队后如果实际排队超过等待期限，出队时也直接拒绝。
+"""
+
+import logging
+from typing import Dict, FrozenSet, Optional
+from outbox import TokenBucket
+from metrics import ADMISSION_REJECTED
+
+logger = logging.getLogger(__name__)
+
+# 处理耗时的指数移动平均系数
+EWMA_ALPHA = 0.2
+
+# 还没有处理过消息时假设的单条耗时（秒）
+INITIAL_HANDLE_SECONDS = 10.0
+
+# 超过这么多个用户的令牌桶时清理空闲的
+MAX_IDLE_BUCKETS = 1000
+
+
+def parse_allowed_ids(value: Optional[str]) -> Optional[FrozenSet[int]]:
+    """解析 ALLOWED_USER_ID（逗号分隔）；没有设置时返回 None，表示允许所有用户"""
+    if not value or not value.strip():
+        return None
+    ids = set()
+    for uid in value.split(","):
+        uid = uid.strip()
+        if not uid:
+            continue
+        try:
+            ids.add(int(uid))
+        except ValueError:
+            logger.warning("ALLOWED_USER_ID 里有无效的用户 ID: %s", uid)
+    return frozenset(ids)
+
+
+class AdmissionController:
+    """决定一条消息能不能进入处理队列"""
+
+    def __init__(
+        self,
+        user_rate: float,
+        user_burst: int,
+        max_chat_queue: int,
+        max_queued: int,
+        max_wait: float,
+    ):
+        """
+        Args:
+            user_rate: 每个用户每秒可发起的请求数
+            user_burst: 每个用户允许连续发起的请求数
+            max_chat_queue: 单个 chat 最多排队的请求数
+            max_queued: 全局最多排队的请求数
+            max_wait: 最长排队时间（秒）
+        """
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_chat_queue = max_chat_queue
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self.handle_seconds = INITIAL_HANDLE_SECONDS  # 单条处理耗时的移动平均
+        self._buckets: Dict[int, TokenBucket] = {}
+
+    def check(
+        self,
+        user_id: int,
+        chat_queued: int,
+        chat_running: bool,
+        total_queued: int,
+        backend_backlog: float,
+    ) -> Optional[str]:
+        """
+        检查能否接受一条新请求
+
+        Args:
+            user_id: 发消息的用户
+            chat_queued: 这个 chat 正在排队的请求数
+            chat_running: 这个 chat 是否有请求正在处理
+            total_queued: 所有 chat 排队的请求总数
+            backend_backlog: 后端积压（等待进程槽位的请求数 / 槽位数）
+
+        Returns:
+            拒绝原因（rate / queue / deadline），可以接受时为 None
+        """
+        reason = None
+        if chat_queued >= self.max_chat_queue or total_queued >= self.max_queued:
+            reason = "queue"
+        elif self.estimate_wait(chat_queued, chat_running, backend_backlog) > self.max_wait:
+            reason = "deadline"
+        elif not self._bucket(user_id).try_acquire():
+            reason = "rate"
+
+        if reason:
+            ADMISSION_REJECTED.inc(reason=reason)
+            logger.warning("拒绝用户 %s 的请求: %s", user_id, reason)
+        return reason
+
+    def estimate_wait(self, chat_queued: int, chat_running: bool, backend_backlog: float) -> float:
+        """估算新请求开始处理前要等多久（秒）"""
+        ahead = chat_queued + (1 if chat_running else 0)
+        return (ahead + backend_backlog) * self.handle_seconds
+
+    def expired(self, waited: float) -> bool:
+        """已经排队太久，出队时直接拒绝"""
+        if waited <= self.max_wait:
+            return False
+        ADMISSION_REJECTED.inc(reason="expired")
+        return True
+
+    def observe(self, seconds: float):
+        """记录一次处理耗时，用来估算等待时间"""
+        self.handle_seconds += EWMA_ALPHA * (seconds - self.handle_seconds)
+
+    def _bucket(self, user_id: int) -> TokenBucket:
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            if len(self._buckets) >= MAX_IDLE_BUCKETS:
+                self._buckets = {k: v for k, v in self._buckets.items() if not v.idle}
+            bucket = self._buckets[user_id] = TokenBucket(self.user_rate, self.user_burst)
+        return bucket
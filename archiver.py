@@ -0,0 +1,166 @@
+"""
+Session 归档模块 - 在后台把写满的 session 总结进 memory 喵～
+
+归档任务进入队列，由固定数量的 worker 依次处理，失败会按指数退避重试。
+用户的消息不用等归档完成，直接进入新 session。
+"""
+
+import asyncio
+import contextvars
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, List, Optional, Set
+from config import Config
+from opencode_runner import run_command
+from metrics import timed
+
+logger = logging.getLogger(__name__)
+
+# 单次归档的超时时间（秒）
+ARCHIVE_TIMEOUT = 60
+
+# 第一次重试前等待的时间（秒），之后每次翻倍
+RETRY_BASE_DELAY = 5
+
+# 记住最近归档过的 session 数量，用来去重
+DONE_HISTORY_SIZE = 1000
+
+
+@dataclass
+class ArchiveJob:
+    """一个归档任务"""
+
+    session_id: str
+    memory_file: Path
+    key: Optional[str] = None  # session 所在的槽位
+    attempts: int = 0
+
+
+class SessionArchiver:
+    """后台归档队列"""
+
+    def __init__(
+        self,
+        max_concurrency: Optional[int] = None,
+        max_retries: Optional[int] = None,
+        on_archived: Optional[Callable[[str, Optional[str]], None]] = None,
+    ):
+        """
+        Args:
+            max_concurrency: 同时归档的 session 数
+            max_retries: 失败后最多重试几次
+            on_archived: 归档成功后调用 on_archived(session_id, key)，用来持久化记录
+        """
+        self.on_archived = on_archived
+        self.max_concurrency = max(1, max_concurrency or Config.ARCHIVE_MAX_CONCURRENCY)
+        self.max_retries = max_retries if max_retries is not None else Config.ARCHIVE_MAX_RETRIES
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._pending: Set[str] = set()  # 排队或正在归档
+        self._done: "OrderedDict[str, None]" = OrderedDict()  # 最近归档完成的
+
+    def submit(self, session_id: str, memory_file: Path, key: Optional[str] = None) -> bool:
+        """
+        提交归档任务（需要在事件循环中调用）
+
+        Returns:
+            是否加入了队列（同一个 session 只归档一次）
+        """
+        if session_id in self._pending or session_id in self._done:
+            return False
+
+        self._ensure_workers()
+        self._pending.add(session_id)
+        self._queue.put_nowait(ArchiveJob(session_id, memory_file, key))
+        logger.info("session %s 已加入归档队列（排队 %s）", session_id, self._queue.qsize())
+        return True
+
+    def pending_count(self) -> int:
+        """排队和正在归档的任务数"""
+        return len(self._pending)
+
+    def _ensure_workers(self):
+        """懒启动 worker（第一次提交时才有事件循环）"""
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if not self._workers:
+            self._workers = [
+                # 用空的 context 启动：worker 可能是在用户消息的处理过程中创建的，
+                # 归档调用的 opencode 不能算到那条消息头上（见 opencode_runner.track_runs）
+                contextvars.Context().run(asyncio.create_task, self._worker())
+                for _ in range(self.max_concurrency)
+            ]
+
+    async def _worker(self):
+        """不断从队列取任务执行"""
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._process(job)
+            finally:
+                self._queue.task_done()
+
+    async def _process(self, job: ArchiveJob):
+        """执行一个归档任务，失败时重试"""
+        while True:
+            job.attempts += 1
+            if await self._archive_once(job):
+                if self.on_archived is not None:
+                    try:
+                        self.on_archived(job.session_id, job.key)
+                    except Exception as e:
+                        logger.error("记录 session %s 已归档失败: %s", job.session_id, e)
+                self._pending.discard(job.session_id)
+                self._done[job.session_id] = None
+                while len(self._done) > DONE_HISTORY_SIZE:
+                    self._done.popitem(last=False)
+                logger.info("已归档 session: %s", job.session_id)
+                return
+
+            if job.attempts > self.max_retries:
+                self._pending.discard(job.session_id)
+                logger.error(
+                    "归档 session %s 失败，已重试 %s 次，放弃", job.session_id, self.max_retries
+                )
+                return
+
+            delay = RETRY_BASE_DELAY * 2 ** (job.attempts - 1)
+            logger.warning("归档 session %s 失败，%s 秒后重试", job.session_id, delay)
+            await asyncio.sleep(delay)
+
+    async def _archive_once(self, job: ArchiveJob) -> bool:
+        """调用 opencode 总结 session 并追加写入 memory 文件"""
+        archive_prompt = f"""总结这次会话(session: {job.session_id})的长期有用内容。
+将总结追加写入文件: {job.memory_file}
+
+格式随意，可以包括：
+- 讨论的主题
+- 做出的决策
+- 完成的任务
+- 有用的代码或命令
+
+如果没有什么值得记录的，可以不写或简单写一句。"""
+
+        try:
+            cmd = [Config.OPENCODE_CLI, "run", "--session", job.session_id, archive_prompt]
+            with timed("archive"):
+                result = await run_command(cmd, timeout=ARCHIVE_TIMEOUT)
+            if result.returncode != 0:
+                logger.error("归档 session 出错: %s", result.stderr.strip() or "未知错误")
+                return False
+            return True
+        except Exception as e:
+            logger.error("归档 session 失败: %s", e)
+            return False
+
+    async def shutdown(self):
+        """停止 worker，还没完成的归档会丢弃（没有记为已归档，下次启动时重新排队）"""
+        if self._pending:
+            logger.warning("关闭时还有 %s 个归档任务未完成", len(self._pending))
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
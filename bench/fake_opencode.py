@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+假的 opencode CLI - 压测时通过 OPENCODE_CLI 指向它喵～
+
+支持的命令：
+    fake_opencode.py run [--format json] [--title T | --session ID] "message"
+    fake_opencode.py session list
+    fake_opencode.py serve [--hostname H] [--port P]   （OPENCODE_BACKEND=server 时由 bot 启动）
+
+环境变量：
+    FAKE_OPENCODE_STARTUP    启动耗时（秒，默认 0.2）
+    FAKE_OPENCODE_GEN_TIME   生成耗时（秒，默认 1.0）
+    FAKE_OPENCODE_SECTIONS   回复段落数（默认 2，段落之间用 3 个换行符分隔）
+    FAKE_OPENCODE_CHUNKS     每段分几次输出（默认 4，模拟流式输出）
+    FAKE_OPENCODE_FAIL_RATE  失败概率（0~1，默认 0）
+    FAKE_OPENCODE_HANG_RATE  卡住概率（0~1，默认 0，卡住时睡 1 小时）
+    FAKE_OPENCODE_STATE      记录 session 标题的文件（供 session list 使用）
+
+serve 模式下失败（FAKE_OPENCODE_FAIL_RATE）时像真实 server 一样在 info.error 里返回错误，
+bot 会删掉刚建的 session 再改用 CLI。GET /fake/stats 返回 session 数和其中没有收到过回复
+（发送失败后没有清理）的 session 数，压测结束时检查。
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STATE_FILE = os.getenv(
+    "FAKE_OPENCODE_STATE", os.path.join(tempfile.gettempdir(), "fake_opencode_sessions")
+)
+
+
+def env_float(name: str, default: float) -> float:
+    return float(os.getenv(name, str(default)))
+
+
+def emit(text: str):
+    sys.stdout.write(text)
+    sys.stdout.flush()
+
+
+def cmd_run(args):
+    json_mode = False
+    title = None
+    session_id = None
+    prompt_parts = []
+
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == "--format":
+            json_mode = args[i + 1] == "json"
+            i += 2
+        elif arg == "--title":
+            title = args[i + 1]
+            i += 2
+        elif arg == "--session":
+            session_id = args[i + 1]
+            i += 2
+        else:
+            prompt_parts.append(arg)
+            i += 1
+
+    time.sleep(env_float("FAKE_OPENCODE_STARTUP", 0.2))
+
+    if random.random() < env_float("FAKE_OPENCODE_FAIL_RATE", 0):
+        sys.stderr.write("fake opencode: simulated failure\n")
+        sys.exit(1)
+    if random.random() < env_float("FAKE_OPENCODE_HANG_RATE", 0):
+        time.sleep(3600)
+
+    if session_id is None:
+        session_id = f"ses_fake{uuid.uuid4().hex[:12]}"
+        if title:
+            with open(STATE_FILE, "a") as f:
+                f.write(f"{session_id} {title}\n")
+
+    sections = max(1, int(env_float("FAKE_OPENCODE_SECTIONS", 2)))
+    chunks = max(1, int(env_float("FAKE_OPENCODE_CHUNKS", 4)))
+    delay = env_float("FAKE_OPENCODE_GEN_TIME", 1.0) / (sections * chunks)
+    prompt = " ".join(prompt_parts)
+
+    if json_mode:
+        emit(json.dumps({"type": "step_start", "sessionID": session_id}) + "\n")
+
+    for s in range(sections):
+        text = f"第 {s + 1} 段回复喵～（收到 {len(prompt)} 个字符）"
+        last = s == sections - 1
+
+        if json_mode:
+            # 真实的 opencode 在文本块结束时才输出事件，这里每段一个文本块
+            time.sleep(delay * chunks)
+            part = {"type": "text", "text": text if last else text + "\n\n\n"}
+            emit(json.dumps({"type": "text", "sessionID": session_id, "part": part}) + "\n")
+        else:
+            for k in range(chunks):
+                time.sleep(delay)
+                emit(text[len(text) * k // chunks:len(text) * (k + 1) // chunks])
+            emit("\n" if last else "\n\n\n")
+
+
+def cmd_session_list():
+    print("Session ID                      Title                 Updated")
+    print("─" * 60)
+    if os.path.exists(STATE_FILE):
+        with open(STATE_FILE) as f:
+            for line in reversed(f.read().splitlines()):
+                session_id, title = line.split(maxsplit=1)
+                print(f"{session_id}  {title}  just now")
+
+
+class FakeServerHandler(BaseHTTPRequestHandler):
+    """opencode serve 的 HTTP 接口（只实现 bot 用到的部分）"""
+
+    sessions = {}  # session ID -> 是否收到过回复
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/config":
+            self._reply({})
+        elif self.path == "/fake/stats":
+            with self.lock:
+                orphaned = sum(1 for replied in self.sessions.values() if not replied)
+                self._reply({"sessions": len(self.sessions), "orphaned": orphaned})
+        else:
+            self._reply({"error": "not found"}, 404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length) or b"{}")
+        parts = self.path.strip("/").split("/")
+
+        if parts == ["session"]:
+            session_id = f"ses_fake{uuid.uuid4().hex[:12]}"
+            with self.lock:
+                self.sessions[session_id] = False
+            with open(STATE_FILE, "a") as f:
+                f.write(f"{session_id} {body.get('title') or session_id}\n")
+            self._reply({"id": session_id, "title": body.get("title")})
+        elif len(parts) == 3 and parts[0] == "session" and parts[2] == "message":
+            self._message(parts[1], body)
+        elif len(parts) == 3 and parts[0] == "session" and parts[2] == "abort":
+            self._reply(True)
+        else:
+            self._reply({"error": "not found"}, 404)
+
+    def do_DELETE(self):
+        parts = self.path.strip("/").split("/")
+        if len(parts) == 2 and parts[0] == "session":
+            with self.lock:
+                self.sessions.pop(parts[1], None)
+            self._reply(True)
+        else:
+            self._reply({"error": "not found"}, 404)
+
+    def _message(self, session_id: str, body: dict):
+        time.sleep(env_float("FAKE_OPENCODE_GEN_TIME", 1.0))
+        if random.random() < env_float("FAKE_OPENCODE_FAIL_RATE", 0):
+            self._reply({"info": {"error": {"name": "FakeError"}}, "parts": []})
+            return
+
+        with self.lock:
+            self.sessions[session_id] = True
+        prompt = "".join(part.get("text", "") for part in body.get("parts") or [])
+        sections = max(1, int(env_float("FAKE_OPENCODE_SECTIONS", 2)))
+        text = "\n\n\n".join(
+            f"第 {s + 1} 段回复喵～（收到 {len(prompt)} 个字符）" for s in range(sections)
+        )
+        self._reply({"info": {}, "parts": [{"type": "text", "text": text}]})
+
+    def _reply(self, data, status: int = 200):
+        payload = json.dumps(data, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def cmd_serve(args):
+    host, port = "127.0.0.1", 4096
+    for i, arg in enumerate(args[:-1]):
+        if arg == "--hostname":
+            host = args[i + 1]
+        elif arg == "--port":
+            port = int(args[i + 1])
+
+    time.sleep(env_float("FAKE_OPENCODE_STARTUP", 0.2))
+    server = ThreadingHTTPServer((host, port), FakeServerHandler)
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+def main():
+    args = sys.argv[1:]
+    if args[:1] == ["run"]:
+        cmd_run(args[1:])
+    elif args[:2] == ["session", "list"]:
+        cmd_session_list()
+    elif args[:1] == ["serve"]:
+        cmd_serve(args[1:])
+    else:
+        sys.stderr.write(f"fake opencode: unsupported command {args[:2]}\n")
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+端到端压测 - 用假的 opencode 和本地 Bot API 桩服务跑真实的 bot 处理器喵～
+
+每个并发级别启动 N 个 chat，每个 chat 依次发送消息（文字/图片/命令混合），
+等上一条处理完再发下一条。统计每条 update 的处理延迟、首条可见消息时间
+（time to first message）和整体吞吐。
+
+用法:
+    python bench/run_bench.py --concurrency 1,4,16 --messages 10 --output bench.json
+    python bench/run_bench.py --compare bench.json     # 和上次结果对比，有退化时退出码为 1
+    python bench/run_bench.py --backend server --fail-rate 0.2   # 走 server 后端（假 server），
+                                                                 # 检查发送失败改用 CLI 时没有留下空 session
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import socket
+import argparse
+import tempfile
+import subprocess
+from typing import Dict, List, Optional
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from telegram_stub import TelegramStub  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="陈千语 Bot 端到端压测")
+    parser.add_argument("--concurrency", default="1,2,4,8", help="并发 chat 数，逗号分隔")
+    parser.add_argument("--messages", type=int, default=10, help="每个 chat 发送的消息数")
+    parser.add_argument("--photo-ratio", type=float, default=0.1, help="图片消息比例")
+    parser.add_argument("--command-ratio", type=float, default=0.1, help="/ping 命令比例")
+    parser.add_argument("--startup", type=float, default=0.2, help="假 opencode 启动耗时（秒）")
+    parser.add_argument("--gen-time", type=float, default=1.0, help="假 opencode 生成耗时（秒）")
+    parser.add_argument("--sections", type=int, default=2, help="每条回复的段落数")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="假 opencode 失败概率")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="Bot API 模拟延迟（秒）")
+    parser.add_argument("--retry-after-rate", type=float, default=0.0, help="Bot API 返回 429 的概率")
+    parser.add_argument("--stream", action="store_true", help="开启 STREAM_REPLIES")
+    parser.add_argument("--backend", choices=("cli", "server"), default="cli", help="Opencode 后端")
+    parser.add_argument("--seed", type=int, default=42, help="随机种子")
+    parser.add_argument("--output", help="结果写入 JSON 文件")
+    parser.add_argument("--compare", help="与之前的结果 JSON 对比")
+    parser.add_argument("--threshold", type=float, default=10.0, help="判定退化的百分比")
+    return parser.parse_args()
+
+
+def setup_env(args, workdir: str):
+    """在导入 bot 之前设置环境变量"""
+    os.environ.update(
+        {
+            "TELEGRAM_BOT_TOKEN": "123456:bench",
+            "ALLOWED_USER_ID": "",
+            "LOG_LEVEL": "WARNING",
+            "LOG_FILE": os.path.join(workdir, "bot.log"),
+            "TRACE_FILE": os.path.join(workdir, "traces.jsonl"),
+            "INBOX_FILE": os.path.join(workdir, "inbox.db"),
+            "BOT_PORT": "0",
+            "OPENCODE_CLI": os.path.join(BENCH_DIR, "fake_opencode.py"),
+            "WORKSPACE_DIR": os.path.join(workdir, "workspace"),
+            "AGENTS_CONFIG_DIR": os.path.join(workdir, "agents"),
+            "MEDIA_CACHE_DIR": os.path.join(workdir, "media"),
+            "UPLOAD_CACHE_FILE": os.path.join(workdir, "uploads.json"),
+            "STREAM_REPLIES": "true" if args.stream else "false",
+            "OPENCODE_BACKEND": args.backend,
+            "OPENCODE_SERVER_PORT": str(free_port()),
+            # 压测客户端发得比真人快得多，放宽每个用户的频率限制
+            "ADMISSION_USER_RATE_PER_MINUTE": "6000",
+            "ADMISSION_USER_BURST": "100",
+            "FAKE_OPENCODE_STATE": os.path.join(workdir, "fake_sessions"),
+            "FAKE_OPENCODE_STARTUP": str(args.startup),
+            "FAKE_OPENCODE_GEN_TIME": str(args.gen_time),
+            "FAKE_OPENCODE_SECTIONS": str(args.sections),
+            "FAKE_OPENCODE_FAIL_RATE": str(args.fail_rate),
+        }
+    )
+    os.makedirs(os.environ["WORKSPACE_DIR"], exist_ok=True)
+
+
+def free_port() -> int:
+    """找一个空闲的本地端口（给假 server 用）"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_for_server(handler, timeout: float = 30) -> bool:
+    """等 bot 启动的假 server 就绪"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if handler.server_backend and handler.server_backend.available:
+            return True
+        await asyncio.sleep(0.1)
+    return False
+
+
+async def server_stats(handler) -> Optional[Dict]:
+    """假 server 上的 session 统计（sessions / orphaned）"""
+    import httpx
+
+    try:
+        async with httpx.AsyncClient(base_url=handler.server_backend.server.base_url) as client:
+            response = await client.get("/fake/stats", timeout=5)
+            return response.json()
+    except httpx.HTTPError:
+        return None
+
+
+class UpdateFactory:
+    """生成合成的 Telegram update"""
+
+    def __init__(self, args):
+        self.args = args
+        self._update_id = 0
+
+    def make(self, chat_id: int) -> Dict:
+        self._update_id += 1
+        message = {
+            "message_id": self._update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {
+                "id": chat_id,
+                "is_bot": False,
+                "first_name": "Bench",
+                "username": f"user{chat_id}",
+            },
+        }
+
+        roll = random.random()
+        if roll < self.args.command_ratio:
+            message["text"] = "/ping"
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": 5}]
+        elif roll < self.args.command_ratio + self.args.photo_ratio:
+            file_id = f"photo{random.randint(1, 20)}"
+            message["photo"] = [
+                {"file_id": file_id, "file_unique_id": f"u_{file_id}", "width": 800, "height": 600}
+            ]
+            message["caption"] = "看看这张图喵"
+        else:
+            message["text"] = f"压测消息 {self._update_id}：今天过得怎么样？"
+
+        return {"update_id": self._update_id, "message": message}
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    """p50/p95/p99/max（毫秒）"""
+    if not values:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+    ordered = sorted(values)
+
+    def pick(p: float) -> float:
+        index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+        return round(ordered[index] * 1000, 1)
+
+    return {"p50": pick(50), "p95": pick(95), "p99": pick(99), "max": pick(100)}
+
+
+async def run_level(application, stub: TelegramStub, factory: UpdateFactory, chats: int, messages: int, chat_base: int) -> Dict:
+    """跑一个并发级别"""
+    from telegram import Update
+    from metrics import ADMISSION_REJECTED
+
+    rejected_before = sum(ADMISSION_REJECTED._values.values())
+    latencies: List[float] = []
+    first_message: List[float] = []
+    errors = 0
+
+    async def chat_loop(chat_id: int):
+        nonlocal errors
+        for _ in range(messages):
+            update = Update.de_json(factory.make(chat_id), application.bot)
+            started = time.monotonic()
+            try:
+                await application.process_update(update)
+            except Exception:
+                errors += 1
+            latencies.append(time.monotonic() - started)
+            first = stub.first_visible_after(chat_id, started)
+            if first is not None:
+                first_message.append(first - started)
+
+    started = time.monotonic()
+    await asyncio.gather(*(chat_loop(chat_base + i) for i in range(chats)))
+    wall = time.monotonic() - started
+
+    return {
+        "concurrency": chats,
+        "updates": len(latencies),
+        "errors": errors,
+        "rejected": int(sum(ADMISSION_REJECTED._values.values()) - rejected_before),
+        "wall_seconds": round(wall, 3),
+        "updates_per_second": round(len(latencies) / wall, 3) if wall else 0.0,
+        "latency_ms": percentiles(latencies),
+        "first_message_ms": percentiles(first_message),
+    }
+
+
+async def run(args) -> Dict:
+    import bot
+
+    stub = TelegramStub(latency=args.api_latency, retry_after_rate=args.retry_after_rate)
+    stub.start()
+    application = bot.build_application(
+        os.environ["TELEGRAM_BOT_TOKEN"], base_url=stub.base_url, base_file_url=stub.base_file_url
+    )
+    factory = UpdateFactory(args)
+    levels = []
+
+    server = None
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    try:
+        if args.backend == "server" and not await wait_for_server(bot.handler):
+            raise RuntimeError("假 opencode server 没有启动")
+        for index, chats in enumerate(int(c) for c in args.concurrency.split(",")):
+            result = await run_level(
+                application, stub, factory, chats, args.messages, chat_base=(index + 1) * 10000
+            )
+            levels.append(result)
+            print_level(result)
+        if args.backend == "server":
+            server = await server_stats(bot.handler)
+            print(f"server session: {server}")
+    finally:
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await application.shutdown()
+        stub.stop()
+
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": int(time.time()),
+            "args": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        },
+        "levels": levels,
+        "server": server,
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT_DIR,
+            capture_output=True,
+            text=True,
+            timeout=5,
+        ).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def print_level(result: Dict):
+    lat = result["latency_ms"]
+    ttfm = result["first_message_ms"]
+    print(
+        f"并发 {result['concurrency']:>3} | {result['updates']:>4} 条 | "
+        f"{result['updates_per_second']:>7.2f} 条/秒 | "
+        f"延迟 p50 {lat['p50']:>8.1f} p95 {lat['p95']:>8.1f} p99 {lat['p99']:>8.1f} ms | "
+        f"首条 p50 {ttfm['p50']:>8.1f} p95 {ttfm['p95']:>8.1f} ms | 错误 {result['errors']} "
+        f"| 拒绝 {result.get('rejected', 0)}"
+    )
+
+
+def compare(old: Dict, new: Dict, threshold: float) -> bool:
+    """对比两次结果，返回是否有退化"""
+    old_levels = {level["concurrency"]: level for level in old["levels"]}
+    regressed = False
+    print(f"\n对比 {old['meta'].get('commit')} -> {new['meta'].get('commit')}（阈值 {threshold}%）")
+
+    for level in new["levels"]:
+        base = old_levels.get(level["concurrency"])
+        if base is None:
+            continue
+        checks = [
+            ("延迟 p50", base["latency_ms"]["p50"], level["latency_ms"]["p50"], True),
+            ("延迟 p95", base["latency_ms"]["p95"], level["latency_ms"]["p95"], True),
+            ("延迟 p99", base["latency_ms"]["p99"], level["latency_ms"]["p99"], True),
+            ("首条 p50", base["first_message_ms"]["p50"], level["first_message_ms"]["p50"], True),
+            ("吞吐", base["updates_per_second"], level["updates_per_second"], False),
+        ]
+        for name, before, after, lower_is_better in checks:
+            if not before:
+                continue
+            change = (after - before) / before * 100
+            worse = change > threshold if lower_is_better else change < -threshold
+            regressed = regressed or worse
+            mark = "❌" if worse else "  "
+            print(
+                f"{mark} 并发 {level['concurrency']:>3} {name}: "
+                f"{before:.1f} -> {after:.1f} ({change:+.1f}%)"
+            )
+    return regressed
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+
+    with tempfile.TemporaryDirectory(prefix="chenqianyu-bench-") as workdir:
+        setup_env(args, workdir)
+        results = asyncio.run(run(args))
+
+    server = results.get("server")
+    if server and server.get("orphaned"):
+        print(f"❌ server 上留下了 {server['orphaned']} 个没有用过的 session")
+        sys.exit(1)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        if compare(old, results, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
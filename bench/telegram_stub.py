@@ -0,0 +1,188 @@
+"""
+Telegram Bot API 桩服务 - 压测时代替 api.telegram.org 喵～
+
+在本地线程里跑一个 HTTP 服务，实现 bot 用到的几个方法，
+并记录每次发送/编辑消息的时间，用来计算延迟。
+"""
+
+import json
+import time
+import random
+import threading
+from dataclasses import dataclass
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs
+
+# 会产生用户可见内容的方法
+VISIBLE_METHODS = {"sendMessage", "editMessageText", "sendPhoto"}
+
+# 假图片内容（下载用户图片时返回）
+FAKE_JPEG = b"\xff\xd8\xff\xe0" + b"\x00" * 2048 + b"\xff\xd9"
+
+
+@dataclass
+class ApiCall:
+    """一次 Bot API 调用"""
+
+    at: float  # time.monotonic()
+    method: str
+    chat_id: Optional[int]
+
+
+class TelegramStub:
+    """本地 Bot API 桩服务"""
+
+    def __init__(self, latency: float = 0.0, retry_after_rate: float = 0.0):
+        """
+        Args:
+            latency: 每次调用的模拟网络延迟（秒）
+            retry_after_rate: 返回 429 RetryAfter 的概率（0~1）
+        """
+        self.latency = latency
+        self.retry_after_rate = retry_after_rate
+        self.calls: List[ApiCall] = []
+        self._lock = threading.Lock()
+        self._next_message_id = 1
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    @property
+    def base_file_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/file/bot"
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def first_visible_after(self, chat_id: int, since: float) -> Optional[float]:
+        """chat 在 since 之后第一次收到可见内容的时间"""
+        with self._lock:
+            for call in self.calls:
+                if call.chat_id == chat_id and call.at >= since and call.method in VISIBLE_METHODS:
+                    return call.at
+        return None
+
+    def count(self, method: str) -> int:
+        with self._lock:
+            return sum(1 for call in self.calls if call.method == method)
+
+    def _record(self, method: str, chat_id: Optional[int]):
+        with self._lock:
+            self.calls.append(ApiCall(time.monotonic(), method, chat_id))
+
+    def _message(self, chat_id: int, **extra) -> Dict:
+        with self._lock:
+            message_id = self._next_message_id
+            self._next_message_id += 1
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+        }
+        message.update(extra)
+        return message
+
+    def handle(self, method: str, params: Dict) -> Dict:
+        """处理一次 API 调用，返回 Bot API 格式的响应"""
+        chat_id = int(params["chat_id"]) if "chat_id" in params else None
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if chat_id is not None and random.random() < self.retry_after_rate:
+            self._record(f"{method}:429", chat_id)
+            return {
+                "ok": False,
+                "error_code": 429,
+                "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            }
+
+        self._record(method, chat_id)
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method == "sendMessage":
+            result = self._message(chat_id, text=params.get("text", ""))
+        elif method == "editMessageText":
+            result = self._message(chat_id, text=params.get("text", ""))
+        elif method == "sendPhoto":
+            photo_id = f"uploaded_{random.getrandbits(32):08x}"
+            result = self._message(
+                chat_id,
+                photo=[{"file_id": photo_id, "file_unique_id": photo_id, "width": 1, "height": 1}],
+            )
+        elif method == "getFile":
+            file_id = params.get("file_id", "file")
+            result = {
+                "file_id": file_id,
+                "file_unique_id": f"u_{file_id}",
+                "file_size": len(FAKE_JPEG),
+                "file_path": f"photos/{file_id}.jpg",
+            }
+        else:
+            result = True
+
+        return {"ok": True, "result": result}
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, body: bytes, content_type: str, status: int = 200):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                # /file/bot<token>/<path>
+                self._reply(FAKE_JPEG, "image/jpeg")
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+                method = self.path.rstrip("/").rsplit("/", 1)[-1]
+                params = _parse_params(self.headers.get("Content-Type", ""), body)
+                response = stub.handle(method, params)
+                status = response.get("error_code", 200)
+                self._reply(json.dumps(response).encode(), "application/json", status)
+
+        return Handler
+
+
+def _parse_params(content_type: str, body: bytes) -> Dict[str, str]:
+    """解析表单或 multipart 参数（文件内容忽略）"""
+    if content_type.startswith("multipart/form-data"):
+        message = BytesParser().parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body
+        )
+        params = {}
+        for part in message.get_payload():
+            name = part.get_param("name", header="content-disposition")
+            if name and part.get_filename() is None:
+                params[name] = part.get_payload(decode=True).decode("utf-8", "replace")
+        return params
+    if content_type.startswith("application/json"):
+        return {k: str(v) for k, v in json.loads(body or b"{}").items()}
+    return {k: v[0] for k, v in parse_qs(body.decode("utf-8")).items()}
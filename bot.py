@@ -14,95 +14,373 @@ import os
 import sys
 import logging
 import asyncio
+import functools
+import json
+import time
+import signal
 from datetime import datetime
-from telegram import Update, InputFile
+from typing import List, Optional
+from urllib.parse import urlsplit
+from telegram import File, Update, InputFile
 from telegram.ext import (
     Application,
+    CallbackQueryHandler,
     CommandHandler,
+    InlineQueryHandler,
     MessageHandler,
+    TypeHandler,
     filters,
     ContextTypes,
 )
-import tempfile
+from telegram.error import BadRequest
+from telegram.request import HTTPXRequest
 
 # 添加当前目录到路径
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from config import Config
+from logging_setup import correlation_id, setup_file_log, setup_logging
 from message_handler import MessageHandler as OpencodeHandler, SimpleMessageHandler
+from dispatcher import ChatDispatcher
+from coalescer import MessageCoalescer, Batch
+from inbox import Inbox, EXPIRED, FAILED
+from admission import AdmissionController, parse_allowed_ids
+from media_cache import MediaCache
+from upload_cache import UploadCache
+from outbox import create_outbox
+from streaming import StreamingReply
+from http_server import HttpServer, Request, Response
+from metrics import (
+    REGISTRY,
+    CANCELLED,
+    INBOX_EVENTS,
+    PHOTO_SENDS,
+    STAGE_SECONDS,
+    TELEGRAM_SECONDS,
+    UPDATES_TOTAL,
+    Gauge,
+    timed,
+)
+from opencode_runner import process_stats
+from tracing import record_span, set_attrs, span, trace, tracer
 
 
-# 配置日志格式
-class ColoredFormatter(logging.Formatter):
-    """带颜色的日志格式化器"""
+# 日志由后台线程写出，不阻塞事件循环
+log_listener = setup_logging()
 
-    COLORS = {
-        "DEBUG": "\033[36m",  # 青色
-        "INFO": "\033[32m",  # 绿色
-        "WARNING": "\033[33m",  # 黄色
-        "ERROR": "\033[31m",  # 红色
-        "CRITICAL": "\033[35m",  # 紫色
-    }
-    RESET = "\033[0m"
+# 每条 update 的各阶段耗时写到 TRACE_FILE，可选采样最慢的 update 的调用栈
+tracer.configure(
+    export=setup_file_log(
+        "trace", Config.TRACE_FILE, Config.TRACE_FILE_MAX_MB, Config.LOG_FILE_BACKUPS
+    )
+    if Config.TRACE_FILE
+    else None,
+    slow_seconds=Config.TRACE_SLOW_SECONDS,
+    profile_interval=Config.PROFILE_INTERVAL_MS / 1000 if Config.PROFILE_ENABLED else 0,
+    top_n=Config.PROFILE_TOP_N,
+)
 
-    def format(self, record):
-        # 简化 logger 名称
-        if record.name.startswith("telegram"):
-            record.name = "TG"
-        elif record.name.startswith("httpx"):
-            record.name = "HTTP"
-        elif len(record.name) > 15:
-            record.name = record.name[:12] + "..."
+# 日志里最多记录用户消息的前多少个字
+LOG_TEXT_PREVIEW = 80
 
-        # 添加颜色
-        levelname = record.levelname
-        if levelname in self.COLORS:
-            record.levelname = f"{self.COLORS[levelname]}{levelname}{self.RESET}"
+logger = logging.getLogger(__name__)
 
-        # 格式化时间
-        record.asctime = self.formatTime(record, "%H:%M:%S")
+# 初始化消息处理器
+try:
+    handler = OpencodeHandler()
+    logger.info("使用 Opencode CLI 消息处理器")
+except Exception as e:
+    logger.warning("Opencode 处理器初始化失败，使用简化版: %s", e)
+    handler = SimpleMessageHandler()
+
+# 调度器：不同 chat 并行，同一 chat 串行
+dispatcher = ChatDispatcher()
+
+# 连发的文字消息合并成一次调用
+coalescer = MessageCoalescer(Config.COALESCE_WINDOW, Config.COALESCE_MAX_MESSAGES)
 
-        return super().format(record)
+# 收件箱：重启后继续处理没回复完的消息，按 update_id 去重
+inbox = Inbox(Config.INBOX_FILE, Config.INBOX_MAX_ATTEMPTS)
 
+# 重启后不再重新处理的消息的回复
+RESUME_NOTICES = {
+    EXPIRED: "重启前没来得及回复这条消息，已经过去太久了喵～有需要请再发一次吧！🐼",
+    FAILED: "这条消息处理了好几次都没成功，先跳过了喵～请换个说法再发一次吧！🐼",
+}
 
-# 创建处理器
-console_handler = logging.StreamHandler()
-console_handler.setLevel(getattr(logging, Config.LOG_LEVEL))
+# 白名单（启动时解析一次）
+ALLOWED_IDS = parse_allowed_ids(Config.ALLOWED_USER_ID)
 
-# 设置格式
-formatter = ColoredFormatter(
-    fmt="%(asctime)s %(levelname)s [%(name)s] %(message)s", datefmt="%H:%M:%S"
+# 准入控制：限制每个用户的请求频率、队列深度和等待时间
+admission = AdmissionController(
+    user_rate=Config.ADMISSION_USER_RATE_PER_MINUTE / 60,
+    user_burst=Config.ADMISSION_USER_BURST,
+    max_chat_queue=Config.ADMISSION_MAX_CHAT_QUEUE,
+    max_queued=Config.ADMISSION_MAX_QUEUED,
+    max_wait=Config.ADMISSION_MAX_WAIT,
 )
-console_handler.setFormatter(formatter)
 
-# 配置根日志器
-root_logger = logging.getLogger()
-root_logger.setLevel(getattr(logging, Config.LOG_LEVEL))
-root_logger.handlers = []  # 清除默认处理器
-root_logger.addHandler(console_handler)
+# 准入控制拒绝时的回复
+BUSY_MESSAGES = {
+    "rate": "你发得太快啦，休息一下再发喵～🐼",
+    "queue": "我现在有点忙不过来喵～请稍后再发一次吧！🐼",
+    "deadline": "我现在有点忙不过来喵～请稍后再发一次吧！🐼",
+    "expired": "排队太久啦，这条消息我先不处理了喵～请再发一次吧！🐼",
+}
+
+# 发送通道：限速并处理 RetryAfter
+outbox = create_outbox()
+
+# 收到的图片缓存
+media_cache = MediaCache(
+    Config.MEDIA_CACHE_DIR,
+    max_bytes=Config.MEDIA_CACHE_MAX_MB * 1024 * 1024,
+    max_age=Config.MEDIA_CACHE_MAX_AGE_HOURS * 3600,
+)
 
-# 抑制第三方库的冗余日志
-logging.getLogger("httpx").setLevel(logging.WARNING)
-logging.getLogger("httpcore").setLevel(logging.WARNING)
-logging.getLogger("telegram").setLevel(logging.INFO)
+# 发送过的图片的 file_id
+upload_cache = UploadCache(Config.UPLOAD_CACHE_FILE, Config.UPLOAD_CACHE_MAX_ENTRIES)
 
-logger = logging.getLogger(__name__)
+# 熔断状态在指标里的取值
+BREAKER_STATE_VALUES = {"closed": 0, "half_open": 1, "open": 2}
 
-# 初始化消息处理器
-try:
-    handler = OpencodeHandler()
-    logger.info("使用 Opencode CLI 消息处理器")
-except Exception as e:
-    logger.warning(f"Opencode 处理器初始化失败，使用简化版: {e}")
-    handler = SimpleMessageHandler()
+
+def breaker_state() -> str:
+    """Opencode 熔断状态（简化版处理器没有熔断，视为正常）"""
+    breaker = getattr(handler, "breaker", None)
+    return breaker.state if breaker is not None else "closed"
+
+
+# 监控指标和健康检查接口（监听 BOT_PORT）
+http_server = HttpServer(Config.BOT_HOST, Config.BOT_PORT)
+
+REGISTRY.register(
+    Gauge(
+        "chenqianyu_opencode_in_flight",
+        "正在运行的 opencode 进程数",
+        func=lambda: process_stats()["in_flight"],
+    )
+)
+REGISTRY.register(
+    Gauge(
+        "chenqianyu_opencode_waiting",
+        "等待进程槽位的 opencode 调用数",
+        func=lambda: process_stats()["waiting"],
+    )
+)
+REGISTRY.register(
+    Gauge(
+        "chenqianyu_queued_updates",
+        "在 chat 队列里排队的 update 数",
+        func=lambda: dispatcher.total_queued(),
+    )
+)
+REGISTRY.register(
+    Gauge(
+        "chenqianyu_handle_seconds_average",
+        "单条请求处理耗时的移动平均（秒），用来估算等待时间",
+        func=lambda: admission.handle_seconds,
+    )
+)
+REGISTRY.register(
+    Gauge(
+        "chenqianyu_archive_pending",
+        "排队和正在进行的归档任务数",
+        func=lambda: handler.session_manager.archiver.pending_count()
+        if hasattr(handler, "session_manager")
+        else 0,
+    )
+)
+
+REGISTRY.register(
+    Gauge(
+        "chenqianyu_breaker_state",
+        "Opencode 熔断状态（0 正常 / 1 半开 / 2 断开）",
+        func=lambda: BREAKER_STATE_VALUES[breaker_state()],
+    )
+)
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """记录每次 Bot API 调用耗时的请求类"""
+
+    async def do_request(self, url: str, method: str, request_data=None, **kwargs):
+        # 文件下载的 URL 里是文件路径，不能直接当标签
+        api_method = "download" if "/file/" in url else url.rsplit("/", 1)[-1]
+        started = time.monotonic()
+        try:
+            with span("telegram", method=api_method):
+                return await super().do_request(url, method, request_data=request_data, **kwargs)
+        finally:
+            TELEGRAM_SECONDS.observe(time.monotonic() - started, method=api_method)
+
+
+class TracedApplication(Application):
+    """每条 update 的处理过程是一个 trace，日志关联 ID 和 trace ID 都是 update_id"""
+
+    async def process_update(self, update: object) -> None:
+        if not isinstance(update, Update):
+            return await super().process_update(update)
+
+        update_id = str(update.update_id)
+        # 处理这条 update 的后续日志（包括在 chat 队列里执行的部分）都带上它
+        correlation_id.set(update_id)
+        chat = update.effective_chat
+
+        # 需要回复的消息先记进收件箱；已经处理过的（Telegram 重发、重启后重新放回）跳过
+        journaled = needs_reply(update)
+        if journaled and not inbox.begin(
+            update.update_id, chat.id if chat else None, update.to_dict()
+        ):
+            logger.info("update %s 已经处理过或正在处理，跳过", update_id)
+            return
+
+        try:
+            with trace(update_id, "update", chat_id=chat.id if chat else None):
+                await super().process_update(update)
+        except asyncio.CancelledError:
+            # 关闭 bot 时被中断：留到下次启动继续处理
+            inbox.release(update.update_id)
+            raise
+        if journaled:
+            inbox.settle(update.update_id)
+
+
+def needs_reply(update: Update) -> bool:
+    """会调用 Opencode 回复的 update（文字和图片消息，不含命令）"""
+    message = update.message
+    if message is None:
+        return False
+    if message.photo:
+        return True
+    return bool(message.text) and not message.text.startswith("/")
 
 
 def check_user_permission(user_id: int) -> bool:
     """检查用户是否有权限访问"""
-    if not Config.ALLOWED_USER_ID:
-        return True  # 如果没有设置白名单，允许所有用户
-    allowed_ids = [int(uid.strip()) for uid in Config.ALLOWED_USER_ID.split(",")]
-    return user_id in allowed_ids
+    with timed("auth"):
+        # 没有设置白名单时允许所有用户
+        return ALLOWED_IDS is None or user_id in ALLOWED_IDS
+
+
+async def admit(update: Update) -> bool:
+    """准入检查：请求太多或预计等太久时直接回复“忙”并返回 False"""
+    chat_id = update.effective_chat.id
+    procs = process_stats()
+    reason = admission.check(
+        update.effective_user.id,
+        chat_queued=dispatcher.queue_depth(chat_id),
+        chat_running=dispatcher.is_running(chat_id),
+        total_queued=dispatcher.total_queued(),
+        backend_backlog=procs["waiting"] / max(procs["limit"], 1),
+    )
+    if reason is None:
+        return True
+    await outbox.reply_text(update.message, BUSY_MESSAGES[reason])
+    return False
+
+
+def supersede(chat_id: int):
+    """新消息优先（SUPERSEDE_RUNNING）：取消 chat 里还没回复完的请求"""
+    if not Config.SUPERSEDE_RUNNING:
+        return
+    cancelled = dispatcher.cancel(chat_id)
+    if cancelled:
+        CANCELLED.inc(cancelled, reason="superseded")
+        logger.info("chat %s 有新消息，取消了 %s 个请求", chat_id, cancelled)
+
+
+async def run_in_chat(update: Update, func) -> None:
+    """把任务放进 chat 的队列并等待完成，记录排队和处理耗时"""
+    enqueued_at = time.monotonic()
+
+    async def job():
+        waited = time.monotonic() - enqueued_at
+        STAGE_SECONDS.observe(waited, stage="queue_wait")
+        record_span("queue_wait", waited)
+        if admission.expired(waited):
+            await outbox.reply_text(update.message, BUSY_MESSAGES["expired"])
+            return
+
+        started = time.monotonic()
+        cancelled = False
+        try:
+            with timed("handle"):
+                await func()
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            # 被取消的请求耗时不代表正常处理时间
+            if not cancelled:
+                admission.observe(time.monotonic() - started)
+
+    await dispatcher.submit(update.effective_chat.id, job)
+
+
+def per_chat(func):
+    """让处理函数进入所属 chat 的队列，保证同一 chat 内按顺序处理"""
+
+    @functools.wraps(func)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        chat = update.effective_chat
+        if chat is None:
+            return await func(update, context)
+
+        # 没有权限的交给处理函数回复
+        if check_user_permission(update.effective_user.id):
+            supersede(chat.id)
+            if not await admit(update):
+                return
+
+        # 排在这个任务后面的文字消息不能再并入它前面的批次
+        coalescer.close(chat.id)
+        await run_in_chat(update, lambda: func(update, context))
+
+    return wrapper
+
+
+async def count_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """统计收到的 update 类型（在所有处理器之前运行）"""
+    message = update.message
+    if message is None:
+        kind = "other"
+    elif message.photo:
+        kind = "photo"
+    elif message.text and message.text.startswith("/"):
+        kind = "command"
+    elif message.text:
+        kind = "text"
+    else:
+        kind = "other"
+    UPDATES_TOTAL.inc(type=kind)
+    set_attrs(type=kind)
+
+
+async def metrics_endpoint(request: Request) -> Response:
+    """Prometheus 指标"""
+    return Response(
+        body=REGISTRY.render().encode(),
+        content_type="text/plain; version=0.0.4; charset=utf-8",
+    )
+
+
+async def health_endpoint(request: Request) -> Response:
+    """健康检查"""
+    body = {
+        "status": "ok",
+        "opencode": process_stats(),
+        "breaker": breaker_state(),
+        "queued": dispatcher.total_queued(),
+        "handle_seconds_average": round(admission.handle_seconds, 3),
+    }
+    return Response(body=json.dumps(body).encode(), content_type="application/json")
+
+
+async def slow_updates_endpoint(request: Request) -> Response:
+    """最慢的几条 update 的各阶段耗时和调用栈采样（PROFILE_ENABLED）"""
+    body = json.dumps(tracer.slowest(), ensure_ascii=False, indent=2)
+    return Response(body=body.encode(), content_type="application/json")
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -111,8 +389,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     # 检查用户权限
     if not check_user_permission(user.id):
-        await update.message.reply_text("抱歉，你没有权限使用这个 Bot 喵～🐼")
-        logger.warning(f"未授权用户尝试访问: {user.id} ({user.username})")
+        await outbox.reply_text(update.message, "抱歉，你没有权限使用这个 Bot 喵～🐼")
+        logger.warning("未授权用户尝试访问: %s (%s)", user.id, user.username)
         return
 
     welcome_msg = f"""你好 {user.first_name}！我是陈千语喵～🐼
@@ -124,11 +402,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 /start - 开始聊天
 /help - 显示帮助
 /ping - 检查状态
+/cancel - 停止正在生成的回复
 
 发送任何消息都会触发 AI 回复喵～"""
 
-    await update.message.reply_text(welcome_msg)
-    logger.info(f"用户 {user.id} ({user.username}) 启动了 bot")
+    await outbox.reply_text(update.message, welcome_msg)
+    logger.info("用户 %s (%s) 启动了 bot", user.id, user.username)
 
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -151,6 +430,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 /start - 开始聊天
 /help - 显示帮助  
 /ping - 检查 bot 状态
+/cancel - 停止正在生成的回复
 
 📝 提示：
 - 我会保持角色设定说话
@@ -159,7 +439,27 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
 🐼 祝你使用愉快喵～"""
 
-    await update.message.reply_text(help_text)
+    await outbox.reply_text(update.message, help_text)
+
+
+async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """取消这个 chat 正在生成和排队的回复（不进队列，立即生效）"""
+    user = update.effective_user
+    chat_id = update.effective_chat.id
+
+    # 检查用户权限
+    if not check_user_permission(user.id):
+        return
+
+    # 正在收集的批次随任务一起丢弃，之后的消息进新批次
+    coalescer.close(chat_id)
+    cancelled = dispatcher.cancel(chat_id)
+    if cancelled:
+        CANCELLED.inc(cancelled, reason="command")
+        logger.info("用户 %s 取消了 chat %s 的 %s 个请求", user.id, chat_id, cancelled)
+        await outbox.reply_text(update.message, "好的，已经停下来了喵～🐼")
+    else:
+        await outbox.reply_text(update.message, "现在没有正在处理的消息喵～🐼")
 
 
 async def ping(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -170,91 +470,175 @@ async def ping(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not check_user_permission(user.id):
         return
 
-    await update.message.reply_text("✅ Pong! Bot 运行正常喵～🐼")
+    procs = process_stats()
+    queue_line = f"本会话排队: {dispatcher.queue_depth(update.effective_chat.id)} 条"
+    stats = dispatcher.chat_stats(update.effective_chat.id)
+    if stats is not None and stats.processed:
+        queue_line += (
+            f"（上次等了 {stats.last_wait:.1f} 秒，最近平均 {stats.recent_wait:.1f} 秒，"
+            f"最长 {stats.max_wait:.1f} 秒）"
+        )
+    await outbox.reply_text(
+        update.message,
+        "✅ Pong! Bot 运行正常喵～🐼\n"
+        f"{queue_line}\n"
+        f"Opencode 进程: {procs['in_flight']}/{procs['limit']}（等待 {procs['waiting']}）"
+    )
+
+
+async def send_image(update: Update, image_path: str) -> None:
+    """发送回复里的图片：同一个文件发送过就直接用 file_id，不再上传"""
+    user = update.effective_user
+    chat_id = update.effective_chat.id
+    key = UploadCache.key(image_path)
+    file_id = upload_cache.get(key) if key else None
+
+    try:
+        if file_id:
+            try:
+                await outbox.send(chat_id, lambda: update.message.reply_photo(photo=file_id))
+                PHOTO_SENDS.inc(source="file_id")
+                logger.info("已发送图片给用户 %s（使用缓存的 file_id）: %s", user.id, image_path)
+                return
+            except BadRequest as e:
+                logger.warning("缓存的 file_id 不能用了，重新上传: %s", e)
+                upload_cache.discard(key)
+
+        # 先读出全部内容：限流或网络错误重试时要重新上传整张图片
+        with open(image_path, 'rb') as photo:
+            data = photo.read()
+        filename = os.path.basename(image_path)
+        message = await outbox.send(
+            chat_id, lambda: update.message.reply_photo(photo=InputFile(data, filename=filename))
+        )
+        PHOTO_SENDS.inc(source="upload")
+        if key and message.photo:
+            upload_cache.put(key, message.photo[-1].file_id)
+        logger.info("已发送图片给用户 %s: %s", user.id, image_path)
+    except Exception as img_err:
+        logger.error("发送图片失败: %s", img_err)
+        await outbox.reply_text(update.message, f"图片生成好了，但发送失败了喵～({img_err})")
+
+
+async def stream_reply(update: Update, **kwargs) -> None:
+    """流式获取回复并边生成边发送，最后发送图片（如果有）"""
+    user = update.effective_user
+    reply = StreamingReply(update.message, outbox, edit_interval=Config.STREAM_EDIT_INTERVAL)
+
+    stream = handler.stream_message(**kwargs)
+    try:
+        async for chunk in stream:
+            await reply.feed(chunk)
+    finally:
+        # 被取消或发送出错时立刻结束生成，不等垃圾回收
+        await stream.aclose()
+    await reply.finish()
+    logger.info("已流式发送 %s 条消息给用户 %s", reply.sent_count, user.id)
+
+    if reply.image_path and os.path.exists(reply.image_path):
+        await send_image(update, reply.image_path)
 
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """处理收到的消息"""
+    """处理收到的消息（同一个人连发的消息合并成一次回复）"""
     user = update.effective_user
+    chat_id = update.effective_chat.id
     message_text = update.message.text
 
     # 检查用户权限
     if not check_user_permission(user.id):
-        await update.message.reply_text("抱歉，你没有权限使用这个 Bot 喵～🐼")
-        logger.warning(f"未授权用户尝试发消息: {user.id} ({user.username})")
+        await outbox.reply_text(update.message, "抱歉，你没有权限使用这个 Bot 喵～🐼")
+        logger.warning("未授权用户尝试发消息: %s (%s)", user.id, user.username)
         return
 
-    logger.info(f"收到来自 {user.id} ({user.username}) 的消息: {message_text}")
-
-    # 显示"正在输入..."状态
-    await context.bot.send_chat_action(
-        chat_id=update.effective_chat.id, action="typing"
+    logger.info(
+        "收到来自 %s (%s) 的消息（%s 字）: %.*s",
+        user.id, user.username, len(message_text), LOG_TEXT_PREVIEW, message_text,
     )
 
+    # 并入已有批次的消息不产生新的请求，不用检查
+    if not coalescer.can_merge(chat_id, user.id):
+        supersede(chat_id)
+        if not await admit(update):
+            return
+
+    batch = coalescer.add(chat_id, user.id, message_text, update.update_id)
+    if batch is None:
+        logger.info("消息已并入 chat %s 待处理的批次", chat_id)
+        # 批次回复完才算处理完
+        inbox.defer(update.update_id)
+        return
+
     try:
-        # 调用消息处理器获取回复
-        response = handler.process_message(
-            user_id=user.id,
-            username=user.username or user.first_name,
-            message_text=message_text,
-        )
+        await run_in_chat(update, lambda: reply_to_batch(update, context, batch))
+    finally:
+        # 排队超时、出错或被取消时批次可能还开着，不能让之后的消息并入没人回复的批次
+        coalescer.release(batch)
+    # 并入这个批次的消息随它一起处理完了（包括被取消）
+    inbox.finish(*batch.update_ids)
 
-        # 检测图片标记 [IMAGE:路径]
-        import re
-        image_pattern = r'\[IMAGE:([^\]]+)\]'
-        image_match = re.search(image_pattern, response)
-        image_path = None
 
-        if image_match:
-            image_path = image_match.group(1).strip()
-            # 从回复中移除图片标记
-            response = re.sub(image_pattern, '', response).strip()
+async def reply_to_batch(update: Update, context: ContextTypes.DEFAULT_TYPE, batch: Batch) -> None:
+    """等批次收集完，把合并后的消息交给处理器并回复"""
+    user = update.effective_user
 
-        # 按 3 个换行符分割消息，分多次发送
-        messages = [msg.strip() for msg in response.split("\n\n\n") if msg.strip()]
+    message_text = await coalescer.collect(batch)
 
-        if not messages:
-            messages = [response]
+    try:
+        # 显示"正在输入..."状态
+        await context.bot.send_chat_action(
+            chat_id=update.effective_chat.id, action="typing"
+        )
 
-        for i, msg in enumerate(messages):
-            if msg:  # 只发送非空消息
-                await update.message.reply_text(msg)
-                logger.info(f"已发送第 {i + 1}/{len(messages)} 条消息给用户 {user.id}")
+        if Config.STREAM_REPLIES:
+            await stream_reply(
+                update,
+                user_id=user.id,
+                username=user.username or user.first_name,
+                chat_id=update.effective_chat.id,
+                message_text=message_text,
+            )
+            return
 
-                # 多条消息之间间隔 600ms
-                if i < len(messages) - 1:
-                    await asyncio.sleep(0.6)
+        # 调用消息处理器获取回复
+        response = await handler.process_message(
+            user_id=user.id,
+            username=user.username or user.first_name,
+            chat_id=update.effective_chat.id,
+            message_text=message_text,
+        )
+
+        # 按段落拆分后依次发送
+        sent, image_path = await outbox.send_reply(update.message, response)
+        logger.info("已发送 %s 条消息给用户 %s", sent, user.id)
 
         # 如果有图片，发送图片
         if image_path and os.path.exists(image_path):
-            try:
-                with open(image_path, 'rb') as photo:
-                    await update.message.reply_photo(photo=InputFile(photo))
-                logger.info(f"已发送图片给用户 {user.id}: {image_path}")
-            except Exception as img_err:
-                logger.error(f"发送图片失败: {img_err}")
-                await update.message.reply_text(f"图片生成好了，但发送失败了喵～({img_err})")
+            await send_image(update, image_path)
 
     except Exception as e:
-        logger.error(f"处理消息时出错: {e}")
-        await update.message.reply_text("抱歉，处理消息时出错了喵～请稍后再试！🐼")
+        logger.error("处理消息时出错: %s", e)
+        await outbox.reply_text(update.message, "抱歉，处理消息时出错了喵～请稍后再试！🐼")
 
 
+@per_chat
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """处理收到的图片消息"""
     user = update.effective_user
     
     # 检查用户权限
     if not check_user_permission(user.id):
-        await update.message.reply_text("抱歉，你没有权限使用这个 Bot 喵～🐼")
-        logger.warning(f"未授权用户尝试发图片: {user.id} ({user.username})")
+        await outbox.reply_text(update.message, "抱歉，你没有权限使用这个 Bot 喵～🐼")
+        logger.warning("未授权用户尝试发图片: %s (%s)", user.id, user.username)
         return
     
     # 获取图片文件
     photo = update.message.photo[-1]  # 取最大尺寸的图片
     caption = update.message.caption or ""
     
-    logger.info(f"收到来自 {user.id} ({user.username}) 的图片，尺寸: {photo.width}x{photo.height}")
+    logger.info(
+        "收到来自 %s (%s) 的图片，尺寸: %sx%s", user.id, user.username, photo.width, photo.height
+    )
     
     # 显示"正在输入..."状态
     await context.bot.send_chat_action(
@@ -262,77 +646,264 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     )
     
     try:
-        # 下载图片
-        file = await context.bot.get_file(photo.file_id)
-        
-        # 创建临时文件保存图片
-        temp_dir = tempfile.gettempdir()
-        image_filename = f"telegram_photo_{user.id}_{photo.file_id}.jpg"
-        image_path = os.path.join(temp_dir, image_filename)
-        
-        await file.download_to_drive(image_path)
-        logger.info(f"图片已下载到: {image_path}")
+        # 下载图片（同一张图片再次发来时直接用缓存）
+        async def get_file() -> File:
+            return await context.bot.get_file(photo.file_id)
+
+        image_path = str(await media_cache.fetch(photo.file_unique_id, get_file))
+        logger.info("图片已保存到: %s", image_path)
         
         # 准备消息内容
         message_with_image = f"[用户发送了一张图片]"
         if caption:
             message_with_image += f"\n配文: {caption}"
         
+        if Config.STREAM_REPLIES:
+            await stream_reply(
+                update,
+                user_id=user.id,
+                username=user.username or user.first_name,
+                chat_id=update.effective_chat.id,
+                message_text=message_with_image,
+                image_path=image_path,
+            )
+            return
+
         # 调用消息处理器获取回复，传入图片路径
-        response = handler.process_message(
+        response = await handler.process_message(
             user_id=user.id,
             username=user.username or user.first_name,
+            chat_id=update.effective_chat.id,
             message_text=message_with_image,
             image_path=image_path,
         )
         
-        # 检测图片标记 [IMAGE:路径]
-        import re
-        image_pattern = r'\[IMAGE:([^\]]+)\]'
-        image_match = re.search(image_pattern, response)
-        response_image_path = None
-        
-        if image_match:
-            response_image_path = image_match.group(1).strip()
-            # 从回复中移除图片标记
-            response = re.sub(image_pattern, '', response).strip()
-        
-        # 按 3 个换行符分割消息，分多次发送
-        messages = [msg.strip() for msg in response.split("\n\n\n") if msg.strip()]
-        
-        if not messages:
-            messages = [response]
-        
-        for i, msg in enumerate(messages):
-            if msg:  # 只发送非空消息
-                await update.message.reply_text(msg)
-                logger.info(f"已发送第 {i + 1}/{len(messages)} 条消息给用户 {user.id}")
-                
-                # 多条消息之间间隔 600ms
-                if i < len(messages) - 1:
-                    await asyncio.sleep(0.6)
-        
+        # 按段落拆分后依次发送
+        sent, response_image_path = await outbox.send_reply(update.message, response)
+        logger.info("已发送 %s 条消息给用户 %s", sent, user.id)
+
         # 如果有图片，发送图片
         if response_image_path and os.path.exists(response_image_path):
-            try:
-                with open(response_image_path, 'rb') as photo_file:
-                    await update.message.reply_photo(photo=InputFile(photo_file))
-                logger.info(f"已发送图片给用户 {user.id}: {response_image_path}")
-            except Exception as img_err:
-                logger.error(f"发送图片失败: {img_err}")
-                await update.message.reply_text(f"图片生成好了，但发送失败了喵～({img_err})")
+            await send_image(update, response_image_path)
         
     except Exception as e:
-        logger.error(f"处理图片消息时出错: {e}")
-        await update.message.reply_text("抱歉，处理图片时出错了喵～请稍后再试！🐼")
+        logger.error("处理图片消息时出错: %s", e)
+        await outbox.reply_text(update.message, "抱歉，处理图片时出错了喵～请稍后再试！🐼")
 
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """处理错误"""
-    logger.error(f"更新 {update} 导致错误: {context.error}")
+    logger.error("更新 %s 导致错误: %s", update, context.error)
 
     if update and update.effective_message:
-        await update.effective_message.reply_text("哎呀，出错了喵～请稍后再试！🐼")
+        await outbox.reply_text(update.effective_message, "哎呀，出错了喵～请稍后再试！🐼")
+
+
+# 处理器类型 -> 它处理的 update 类型
+HANDLER_UPDATE_TYPES = {
+    CommandHandler: [Update.MESSAGE],
+    MessageHandler: [Update.MESSAGE],
+    CallbackQueryHandler: [Update.CALLBACK_QUERY],
+    InlineQueryHandler: [Update.INLINE_QUERY],
+}
+
+
+def allowed_update_types(application: Application) -> List[str]:
+    """
+    根据已注册的处理器计算需要订阅的 update 类型
+
+    TypeHandler 只做统计，不影响订阅；遇到不认识的处理器时订阅全部类型。
+    """
+    types: List[str] = []
+    for handlers in application.handlers.values():
+        for h in handlers:
+            if isinstance(h, TypeHandler):
+                continue
+            handled = next(
+                (v for k, v in HANDLER_UPDATE_TYPES.items() if isinstance(h, k)), None
+            )
+            if handled is None:
+                return list(Update.ALL_TYPES)
+            types.extend(t for t in handled if t not in types)
+    return types
+
+
+def webhook_path() -> str:
+    """webhook 在本地监听的路径（取 WEBHOOK_URL 的路径部分）"""
+    return urlsplit(Config.WEBHOOK_URL).path or "/webhook"
+
+
+def register_webhook(application: Application) -> None:
+    """在 HTTP 服务上注册接收 update 的 webhook 接口"""
+
+    async def webhook_endpoint(request: Request) -> Response:
+        if Config.WEBHOOK_SECRET:
+            token = request.headers.get("x-telegram-bot-api-secret-token")
+            if token != Config.WEBHOOK_SECRET:
+                return Response(403, b"forbidden")
+        try:
+            data = json.loads(request.body)
+            update = Update.de_json(data, application.bot)
+        except Exception as e:
+            logger.warning("无法解析 webhook 请求: %s", e)
+            return Response(400, b"bad update")
+
+        # 放进队列后立即返回，由 Application 异步处理
+        await application.update_queue.put(update)
+        return Response(body=b"ok")
+
+    http_server.route("POST", webhook_path(), webhook_endpoint)
+
+
+async def resume_updates(application: Application) -> None:
+    """
+    把上次没处理完的消息放回队列
+
+    太旧的或者重试次数用完的不再处理，只回复一句（先标记再回复，最多回复一次）。
+    """
+    pending = inbox.unfinished()
+    if not pending:
+        return
+
+    now = time.time()
+    resumed = 0
+    for item in pending:
+        update = Update.de_json(item.payload, application.bot)
+        if item.attempts >= inbox.max_attempts:
+            status = FAILED
+        elif now - item.received_at > Config.INBOX_RESUME_MAX_AGE:
+            status = EXPIRED
+        else:
+            await application.update_queue.put(update)
+            resumed += 1
+            continue
+
+        inbox.give_up(item.update_id, status)
+        try:
+            await outbox.reply_text(update.message, RESUME_NOTICES[status])
+        except Exception as e:
+            logger.warning("回复 update %s 失败: %s", item.update_id, e)
+
+    if resumed:
+        INBOX_EVENTS.inc(resumed, event="resumed")
+    logger.info("上次有 %s 条消息没处理完，继续处理其中 %s 条", len(pending), resumed)
+
+
+async def on_startup(application: Application) -> None:
+    """启动后台任务"""
+    media_cache.cleanup()
+    inbox.cleanup()
+    await handler.start()
+    await resume_updates(application)
+    if Config.METRICS_ENABLED:
+        http_server.route("GET", "/metrics", metrics_endpoint)
+        http_server.route("GET", "/healthz", health_endpoint)
+    if Config.PROFILE_ENABLED:
+        http_server.route("GET", "/debug/slow", slow_updates_endpoint)
+        tracer.start_profiler()
+    if http_server.has_routes:
+        try:
+            await http_server.start()
+        except OSError as e:
+            # webhook 模式离不开这个端口；只有 /metrics 等接口的话不影响收发消息
+            if http_server.has_route("POST", webhook_path()):
+                raise
+            logger.warning("HTTP 服务启动失败（端口 %s），/metrics 等接口暂不可用: %s", Config.BOT_PORT, e)
+
+
+async def on_shutdown(application: Application) -> None:
+    """关闭时取消还在排队的任务和后台任务"""
+    await dispatcher.shutdown()
+    await tracer.stop_profiler()
+    await handler.shutdown()
+    await http_server.stop()
+    inbox.close()
+
+
+def build_application(
+    token: str, base_url: Optional[str] = None, base_file_url: Optional[str] = None
+) -> Application:
+    """
+    创建 Application 并注册所有处理器
+
+    Args:
+        token: Telegram Bot Token
+        base_url: Bot API 地址（可选，压测时指向本地桩服务）
+        base_file_url: 文件下载地址（可选）
+    """
+    # 开启并发处理 update，顺序由 dispatcher 按 chat 保证
+    builder = (
+        Application.builder()
+        .application_class(TracedApplication)
+        .token(token)
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .concurrent_updates(Config.MAX_CONCURRENT_UPDATES)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    if base_file_url:
+        builder = builder.base_file_url(base_file_url)
+    application = builder.build()
+
+    # 添加处理器
+    application.add_handler(TypeHandler(Update, count_update), group=-1)
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("ping", ping))
+    application.add_handler(CommandHandler("cancel", cancel_command))
+    application.add_handler(
+        MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message)
+    )
+    application.add_handler(
+        MessageHandler(filters.PHOTO, handle_photo)
+    )
+
+    # 错误处理器
+    application.add_error_handler(error_handler)
+
+    return application
+
+
+async def run_webhook(application: Application) -> bool:
+    """
+    以 webhook 模式运行，直到收到 SIGINT/SIGTERM
+
+    Returns:
+        False 表示设置 webhook 失败（没有开始运行），调用方应改用轮询
+    """
+    allowed_updates = allowed_update_types(application)
+    await application.initialize()
+    try:
+        await application.bot.set_webhook(
+            url=Config.WEBHOOK_URL,
+            allowed_updates=allowed_updates,
+            secret_token=Config.WEBHOOK_SECRET or None,
+        )
+    except Exception as e:
+        logger.error("设置 webhook 失败，改用轮询: %s", e)
+        await application.shutdown()
+        return False
+
+    register_webhook(application)
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    logger.info("Webhook 已就绪: %s，订阅 %s", Config.WEBHOOK_URL, allowed_updates)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+    return True
 
 
 def main() -> None:
@@ -350,32 +921,22 @@ def main() -> None:
         sys.exit(1)
 
     print(f"🤖 Opencode CLI: {Config.OPENCODE_CLI}")
+    print(f"⚙️  Opencode 进程上限: {Config.OPENCODE_MAX_PROCESSES}")
+    print(f"🔌 Opencode 后端: {Config.OPENCODE_BACKEND}")
+    print(f"📡 接收方式: {'webhook ' + Config.WEBHOOK_URL if Config.WEBHOOK_URL else '轮询'}")
     print("=" * 50)
 
-    # 创建 Application
-    application = Application.builder().token(Config.TELEGRAM_TOKEN).build()
-
-    # 添加处理器
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("ping", ping))
-    application.add_handler(
-        MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message)
-    )
-    application.add_handler(
-        MessageHandler(filters.PHOTO, handle_photo)
-    )
-
-    # 错误处理器
-    application.add_error_handler(error_handler)
+    application = build_application(Config.TELEGRAM_TOKEN)
 
     print("🚀 Bot 启动中...")
     print("📱 在 Telegram 中搜索你的 Bot 开始聊天")
     print("⚠️  按 Ctrl+C 停止")
     print("=" * 50)
 
-    # 运行 bot
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # 运行 bot：配置了 WEBHOOK_URL 就用 webhook，否则（或设置失败时）用轮询
+    if Config.WEBHOOK_URL and asyncio.run(run_webhook(application)):
+        return
+    application.run_polling(allowed_updates=allowed_update_types(application))
 
 
 if __name__ == "__main__":
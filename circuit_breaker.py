@@ -0,0 +1,127 @@
+"""
+熔断模块 - Opencode 出故障时立刻回复，不让每条消息都等到超时喵～
+
+记录最近几次调用 Opencode 的结果，失败（出错或超时）比例太高就断开：
+之后的消息不再调用 Opencode，直接回复降级消息。断开时长一到就进入
+半开状态，放行一条真实请求作为试探（只有真实请求才会走到模型提供方），
+成功就恢复正常，失败就继续断开、断开时长翻倍。
+"""
+
+import time
+import asyncio
+import logging
+import contextvars
+from collections import deque
+from typing import Deque, Optional
+from metrics import BREAKER_TRANSITIONS, BREAKER_FAST_FAILS
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"  # 正常
+OPEN = "open"  # 断开，直接降级
+HALF_OPEN = "half_open"  # 试探中，只放行一条请求
+
+# 断开时长的上限（秒）：试探一直失败时间隔翻倍，最多到这么久
+MAX_OPEN_SECONDS = 300
+
+
+class CircuitBreaker:
+    """按最近调用的失败比例断开和恢复"""
+
+    def __init__(
+        self,
+        window: int,
+        min_calls: int,
+        failure_ratio: float,
+        open_seconds: float,
+    ):
+        """
+        Args:
+            window: 统计最近多少次调用
+            min_calls: 至少有这么多次结果才判断
+            failure_ratio: 失败比例达到多少时断开（0~1）
+            open_seconds: 断开后多久放行试探请求（秒），试探失败后翻倍
+        """
+        self.window = max(1, window)
+        self.min_calls = max(1, min(min_calls, self.window))
+        self.failure_ratio = failure_ratio
+        self.open_seconds = open_seconds
+
+        self.state = CLOSED
+        self._results: Deque[bool] = deque(maxlen=self.window)  # True 表示失败
+        self._delay = open_seconds
+        self._trial_at: Optional[float] = None  # 半开状态下放行试探请求的时间
+        self._task: Optional[asyncio.Task] = None
+
+    def allow(self) -> bool:
+        """这次能不能调用 Opencode；不能时调用方直接降级"""
+        if self.state == CLOSED:
+            return True
+        if self.state == HALF_OPEN:
+            # 一次只放行一条试探请求；它被取消没有结果时，过一段时间再放行下一条
+            now = time.monotonic()
+            if self._trial_at is None or now - self._trial_at >= self.open_seconds:
+                self._trial_at = now
+                return True
+        BREAKER_FAST_FAILS.inc()
+        return False
+
+    def record_success(self):
+        """记录一次成功的调用"""
+        if self.state == HALF_OPEN:
+            logger.info("Opencode 试探请求成功，恢复正常喵～")
+            self._close()
+            return
+        self._results.append(False)
+
+    def record_failure(self, reason: str):
+        """记录一次失败（出错或超时）的调用"""
+        if self.state == HALF_OPEN:
+            logger.warning("Opencode 试探请求失败（%s），继续断开", reason)
+            self._open(self._delay * 2)
+            return
+        if self.state == OPEN:
+            # 断开前就已经发出的请求，结果不影响状态
+            return
+
+        self._results.append(True)
+        failures = sum(self._results)
+        if len(self._results) >= self.min_calls and failures >= self.failure_ratio * len(self._results):
+            logger.error(
+                "最近 %s 次 Opencode 调用失败 %s 次（%s），暂停调用 %.0f 秒",
+                len(self._results), failures, reason, self._delay,
+            )
+            self._open(self.open_seconds)
+
+    async def shutdown(self):
+        """停止断开计时"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def _open(self, delay: float):
+        self._set_state(OPEN)
+        self._delay = min(delay, MAX_OPEN_SECONDS)
+        self._trial_at = None
+        if self._task is None or self._task.done():
+            # 用空的 context 启动：计时不属于触发断开的那条消息（日志关联 ID、trace、RunTracker）
+            self._task = contextvars.Context().run(asyncio.create_task, self._recover())
+
+    def _close(self):
+        self._set_state(CLOSED)
+        self._results.clear()
+        self._delay = self.open_seconds
+        self._trial_at = None
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            self.state = state
+            BREAKER_TRANSITIONS.inc(state=state)
+
+    async def _recover(self):
+        """断开时长一到就进入半开状态，下一条请求就是试探"""
+        await asyncio.sleep(self._delay)
+        if self.state == OPEN:
+            logger.info("Opencode 已暂停 %.0f 秒，放行一条请求试试", self._delay)
+            self._set_state(HALF_OPEN)
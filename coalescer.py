@@ -0,0 +1,119 @@
+"""
+消息合并模块 - 把同一个人连发的几条消息合成一次 Opencode 调用喵～
+
+每个 chat 最多有一个正在收集的批次。批次入队后、开始处理前收到的消息
+都会并入它；开始处理时再等一个去抖窗口（每来一条新消息重新计时），
+窗口结束或消息数达到上限后批次关闭，之后的消息进入新批次。
+"""
+
+import asyncio
+import time
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+from metrics import MESSAGES_COALESCED
+
+logger = logging.getLogger(__name__)
+
+# 合并后各条消息之间的分隔
+MESSAGE_SEPARATOR = "\n\n"
+
+
+@dataclass
+class Batch:
+    """一批待合并的消息"""
+
+    chat_id: int
+    user_id: int
+    texts: List[str] = field(default_factory=list)
+    update_ids: List[int] = field(default_factory=list)  # 这批消息所属的 update
+    last_added: float = field(default_factory=time.monotonic)
+    closed: bool = False
+    _wakeup: asyncio.Event = field(default_factory=asyncio.Event)
+
+    @property
+    def text(self) -> str:
+        """合并后的消息"""
+        return MESSAGE_SEPARATOR.join(self.texts)
+
+
+class MessageCoalescer:
+    """按 chat 合并连发的消息"""
+
+    def __init__(self, window: float, max_messages: int):
+        """
+        Args:
+            window: 去抖窗口（秒），0 表示只合并排队期间收到的消息
+            max_messages: 一批最多合并的消息数，1 表示不合并
+        """
+        self.window = window
+        self.max_messages = max(1, max_messages)
+        self._open: Dict[int, Batch] = {}
+
+    def can_merge(self, chat_id: int, user_id: int) -> bool:
+        """这条消息能否并入 chat 正在收集的批次（不会产生新的请求）"""
+        batch = self._open.get(chat_id)
+        return batch is not None and batch.user_id == user_id
+
+    def add(self, chat_id: int, user_id: int, text: str, update_id: int) -> Optional[Batch]:
+        """
+        加入 chat 正在收集的批次
+
+        Returns:
+            新建的批次（调用方需要为它入队）；并入已有批次时返回 None
+        """
+        batch = self._open.get(chat_id)
+        if batch is not None and batch.user_id == user_id:
+            batch.texts.append(text)
+            batch.update_ids.append(update_id)
+            batch.last_added = time.monotonic()
+            MESSAGES_COALESCED.inc()
+            if len(batch.texts) >= self.max_messages:
+                self._close(batch)
+            else:
+                batch._wakeup.set()
+            return None
+
+        if batch is not None:
+            # 群聊里换了人说话，之前的批次不再接收消息
+            self._close(batch)
+
+        batch = Batch(chat_id=chat_id, user_id=user_id, texts=[text], update_ids=[update_id])
+        if self.max_messages > 1:
+            self._open[chat_id] = batch
+        else:
+            batch.closed = True
+        return batch
+
+    def close(self, chat_id: int):
+        """chat 有别的任务入队时调用，之后的消息不再并入之前的批次"""
+        batch = self._open.get(chat_id)
+        if batch is not None:
+            self._close(batch)
+
+    def release(self, batch: Batch):
+        """批次的任务结束时调用（包括没等到 collect 就返回或出错），之后的消息进入新批次"""
+        self._close(batch)
+
+    async def collect(self, batch: Batch) -> str:
+        """等去抖窗口结束（或批次满），关闭批次并返回合并后的消息"""
+        while not batch.closed:
+            remaining = batch.last_added + self.window - time.monotonic()
+            if remaining <= 0:
+                break
+            batch._wakeup.clear()
+            try:
+                await asyncio.wait_for(batch._wakeup.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        self._close(batch)
+
+        if len(batch.texts) > 1:
+            logger.info("chat %s 合并了 %s 条消息", batch.chat_id, len(batch.texts))
+        return batch.text
+
+    def _close(self, batch: Batch):
+        batch.closed = True
+        batch._wakeup.set()
+        if self._open.get(batch.chat_id) is batch:
+            del self._open[batch.chat_id]
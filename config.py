@@ -3,6 +3,7 @@
 """
 
 import os
+import tempfile
 from dotenv import load_dotenv
 
 # 加载环境变量
@@ -17,21 +18,156 @@ class Config:
 
     # Opencode CLI 配置
     OPENCODE_CLI = os.getenv("OPENCODE_CLI", "opencode")
+    # 使用 `opencode run --format json`，直接从输出里拿到新 session 的 ID
+    # （STREAM_REPLIES 时不用：JSON 事件流不是逐字输出的，流式回复仍用普通文本）
+    OPENCODE_JSON_OUTPUT = os.getenv("OPENCODE_JSON_OUTPUT", "true").lower() in ("1", "true", "yes")
+
+    # Opencode 后端：cli（每条消息启动一次 CLI）或 server（常驻 opencode serve）
+    OPENCODE_BACKEND = os.getenv("OPENCODE_BACKEND", "cli")
+    # server 后端的本地端口
+    OPENCODE_SERVER_PORT = int(os.getenv("OPENCODE_SERVER_PORT", "4096"))
+    # 外部 server 地址（设置后不启动本地 server 进程）
+    OPENCODE_SERVER_URL = os.getenv("OPENCODE_SERVER_URL", "")
+
+    # 并发配置
+    # 同时运行的 opencode 进程上限（全局）
+    OPENCODE_MAX_PROCESSES = int(os.getenv("OPENCODE_MAX_PROCESSES", "4"))
+    # 同时处理的 update 上限（包括在会话队列里排队的）
+    MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "256"))
+
+    # 准入控制：超出时立即回复“忙”，不再排队
+    # 每个用户每分钟最多发起多少次请求（合并进同一批的消息不算）
+    ADMISSION_USER_RATE_PER_MINUTE = float(os.getenv("ADMISSION_USER_RATE_PER_MINUTE", "20"))
+    ADMISSION_USER_BURST = int(os.getenv("ADMISSION_USER_BURST", "5"))
+    # 单个 chat / 全局最多排队的请求数
+    ADMISSION_MAX_CHAT_QUEUE = int(os.getenv("ADMISSION_MAX_CHAT_QUEUE", "5"))
+    ADMISSION_MAX_QUEUED = int(os.getenv("ADMISSION_MAX_QUEUED", "100"))
+    # 最长排队时间（秒），预计或实际超过时拒绝
+    ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "90"))
+
+    # 连发消息合并：开始处理前再等多久（秒）收集后续消息，0 表示只合并排队期间收到的
+    COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", "0"))
+    # 一次最多合并几条消息，达到后立即处理；1 表示不合并
+    COALESCE_MAX_MESSAGES = int(os.getenv("COALESCE_MAX_MESSAGES", "5"))
 
     # 安全设置 - 只允许特定用户访问
     ALLOWED_USER_ID = os.getenv("ALLOWED_USER_ID")
 
+    # Session 存储后端：sqlite（默认）或 file（旧版纯文本时间段文件）
+    SESSION_STORE = os.getenv("SESSION_STORE", "sqlite")
+    # Session 范围：global（所有人共用）、user（每个用户一个）、chat（每个 chat 一个）；
+    # auto 在白名单只有一个用户时用 global，否则用 user
+    SESSION_SCOPE = os.getenv("SESSION_SCOPE", "auto")
+    # 换新 session 的条件：估算的上下文大小（提示词和回复累计的 token 数）达到
+    # SESSION_TOKEN_BUDGET，或者消息数达到 SESSION_MAX_MESSAGES（先到为准）
+    SESSION_TOKEN_BUDGET = int(os.getenv("SESSION_TOKEN_BUDGET", "60000"))
+    SESSION_MAX_MESSAGES = int(os.getenv("SESSION_MAX_MESSAGES", "50"))
+    # 提前创建 session：时间段结束前 SESSION_PREWARM_LEAD 秒为这个时间段用过的槽位创建下一个
+    # 时间段的 session，session 写满时也马上换好下一个，第一条消息不用等新建 session 和读前言。
+    # 每次只建一个，而且只在 opencode 进程有空闲时建（会多占一个进程，默认关闭）
+    SESSION_PREWARM = os.getenv("SESSION_PREWARM", "false").lower() in ("1", "true", "yes")
+    SESSION_PREWARM_LEAD = float(os.getenv("SESSION_PREWARM_LEAD", "300"))
+
+    # 后台归档
+    # 同时进行的归档任务数
+    ARCHIVE_MAX_CONCURRENCY = int(os.getenv("ARCHIVE_MAX_CONCURRENCY", "1"))
+    # 归档失败后的重试次数
+    ARCHIVE_MAX_RETRIES = int(os.getenv("ARCHIVE_MAX_RETRIES", "3"))
+
+    # 熔断：最近 BREAKER_WINDOW 次调用里失败（出错或超时）比例达到 BREAKER_FAILURE_RATIO
+    # （且至少有 BREAKER_MIN_CALLS 次结果）时暂停调用 Opencode，直接回复降级消息；
+    # BREAKER_OPEN_SECONDS 秒后放行一条请求试探恢复（失败则翻倍再等）
+    BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", "10"))
+    BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "4"))
+    BREAKER_FAILURE_RATIO = float(os.getenv("BREAKER_FAILURE_RATIO", "0.5"))
+    BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "30"))
+
+    # 收件箱：需要回复的消息先记到这里，重启后继续处理没回复完的，按 update_id 去重；
+    # 留空表示只在内存里去重
+    INBOX_FILE = os.getenv(
+        "INBOX_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "inbox.db")
+    )
+    # 重启时超过这么久（秒）的消息不再重新处理，只告诉用户没来得及回复
+    INBOX_RESUME_MAX_AGE = float(os.getenv("INBOX_RESUME_MAX_AGE", "3600"))
+    # 同一条消息最多处理几次（每次都没处理完就进程退出时不再重试）
+    INBOX_MAX_ATTEMPTS = int(os.getenv("INBOX_MAX_ATTEMPTS", "3"))
+
+    # 流式回复：Opencode 边输出边发送
+    STREAM_REPLIES = os.getenv("STREAM_REPLIES", "false").lower() in ("1", "true", "yes")
+    # 新消息优先：同一个 chat 来了新请求时取消正在进行的回复
+    SUPERSEDE_RUNNING = os.getenv("SUPERSEDE_RUNNING", "false").lower() in ("1", "true", "yes")
+
+    # 发送限速（Telegram 的限制：全局约 30 条/秒，单个 chat 约 1 条/秒，群聊约 20 条/分钟）
+    OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "30"))
+    OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "1"))
+    # 单个 chat 允许连续发送的条数（多段回复的前几段不用等）
+    OUTBOX_CHAT_BURST = int(os.getenv("OUTBOX_CHAT_BURST", "3"))
+    OUTBOX_GROUP_RATE_PER_MINUTE = float(os.getenv("OUTBOX_GROUP_RATE_PER_MINUTE", "20"))
+    # 遇到 RetryAfter 或网络错误时最多重试几次
+    OUTBOX_MAX_RETRIES = int(os.getenv("OUTBOX_MAX_RETRIES", "3"))
+
+    # 流式回复时占位消息两次编辑的最短间隔（秒）
+    STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+
+    # 收到的图片缓存（按 file_unique_id），超出大小或长时间没用的文件会被删除
+    MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR") or os.path.join(
+        tempfile.gettempdir(), "chenqianyu-media"
+    )
+    MEDIA_CACHE_MAX_MB = int(os.getenv("MEDIA_CACHE_MAX_MB", "200"))
+    MEDIA_CACHE_MAX_AGE_HOURS = float(os.getenv("MEDIA_CACHE_MAX_AGE_HOURS", "24"))
+
+    # 回复里发送过的图片的 file_id 缓存（同一文件再次发送时不用重新上传）
+    UPLOAD_CACHE_FILE = os.getenv("UPLOAD_CACHE_FILE") or os.path.expanduser(
+        "~/.cache/chenqianyu-bot/uploads.json"
+    )
+    UPLOAD_CACHE_MAX_ENTRIES = int(os.getenv("UPLOAD_CACHE_MAX_ENTRIES", "1000"))
+
     # 服务器配置
+    BOT_HOST = os.getenv("BOT_HOST", "127.0.0.1")
     BOT_PORT = int(os.getenv("BOT_PORT", "3993"))
+    # 在 BOT_PORT 上提供 /metrics 和 /healthz
+    METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+    # 设置后用 webhook 接收 update（本地监听 BOT_PORT 上 URL 的路径），否则用轮询
     WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+    # webhook 请求头 X-Telegram-Bot-Api-Secret-Token 的校验值（可选）
+    WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
 
     # 日志配置
     LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+    # 日志格式：text（带颜色的文本）或 json（每行一个 JSON 对象）
+    LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+    # 日志文件（按大小轮转，manage.sh logs 查看的就是它），留空表示只输出到控制台
+    LOG_FILE = os.getenv(
+        "LOG_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs", "bot.log")
+    )
+    LOG_FILE_MAX_MB = int(os.getenv("LOG_FILE_MAX_MB", "10"))
+    # 保留几个轮转出来的旧文件（bot.log.1 ~ bot.log.N）
+    LOG_FILE_BACKUPS = int(os.getenv("LOG_FILE_BACKUPS", "5"))
+    # 等待写出的日志条数上限，写得太慢堆满时丢弃新的日志而不是卡住 bot
+    LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+    # 追踪：每条 update 各阶段的耗时写成一行 JSON（按大小轮转），留空表示不写
+    TRACE_FILE = os.getenv(
+        "TRACE_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs", "traces.jsonl")
+    )
+    TRACE_FILE_MAX_MB = int(os.getenv("TRACE_FILE_MAX_MB", "10"))
+    # 只写出耗时不少于这么多秒的 update，0 表示全部写出
+    TRACE_SLOW_SECONDS = float(os.getenv("TRACE_SLOW_SECONDS", "0"))
+    # 采样调用栈，保留最慢的 PROFILE_TOP_N 条 update 的调用栈（/debug/slow）
+    PROFILE_ENABLED = os.getenv("PROFILE_ENABLED", "false").lower() in ("1", "true", "yes")
+    PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "50"))
+    PROFILE_TOP_N = int(os.getenv("PROFILE_TOP_N", "10"))
+
+    # 工作目录（sessions/ 和配置文件软链接所在目录，默认是 bot 代码目录）
+    WORKSPACE_DIR = os.getenv("WORKSPACE_DIR", "")
 
     # AGENTS.md 配置目录
     AGENTS_CONFIG_DIR = os.getenv(
         "AGENTS_CONFIG_DIR", os.path.expanduser("~/.config/opencode/")
     )
+    # 记忆检索：每条消息附上 MEMORY.md 和 memory/ 里最相关的几个片段，
+    # agent 不用再通读每日记忆日志；0 表示不检索（让 agent 自己阅读）
+    MEMORY_SNIPPETS = int(os.getenv("MEMORY_SNIPPETS", "5"))
 
     @classmethod
     def validate(cls):
@@ -0,0 +1,57 @@
+"""
+配置文件指纹模块 - 记录 AGENTS_CONFIG_DIR 下配置文件的内容哈希喵～
+
+session 新建时提示词里带完整的前言，让 agent 阅读这些文件；之后只有文件
+内容变了才重新发送前言，其余消息只带一句简短的说明。
+"""
+
+import hashlib
+import logging
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 前言里要求 agent 阅读的配置文件
+# （memory/ 下的每日日志由 agent 自己追加，不参与比较）
+CONTEXT_FILES = ("AGENTS.md", "IDENTITY.md", "SOUL.md", "USER.md", "MEMORY.md")
+
+
+class ContextFiles:
+    """计算配置文件的内容哈希（按 mtime 和大小缓存，文件没变时不重新读取）"""
+
+    def __init__(self, config_dir: str):
+        self.config_dir = Path(config_dir)
+        # 文件名 -> ((mtime_ns, size), 哈希)
+        self._cache: Dict[str, Tuple[Tuple[int, int], str]] = {}
+
+    def hashes(self) -> Dict[str, str]:
+        """所有配置文件的当前哈希（文件不存在时为空字符串）"""
+        return {name: self._hash(name) for name in CONTEXT_FILES}
+
+    def _hash(self, name: str) -> str:
+        path = self.config_dir / name
+        try:
+            stat = path.stat()
+        except OSError:
+            return ""
+
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        cached = self._cache.get(name)
+        if cached and cached[0] == stamp:
+            return cached[1]
+
+        try:
+            digest = hashlib.sha256(path.read_bytes()).hexdigest()
+        except OSError as e:
+            logger.warning("读取配置文件 %s 失败: %s", path, e)
+            return ""
+        self._cache[name] = (stamp, digest)
+        return digest
+
+
+def changed_files(seen: Optional[Dict[str, str]], current: Dict[str, str]) -> List[str]:
+    """与 session 上次看到的哈希相比有变化的文件（从没记录过时视为全部变化）"""
+    if seen is None:
+        return list(current)
+    return [name for name, digest in current.items() if seen.get(name) != digest]
@@ -0,0 +1,209 @@
+"""
+Update 调度模块 - 不同会话并行处理，同一会话严格按顺序喵～
+
+每个 chat 有一条自己的任务队列和一个 worker，队列空了 worker 就退出；
+排队统计继续保留（最多保留 MAX_IDLE_CHATS 个空闲 chat 的，最久没消息的先清掉），
+最近一次排队时间同时导出到 chenqianyu_chat_queue_wait_seconds{chat=...}。
+全局的 opencode 进程数由 opencode_runner 的进程槽位限制。
+任务在单独的 asyncio 任务里执行，可以随时取消（/cancel、新消息优先）。
+"""
+
+import asyncio
+import contextvars
+import time
+import logging
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+from metrics import CHAT_QUEUE_WAIT
+
+logger = logging.getLogger(__name__)
+
+# 排队超过这个时间（秒）就记一条日志
+SLOW_WAIT_SECONDS = 5
+
+# 最多保留多少个 chat 的排队统计（正在处理的 chat 不算在内，总会保留）
+MAX_IDLE_CHATS = 1000
+
+# 排队时间移动平均的平滑系数
+WAIT_EWMA_ALPHA = 0.2
+
+
+@dataclass
+class ChatStats:
+    """单个 chat 的队列统计"""
+
+    queued: int = 0  # 正在排队的任务数
+    running: bool = False  # 是否有任务在执行
+    processed: int = 0  # 已处理的任务数
+    last_wait: float = 0.0  # 最近一次排队时间（秒）
+    max_wait: float = 0.0  # 最长排队时间（秒）
+    total_wait: float = 0.0  # 累计排队时间（秒）
+    recent_wait: float = 0.0  # 排队时间的指数移动平均（秒），反映最近的情况
+
+    @property
+    def avg_wait(self) -> float:
+        """平均排队时间（秒）"""
+        return self.total_wait / self.processed if self.processed else 0.0
+
+
+@dataclass
+class _Job:
+    """队列中的一个任务"""
+
+    func: Callable[[], Awaitable[Any]]
+    future: asyncio.Future
+    enqueued_at: float = field(default_factory=time.monotonic)
+    # 提交时的 context（日志关联 ID 等），任务在它的副本里执行
+    context: contextvars.Context = field(default_factory=contextvars.copy_context)
+    task: Optional[asyncio.Task] = None  # 执行中的任务
+    cancelled: bool = False  # 被 cancel() 取消
+
+
+class ChatDispatcher:
+    """按 chat 串行、跨 chat 并行的任务调度器"""
+
+    def __init__(self):
+        self._queues: Dict[int, Deque[_Job]] = {}
+        self._workers: Dict[int, asyncio.Task] = {}
+        self._running: Dict[int, _Job] = {}
+        # 按最近提交任务的先后排列，超出 MAX_IDLE_CHATS 时先清最久没消息的
+        self._stats: "OrderedDict[int, ChatStats]" = OrderedDict()
+
+    async def submit(self, chat_id: int, func: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        把任务加入 chat 的队列，等待执行完成并返回结果
+
+        入队在第一个 await 之前完成，所以同一 chat 的任务严格按调用顺序执行。
+        任务被 cancel() 取消时返回 None。
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(chat_id, deque()).append(_Job(func, future))
+        self._stats.setdefault(chat_id, ChatStats()).queued += 1
+        self._stats.move_to_end(chat_id)
+
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._run_chat(chat_id))
+
+        return await future
+
+    async def _run_chat(self, chat_id: int):
+        """依次执行某个 chat 队列里的任务"""
+        queue = self._queues[chat_id]
+        stats = self._stats[chat_id]
+
+        try:
+            while queue:
+                job = queue.popleft()
+                stats.queued -= 1
+
+                if job.future.cancelled():
+                    continue
+
+                wait = time.monotonic() - job.enqueued_at
+                stats.last_wait = wait
+                stats.max_wait = max(stats.max_wait, wait)
+                stats.total_wait += wait
+                if stats.processed:
+                    stats.recent_wait += WAIT_EWMA_ALPHA * (wait - stats.recent_wait)
+                else:
+                    stats.recent_wait = wait
+                stats.processed += 1
+                CHAT_QUEUE_WAIT.set(wait, chat=chat_id)
+                if wait > SLOW_WAIT_SECONDS:
+                    logger.info("chat %s 的任务排队了 %.1f 秒", chat_id, wait)
+
+                stats.running = True
+                job.task = job.context.run(asyncio.create_task, job.func())
+                self._running[chat_id] = job
+                try:
+                    result = await job.task
+                except asyncio.CancelledError:
+                    if not job.cancelled:
+                        # worker 自己被取消（关闭 bot），任务也已一起取消
+                        raise
+                    if not job.future.done():
+                        job.future.set_result(None)
+                except Exception as e:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+                else:
+                    if not job.future.done():
+                        job.future.set_result(result)
+                finally:
+                    stats.running = False
+                    del self._running[chat_id]
+        finally:
+            # 被取消时（例如关闭 bot），剩下的任务也一起取消
+            while queue:
+                queue.popleft().future.cancel()
+                stats.queued -= 1
+            del self._queues[chat_id]
+            del self._workers[chat_id]
+            self._trim_stats()
+
+    def _trim_stats(self):
+        """空闲 chat 的统计太多时，清掉最久没消息的那些"""
+        excess = len(self._stats) - len(self._workers) - MAX_IDLE_CHATS
+        if excess <= 0:
+            return
+        idle = [chat_id for chat_id in self._stats if chat_id not in self._workers]
+        for chat_id in idle[:excess]:
+            del self._stats[chat_id]
+            CHAT_QUEUE_WAIT.remove(chat=chat_id)
+
+    def cancel(self, chat_id: int) -> int:
+        """
+        取消 chat 正在执行和排队的任务
+
+        正在执行的任务收到 CancelledError（opencode 进程随之结束），
+        排队的任务直接丢弃；等待它们的 submit() 都返回 None。
+
+        Returns:
+            取消的任务数
+        """
+        cancelled = 0
+        queue = self._queues.get(chat_id)
+        while queue:
+            job = queue.popleft()
+            self._stats[chat_id].queued -= 1
+            if not job.future.done():
+                job.future.set_result(None)
+                cancelled += 1
+
+        job = self._running.get(chat_id)
+        if job is not None and not job.cancelled and not job.task.done():
+            job.cancelled = True
+            job.task.cancel()
+            cancelled += 1
+        return cancelled
+
+    def queue_depth(self, chat_id: int) -> int:
+        """chat 当前排队的任务数（不含正在执行的）"""
+        stats = self._stats.get(chat_id)
+        return stats.queued if stats else 0
+
+    def is_running(self, chat_id: int) -> bool:
+        """chat 是否有任务正在执行"""
+        stats = self._stats.get(chat_id)
+        return stats.running if stats else False
+
+    def total_queued(self) -> int:
+        """所有 chat 排队的任务总数"""
+        return sum(len(queue) for queue in self._queues.values())
+
+    def chat_stats(self, chat_id: int) -> Optional[ChatStats]:
+        """chat 的队列统计（空闲的 chat 也保留，太久没消息的会被清掉）"""
+        return self._stats.get(chat_id)
+
+    def stats(self) -> Dict[int, ChatStats]:
+        """各个 chat 的队列统计"""
+        return dict(self._stats)
+
+    async def shutdown(self):
+        """取消所有 worker"""
+        workers = list(self._workers.values())
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
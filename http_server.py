@@ -0,0 +1,154 @@
+"""
+极简 HTTP 服务模块 - 在 BOT_PORT 上提供 webhook、/metrics、/healthz 等接口喵～
+
+基于 asyncio.start_server，每个连接处理一个请求后关闭，不依赖额外的库。
+"""
+
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+from urllib.parse import urlsplit, parse_qs
+
+logger = logging.getLogger(__name__)
+
+# 请求体大小上限（字节）
+MAX_BODY_SIZE = 1024 * 1024
+
+# 读取请求的超时时间（秒）
+READ_TIMEOUT = 10
+
+STATUS_TEXT = {
+    200: "OK",
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+
+@dataclass
+class Request:
+    """HTTP 请求"""
+
+    method: str
+    path: str
+    query: Dict[str, str] = field(default_factory=dict)
+    headers: Dict[str, str] = field(default_factory=dict)  # 名字都是小写
+    body: bytes = b""
+
+
+@dataclass
+class Response:
+    """HTTP 响应"""
+
+    status: int = 200
+    body: bytes = b""
+    content_type: str = "text/plain; charset=utf-8"
+
+
+Handler = Callable[[Request], Awaitable[Response]]
+
+
+class HttpServer:
+    """按 (method, path) 分发请求的小型 HTTP 服务"""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._routes: Dict[Tuple[str, str], Handler] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    def route(self, method: str, path: str, handler: Handler):
+        """注册路由"""
+        self._routes[(method.upper(), path)] = handler
+
+    @property
+    def has_routes(self) -> bool:
+        """是否注册了路由"""
+        return bool(self._routes)
+
+    def has_route(self, method: str, path: str) -> bool:
+        """是否注册了某个路由"""
+        return (method.upper(), path) in self._routes
+
+    async def start(self):
+        """开始监听"""
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        # 端口为 0 时取实际分配的端口
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info("HTTP 服务已启动: http://%s:%s", self.host, self.port)
+
+    async def stop(self):
+        """停止监听"""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """处理一个连接上的一个请求"""
+        try:
+            request = await asyncio.wait_for(self._read_request(reader), READ_TIMEOUT)
+            if isinstance(request, Response):
+                response = request
+            else:
+                response = await self._dispatch(request)
+            await self._write_response(writer, response)
+        except (asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logger.error("处理 HTTP 请求出错: %s", e)
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader: asyncio.StreamReader):
+        """读取请求；格式不对时直接返回错误响应"""
+        request_line = (await reader.readline()).decode("latin-1").strip()
+        parts = request_line.split()
+        if len(parts) != 3:
+            return Response(400, b"bad request")
+
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1")
+            if line in ("\r\n", "\n", ""):
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        length = int(headers.get("content-length") or 0)
+        if length > MAX_BODY_SIZE:
+            return Response(413, b"payload too large")
+        body = await reader.readexactly(length) if length else b""
+
+        url = urlsplit(parts[1])
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        return Request(method=parts[0].upper(), path=url.path, query=query, headers=headers, body=body)
+
+    async def _dispatch(self, request: Request) -> Response:
+        """找到路由并调用"""
+        handler = self._routes.get((request.method, request.path))
+        if handler is None:
+            if any(path == request.path for _, path in self._routes):
+                return Response(405, b"method not allowed")
+            return Response(404, b"not found")
+        try:
+            return await handler(request)
+        except Exception as e:
+            logger.error("HTTP 接口 %s %s 出错: %s", request.method, request.path, e)
+            return Response(500, b"internal error")
+
+    async def _write_response(self, writer: asyncio.StreamWriter, response: Response):
+        """写回响应"""
+        head = (
+            f"HTTP/1.1 {response.status} {STATUS_TEXT.get(response.status, 'OK')}\r\n"
+            f"Content-Type: {response.content_type}\r\n"
+            f"Content-Length: {len(response.body)}\r\n"
+            "Connection: close\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + response.body)
+        await writer.drain()
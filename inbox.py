@@ -0,0 +1,197 @@
+"""
+收件箱模块 - 重启不丢消息，也不重复回复喵～
+
+需要回复的 update（文字和图片消息）开始处理前先写进 SQLite，处理完（包括出错
+已经回复、被 /cancel 取消）再标记完成。进程被重启或崩溃时没处理完的 update
+留在库里，下次启动时重新放回队列；按 update_id 去重，Telegram 重发的 update
+和重新放回的 update 只处理一次。
+
+状态：
+- pending：已收到，还没处理完
+- done：处理完了
+- expired：重启时已经过去太久，没有重新处理
+- failed：重试了几次都没处理完（可能每次都让进程崩溃），不再重试
+"""
+
+import json
+import time
+import sqlite3
+import logging
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+from metrics import INBOX_EVENTS
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+DONE = "done"
+EXPIRED = "expired"
+FAILED = "failed"
+
+# 处理完的 update 保留多久（秒），用来识别 Telegram 重发的 update
+KEEP_FINISHED_SECONDS = 24 * 3600
+
+# 每收到这么多条新 update 清理一次过期的记录
+CLEANUP_EVERY = 1000
+
+
+@dataclass
+class PendingUpdate:
+    """上次没处理完的 update"""
+
+    update_id: int
+    payload: Dict[str, Any]  # Update.to_dict()
+    attempts: int  # 已经开始处理过几次
+    received_at: float
+
+
+class Inbox:
+    """按 update_id 记录处理状态的收件箱"""
+
+    def __init__(self, db_path: str, max_attempts: int):
+        """
+        Args:
+            db_path: 数据库文件路径，空字符串表示只放在内存里（只去重，重启后不恢复）
+            max_attempts: 同一条 update 最多开始处理几次
+        """
+        if db_path:
+            Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(db_path or ":memory:")
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_tables()
+        self.max_attempts = max(1, max_attempts)
+
+        self._active: Set[int] = set()  # 本进程正在处理的
+        self._deferred: Set[int] = set()  # 由别的 update 负责回复的（并入批次的消息）
+        self._inserted = 0
+
+    def _create_tables(self):
+        """建表"""
+        with self._conn:
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS updates (
+                    update_id INTEGER PRIMARY KEY,
+                    chat_id INTEGER,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    received_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )"""
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_updates_status ON updates (status, update_id)"
+            )
+
+    def begin(self, update_id: int, chat_id: Optional[int], payload: Dict[str, Any]) -> bool:
+        """
+        开始处理一条 update（第一次收到时先记下来）
+
+        Returns:
+            False 表示不用处理：已经处理过、正在处理或者重试次数用完了
+        """
+        if update_id in self._active:
+            INBOX_EVENTS.inc(event="duplicate")
+            return False
+
+        row = self._conn.execute(
+            "SELECT status, attempts FROM updates WHERE update_id = ?", (update_id,)
+        ).fetchone()
+        now = time.time()
+        if row is None:
+            with self._conn:
+                self._conn.execute(
+                    "INSERT INTO updates (update_id, chat_id, payload, status, attempts, "
+                    "received_at, updated_at) VALUES (?, ?, ?, ?, 1, ?, ?)",
+                    (update_id, chat_id, json.dumps(payload, ensure_ascii=False), PENDING, now, now),
+                )
+            self._inserted += 1
+            if self._inserted % CLEANUP_EVERY == 0:
+                self.cleanup()
+        elif row[0] != PENDING:
+            INBOX_EVENTS.inc(event="duplicate")
+            return False
+        elif row[1] >= self.max_attempts:
+            logger.warning("update %s 已经处理了 %s 次都没完成，不再重试", update_id, row[1])
+            self._set_status([update_id], FAILED)
+            INBOX_EVENTS.inc(event="failed")
+            return False
+        else:
+            with self._conn:
+                self._conn.execute(
+                    "UPDATE updates SET attempts = attempts + 1, updated_at = ? WHERE update_id = ?",
+                    (now, update_id),
+                )
+
+        self._active.add(update_id)
+        return True
+
+    def defer(self, update_id: int):
+        """这条 update 由别的 update 负责回复（并入了批次），它自己的处理函数返回时还不算完成"""
+        self._deferred.add(update_id)
+
+    def settle(self, update_id: int):
+        """处理函数正常返回时调用：没有 defer 的 update 标记完成"""
+        if update_id in self._deferred:
+            self._deferred.discard(update_id)
+            return
+        self.finish(update_id)
+
+    def finish(self, *update_ids: int):
+        """标记处理完成"""
+        ids = [uid for uid in update_ids if uid in self._active]
+        if ids:
+            self._set_status(ids, DONE)
+
+    def release(self, update_id: int):
+        """处理被中断（关闭 bot）：保持未完成，下次启动继续"""
+        self._active.discard(update_id)
+        self._deferred.discard(update_id)
+
+    def unfinished(self) -> List[PendingUpdate]:
+        """上次没处理完的 update（按 update_id 排序，不含本进程正在处理的）"""
+        rows = self._conn.execute(
+            "SELECT update_id, payload, attempts, received_at FROM updates "
+            "WHERE status = ? ORDER BY update_id",
+            (PENDING,),
+        ).fetchall()
+        return [
+            PendingUpdate(update_id=row[0], payload=json.loads(row[1]), attempts=row[2], received_at=row[3])
+            for row in rows
+            if row[0] not in self._active
+        ]
+
+    def give_up(self, update_id: int, status: str):
+        """不再处理这条上次没处理完的 update（expired / failed）"""
+        self._set_status([update_id], status)
+        INBOX_EVENTS.inc(event=status)
+
+    def active_count(self) -> int:
+        """正在处理的 update 数"""
+        return len(self._active)
+
+    def cleanup(self):
+        """删除处理完很久的记录"""
+        with self._conn:
+            cursor = self._conn.execute(
+                "DELETE FROM updates WHERE status != ? AND updated_at < ?",
+                (PENDING, time.time() - KEEP_FINISHED_SECONDS),
+            )
+        if cursor.rowcount:
+            logger.debug("收件箱清理了 %s 条旧记录", cursor.rowcount)
+
+    def close(self):
+        self._conn.close()
+
+    def _set_status(self, update_ids: List[int], status: str):
+        now = time.time()
+        with self._conn:
+            self._conn.executemany(
+                "UPDATE updates SET status = ?, updated_at = ? WHERE update_id = ?",
+                [(status, now, uid) for uid in update_ids],
+            )
+        for uid in update_ids:
+            self._active.discard(uid)
+            self._deferred.discard(uid)
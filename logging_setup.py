@@ -0,0 +1,195 @@
+"""
+日志模块 - 写日志不能卡住事件循环喵～
+
+所有日志记录先放进内存队列，由单独的线程格式化并写到控制台和日志文件，
+事件循环里只做一次入队。队列满了（磁盘或终端太慢）就丢掉新的记录并计数，
+不会阻塞。
+
+输出格式：
+- text：带颜色的单行文本（和以前一样）
+- json：每行一个 JSON 对象，方便用 jq 或日志系统检索
+
+每条 Telegram update 有一个关联 ID（update_id），处理这条 update 期间
+打出的日志都带着它，并发处理多条消息时也能把日志对上。
+"""
+
+import sys
+import json
+import queue
+import atexit
+import logging
+import contextvars
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from pathlib import Path
+from typing import Optional
+from config import Config
+from metrics import LOGS_DROPPED
+
+# 当前正在处理的 update 的关联 ID
+correlation_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "correlation_id", default=None
+)
+
+
+class ColoredFormatter(logging.Formatter):
+    """带颜色的日志格式化器"""
+
+    COLORS = {
+        "DEBUG": "\033[36m",  # 青色
+        "INFO": "\033[32m",  # 绿色
+        "WARNING": "\033[33m",  # 黄色
+        "ERROR": "\033[31m",  # 红色
+        "CRITICAL": "\033[35m",  # 紫色
+    }
+    RESET = "\033[0m"
+
+    def __init__(self, colored: bool = True, datefmt: str = "%H:%M:%S"):
+        super().__init__(datefmt=datefmt)
+        self.colored = colored
+
+    def format(self, record: logging.LogRecord) -> str:
+        levelname = record.levelname
+        if self.colored and levelname in self.COLORS:
+            levelname = f"{self.COLORS[levelname]}{levelname}{self.RESET}"
+
+        line = f"{self.formatTime(record, self.datefmt)} {levelname} [{_short_name(record.name)}]"
+        cid = getattr(record, "correlation_id", None)
+        if cid:
+            line += f" <{cid}>"
+        line += f" {record.getMessage()}"
+
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """每条记录一行 JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        cid = getattr(record, "correlation_id", None)
+        if cid:
+            entry["correlation_id"] = cid
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class AsyncQueueHandler(QueueHandler):
+    """
+    只负责入队的日志处理器
+
+    不在调用方格式化消息（留给写日志的线程），只记下关联 ID；
+    队列满时直接丢弃，不阻塞调用方。
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.correlation_id = correlation_id.get()
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOGS_DROPPED.inc()
+
+
+class _Listener(QueueListener):
+    """写日志的线程"""
+
+    def enqueue_sentinel(self):
+        # 停止时队列可能是满的：等它腾出位置，保证剩下的日志都写出去
+        self.queue.put(self._sentinel)
+
+
+def setup_logging() -> QueueListener:
+    """
+    按配置初始化日志：根日志器只挂一个入队处理器，控制台和文件由后台线程写
+
+    Returns:
+        写日志的线程（退出时自动停止并写完剩下的记录）
+    """
+    level = getattr(logging, Config.LOG_LEVEL.upper(), logging.INFO)
+    use_json = Config.LOG_FORMAT.lower() == "json"
+
+    console_handler = logging.StreamHandler()
+    if use_json:
+        console_handler.setFormatter(JsonFormatter())
+    else:
+        console_handler.setFormatter(ColoredFormatter(colored=sys.stderr.isatty()))
+    handlers = [console_handler]
+
+    if Config.LOG_FILE:
+        log_file = Path(Config.LOG_FILE)
+        log_file.parent.mkdir(parents=True, exist_ok=True)
+        file_handler = RotatingFileHandler(
+            log_file,
+            maxBytes=Config.LOG_FILE_MAX_MB * 1024 * 1024,
+            backupCount=Config.LOG_FILE_BACKUPS,
+            encoding="utf-8",
+        )
+        file_handler.setFormatter(
+            JsonFormatter() if use_json else ColoredFormatter(colored=False, datefmt="%Y-%m-%d %H:%M:%S")
+        )
+        handlers.append(file_handler)
+
+    log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(maxsize=Config.LOG_QUEUE_SIZE)
+    listener = _Listener(log_queue, *handlers)
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(level)
+    root_logger.handlers = []  # 清除默认处理器
+    root_logger.addHandler(AsyncQueueHandler(log_queue))
+
+    # 抑制第三方库的冗余日志
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("httpcore").setLevel(logging.WARNING)
+    logging.getLogger("telegram").setLevel(logging.INFO)
+
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def setup_file_log(name: str, path: str, max_mb: int, backups: int) -> logging.Logger:
+    """
+    单独的日志文件：每条消息原样写一行（例如 trace），同样由后台线程写出
+
+    Returns:
+        往这个文件写的日志器（不会传到根日志器）
+    """
+    log_file = Path(path)
+    log_file.parent.mkdir(parents=True, exist_ok=True)
+    file_handler = RotatingFileHandler(
+        log_file, maxBytes=max_mb * 1024 * 1024, backupCount=backups, encoding="utf-8"
+    )
+    file_handler.setFormatter(logging.Formatter("%(message)s"))
+
+    log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(maxsize=Config.LOG_QUEUE_SIZE)
+    listener = _Listener(log_queue, file_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    file_logger = logging.getLogger(name)
+    file_logger.setLevel(logging.INFO)
+    file_logger.propagate = False
+    file_logger.handlers = [AsyncQueueHandler(log_queue)]
+    return file_logger
+
+
+def _short_name(name: str) -> str:
+    """简化 logger 名称"""
+    if name.startswith("telegram"):
+        return "TG"
+    if name.startswith("httpx"):
+        return "HTTP"
+    if len(name) > 15:
+        return name[:12] + "..."
+    return name
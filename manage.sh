@@ -70,7 +70,10 @@ check_status() {
 
 show_logs() {
     echo "📝 查看日志 (按 Ctrl+C 退出)..."
-    if [ -f "$BOT_DIR/logs/bot.out.log" ]; then
+    # bot.log 是 bot 自己写的轮转日志；bot.out.log 是旧版本的标准输出
+    if [ -f "$BOT_DIR/logs/bot.log" ]; then
+        tail -F "$BOT_DIR/logs/bot.log"
+    elif [ -f "$BOT_DIR/logs/bot.out.log" ]; then
         tail -f "$BOT_DIR/logs/bot.out.log"
     else
         echo "暂无日志文件喵～"
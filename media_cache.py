@@ -0,0 +1,191 @@
+"""
+收到的图片缓存模块 - 按 Telegram 的 file_unique_id 缓存下载的文件喵～
+
+同一张图片被再次转发时直接用缓存，不再下载；下载通过 PTB 的 File 接口
+（沿用 bot 的请求设置，本地模式的 Bot API server 也能用），先写到临时文件再改名。
+同一个文件同时只下载一次。缓存总大小和文件年龄有上限，超出时按最近使用时间（LRU）淘汰。
+"""
+
+import os
+import re
+import time
+import asyncio
+import logging
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Optional
+from telegram import File
+from metrics import timed, MEDIA_CACHE_LOOKUPS
+
+logger = logging.getLogger(__name__)
+
+# 旧版直接下载到临时目录的文件
+LEGACY_FILE_PATTERN = re.compile(r"^telegram_photo_\d+_.+\.jpg$")
+
+# 下载中的临时文件后缀
+PARTIAL_SUFFIX = ".part"
+
+# 下载一个文件的超时时间（秒）
+DOWNLOAD_TIMEOUT = 60
+
+
+class _FileLock:
+    """一个文件的锁，记录有几个调用方在用（没人用了才能删掉）"""
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+class MediaCache:
+    """按 file_unique_id 寻址的本地文件缓存"""
+
+    def __init__(self, cache_dir: str, max_bytes: int, max_age: float):
+        """
+        Args:
+            cache_dir: 缓存目录
+            max_bytes: 缓存总大小上限（字节）
+            max_age: 文件最长保留时间（秒），从最近一次使用算起
+        """
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+        # 文件名 -> 大小，按最近使用时间从旧到新排列
+        self._index: "OrderedDict[str, int]" = OrderedDict()
+        self._total = 0
+        self._locks: Dict[str, _FileLock] = {}
+
+    def cleanup(self) -> int:
+        """
+        启动时清理：删除没下载完的文件和旧版临时文件，重建索引并淘汰超额的文件
+
+        Returns:
+            删除的文件数
+        """
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        removed = 0
+
+        legacy_dir = Path(tempfile.gettempdir())
+        for path in legacy_dir.glob("telegram_photo_*.jpg"):
+            if LEGACY_FILE_PATTERN.match(path.name) and _unlink(path):
+                removed += 1
+
+        entries = []
+        for path in self.cache_dir.iterdir():
+            if not path.is_file():
+                continue
+            if path.name.endswith(PARTIAL_SUFFIX):
+                removed += _unlink(path)
+                continue
+            stat = path.stat()
+            entries.append((stat.st_mtime, path.name, stat.st_size))
+
+        self._index.clear()
+        self._total = 0
+        for _, name, size in sorted(entries):
+            self._index[name] = size
+            self._total += size
+
+        removed += self.evict()
+        if removed:
+            logger.info("图片缓存清理了 %s 个文件", removed)
+        return removed
+
+    async def fetch(self, file_unique_id: str, get_file: Callable[[], Awaitable[File]]) -> Path:
+        """
+        取得图片的本地路径，缓存里没有时下载
+
+        Args:
+            file_unique_id: Telegram 的 file_unique_id（同一文件在所有 bot 中都相同）
+            get_file: 返回 telegram.File 的协程函数（调用 getFile），命中缓存时不调用
+        """
+        name = _file_name(file_unique_id)
+        entry = self._locks.get(name)
+        if entry is None:
+            entry = self._locks[name] = _FileLock()
+        entry.users += 1
+        try:
+            async with entry.lock:
+                path = self.cache_dir / name
+                if name in self._index and path.exists():
+                    MEDIA_CACHE_LOOKUPS.inc(result="hit")
+                    self._touch(name, path)
+                    return path
+
+                MEDIA_CACHE_LOOKUPS.inc(result="miss")
+                with timed("media_download"):
+                    size = await self._download(await get_file(), path)
+                self._index[name] = size
+                self._total += size
+        finally:
+            # 还有别的调用方在等这把锁时不能删，否则新来的会拿到另一把锁，同时下载同一个文件
+            entry.users -= 1
+            if entry.users == 0:
+                del self._locks[name]
+
+        self.evict(keep=name)
+        return path
+
+    def evict(self, keep: Optional[str] = None) -> int:
+        """
+        淘汰过期的文件，再按 LRU 淘汰到总大小不超过上限
+
+        Args:
+            keep: 不淘汰的文件名（刚取出来要用的那个）
+
+        Returns:
+            删除的文件数
+        """
+        removed = 0
+        deadline = time.time() - self.max_age
+        for name in list(self._index):
+            if name == keep:
+                continue
+            path = self.cache_dir / name
+            try:
+                expired = path.stat().st_mtime < deadline
+            except OSError:
+                expired = True
+            over_budget = self._total > self.max_bytes
+            if not expired and not over_budget:
+                # 索引按使用时间排序，后面的都更新
+                break
+            self._total -= self._index.pop(name)
+            removed += _unlink(path)
+        return removed
+
+    def _touch(self, name: str, path: Path):
+        """标记为最近使用"""
+        self._index.move_to_end(name)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    async def _download(self, file: File, path: Path) -> int:
+        """下载到临时文件，完成后改名；返回文件大小"""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        partial = path.with_name(path.name + PARTIAL_SUFFIX)
+        try:
+            await file.download_to_drive(partial, read_timeout=DOWNLOAD_TIMEOUT)
+            size = partial.stat().st_size
+            os.replace(partial, path)
+        except BaseException:
+            _unlink(partial)
+            raise
+        return size
+
+
+def _file_name(file_unique_id: str) -> str:
+    """缓存文件名（file_unique_id 里只保留安全字符）"""
+    return re.sub(r"[^A-Za-z0-9_-]", "_", file_unique_id) + ".jpg"
+
+
+def _unlink(path: Path) -> bool:
+    try:
+        path.unlink()
+        return True
+    except OSError:
+        return False
@@ -0,0 +1,201 @@
+"""
+记忆检索模块 - 只把和消息相关的记忆片段带给 agent，不用每次通读全部日志喵～
+
+对 AGENTS_CONFIG_DIR 下的 MEMORY.md 和 memory/*.md 建一个本地全文索引（BM25），
+文件按段落切成片段。中文按单字和相邻两字（bigram）切词，英文和数字按单词切词。
+按 mtime 和大小判断文件有没有变化，每次检索前只重新索引变化了的文件。
+"""
+
+import re
+import math
+import logging
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# BM25 参数
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# 每个片段大约多少字（按段落切分，相邻的短段落合并）
+CHUNK_CHARS = 500
+
+# 分数低于最高分的这个比例的片段不要（只沾了一两个常见词的）
+MIN_SCORE_RATIO = 0.3
+
+# 英文单词 / 连续的中文
+TOKEN_PATTERN = re.compile(r"[a-z0-9_]+|[\u3400-\u9fff\uf900-\ufaff]+")
+
+
+@dataclass
+class Snippet:
+    """一个检索到的记忆片段"""
+
+    source: str  # 相对 AGENTS_CONFIG_DIR 的路径，例如 memory/2025-02-05.md
+    text: str
+    score: float
+
+
+@dataclass
+class _Chunk:
+    source: str
+    text: str
+    length: int  # 词数
+
+
+def tokenize(text: str) -> List[str]:
+    """切词：中文取单字和相邻两字；英文和数字取单词（至少两个字符）"""
+    tokens: List[str] = []
+    for match in TOKEN_PATTERN.finditer(text.lower()):
+        word = match.group()
+        if word.isascii():
+            if len(word) > 1:
+                tokens.append(word)
+        else:
+            tokens.extend(word)
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return tokens
+
+
+def split_chunks(text: str) -> List[str]:
+    """按空行切成段落，相邻的短段落合并到 CHUNK_CHARS 左右，超长的段落切开"""
+    chunks: List[str] = []
+    current = ""
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        # 标题开始新的片段
+        if current and (paragraph.startswith("#") or len(current) + len(paragraph) > CHUNK_CHARS):
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+        while len(current) > CHUNK_CHARS * 2:
+            chunks.append(current[:CHUNK_CHARS])
+            current = current[CHUNK_CHARS:]
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class MemoryIndex:
+    """memory/ 和 MEMORY.md 的 BM25 索引"""
+
+    def __init__(self, config_dir: str):
+        self.config_dir = Path(config_dir)
+        self._chunks: Dict[int, _Chunk] = {}
+        self._postings: Dict[str, Dict[int, int]] = {}  # 词 -> {片段: 词频}
+        self._files: Dict[str, Tuple[Tuple[int, int], List[int]]] = {}  # 文件 -> (mtime_ns, size), 片段
+        self._total_length = 0
+        self._next_id = 0
+
+    def refresh(self) -> int:
+        """
+        重新索引新增和变化了的文件，移除已删除的文件
+
+        Returns:
+            重新索引的文件数
+        """
+        current: Dict[str, Path] = {}
+        memory_file = self.config_dir / "MEMORY.md"
+        if memory_file.is_file():
+            current["MEMORY.md"] = memory_file
+        memory_dir = self.config_dir / "memory"
+        if memory_dir.is_dir():
+            for path in memory_dir.glob("*.md"):
+                current[f"memory/{path.name}"] = path
+
+        for source in [s for s in self._files if s not in current]:
+            self._remove(source)
+
+        indexed = 0
+        for source, path in current.items():
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            stamp = (stat.st_mtime_ns, stat.st_size)
+            cached = self._files.get(source)
+            if cached and cached[0] == stamp:
+                continue
+            try:
+                text = path.read_text(encoding="utf-8", errors="replace")
+            except OSError as e:
+                logger.warning("读取记忆文件 %s 失败: %s", path, e)
+                continue
+            self._remove(source)
+            self._add(source, stamp, text)
+            indexed += 1
+
+        if indexed:
+            logger.debug("记忆索引更新了 %s 个文件，共 %s 个片段", indexed, len(self._chunks))
+        return indexed
+
+    def search(self, query: str, k: int) -> List[Snippet]:
+        """检索和 query 最相关的 k 个片段（按相关度从高到低）"""
+        terms = set(tokenize(query))
+        if not terms or not self._chunks or k <= 0:
+            return []
+
+        n = len(self._chunks)
+        avg_length = self._total_length / n or 1
+        scores: Dict[int, float] = {}
+        for term in terms:
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for chunk_id, tf in postings.items():
+                length = self._chunks[chunk_id].length
+                norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (BM25_K1 + 1) / norm
+
+        if not scores:
+            return []
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        floor = ranked[0][1] * MIN_SCORE_RATIO
+        results: List[Snippet] = []
+        seen = set()
+        for chunk_id, score in ranked:
+            if score < floor or len(results) >= k:
+                break
+            chunk = self._chunks[chunk_id]
+            # 不同日期里记了一模一样的内容时只要一份
+            if chunk.text in seen:
+                continue
+            seen.add(chunk.text)
+            results.append(Snippet(source=chunk.source, text=chunk.text, score=score))
+        return results
+
+    def _add(self, source: str, stamp: Tuple[int, int], text: str):
+        ids = []
+        for chunk_text in split_chunks(text):
+            tokens = tokenize(chunk_text)
+            if not tokens:
+                continue
+            chunk_id = self._next_id
+            self._next_id += 1
+            self._chunks[chunk_id] = _Chunk(source=source, text=chunk_text, length=len(tokens))
+            self._total_length += len(tokens)
+            for term, tf in Counter(tokens).items():
+                self._postings.setdefault(term, {})[chunk_id] = tf
+            ids.append(chunk_id)
+        self._files[source] = (stamp, ids)
+
+    def _remove(self, source: str):
+        cached = self._files.pop(source, None)
+        if cached is None:
+            return
+        for chunk_id in cached[1]:
+            chunk = self._chunks.pop(chunk_id)
+            self._total_length -= chunk.length
+            for term in set(tokenize(chunk.text)):
+                postings = self._postings.get(term)
+                if postings is None:
+                    continue
+                postings.pop(chunk_id, None)
+                if not postings:
+                    del self._postings[term]
@@ -3,24 +3,86 @@
 """
 
 import os
-import subprocess
+import asyncio
 import logging
-from typing import Optional
+import contextvars
+from collections import OrderedDict
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
+import httpx
 from config import Config
-from session_manager import SessionManager
+from session_manager import SessionManager, IMAGE_TOKENS, estimate_tokens, next_period_start
+from opencode_runner import (
+    run_command,
+    stream_command,
+    OutputParser,
+    OpencodeTimeout,
+    CommandFailed,
+    RunTracker,
+    track_runs,
+    process_stats,
+)
+from opencode_server import OpencodeServer, ServerBackend
+from context_files import ContextFiles, changed_files
+from memory_index import MemoryIndex
+from circuit_breaker import CircuitBreaker, CLOSED
+from metrics import SESSION_PREWARMS, timed
 
 logger = logging.getLogger(__name__)
 
+# 单次 opencode 调用的超时时间（秒）
+OPENCODE_TIMEOUT = 120
+
+# 熔断期间的回复
+DEGRADED_REPLY = "我这边的 AI 暂时出了点问题喵～正在自动恢复，请过一会儿再来找我吧！🐼"
+
+# 提前创建 session 时代替用户消息发送的内容
+PREWARM_MESSAGE = "（这是提前创建的会话，还没有真正的消息：请先阅读上面的文件，然后只回复“好的”。）"
+
+# 每个时间段最多为几个最近用过的槽位提前创建下一个时间段的 session
+PREWARM_MAX_SLOTS = 4
+
 
 class MessageHandler:
     """处理 Telegram 消息并调用 Opencode CLI"""
 
     def __init__(self):
         self.opencode_cli = Config.OPENCODE_CLI
-        self.workspace_dir = os.path.dirname(os.path.abspath(__file__))
+        self.workspace_dir = Config.WORKSPACE_DIR or os.path.dirname(os.path.abspath(__file__))
         self.session_manager = SessionManager(self.workspace_dir)
-
-    def process_message(self, user_id: int, username: str, message_text: str, image_path: str = None) -> str:
+        self.context_files = ContextFiles(Config.AGENTS_CONFIG_DIR)
+        # 每条消息附上最相关的记忆片段，agent 不用通读每日记忆日志
+        self.memory_index = MemoryIndex(Config.AGENTS_CONFIG_DIR) if Config.MEMORY_SNIPPETS > 0 else None
+
+        # 常驻 server 后端（可选），不健康时自动改用 CLI
+        self.server_backend: Optional[ServerBackend] = None
+        if Config.OPENCODE_BACKEND == "server":
+            server = OpencodeServer(base_url=Config.OPENCODE_SERVER_URL or None)
+            self.server_backend = ServerBackend(server, timeout=OPENCODE_TIMEOUT)
+
+        # 熔断：Opencode 连续出错或超时时直接回复降级消息
+        self.breaker = CircuitBreaker(
+            window=Config.BREAKER_WINDOW,
+            min_calls=Config.BREAKER_MIN_CALLS,
+            failure_ratio=Config.BREAKER_FAILURE_RATIO,
+            open_seconds=Config.BREAKER_OPEN_SECONDS,
+        )
+
+        # 这个时间段用过的槽位（槽位 -> (user_id, chat_id)），时间段结束前为它们提前创建 session
+        self._recent_slots: "OrderedDict[str, Tuple[Optional[int], Optional[int]]]" = OrderedDict()
+        self._prewarm_loop_task: Optional[asyncio.Task] = None
+        self._prewarm_tasks: Set[asyncio.Task] = set()
+        # 同一时间只提前创建一个 session，最多占用一个 opencode 进程
+        self._prewarm_lock = asyncio.Lock()
+
+    async def process_message(
+        self,
+        user_id: int,
+        username: str,
+        message_text: str,
+        image_path: str = None,
+        chat_id: Optional[int] = None,
+    ) -> str:
         """
         处理用户消息并返回 AI 回复
 
@@ -29,56 +91,470 @@ class MessageHandler:
             username: Telegram 用户名
             message_text: 用户发送的消息
             image_path: 用户发送的图片路径（可选）
+            chat_id: 消息所在的 chat（SESSION_SCOPE=chat 时用来区分 session）
 
         Returns:
             AI 的回复文本
         """
-        try:
-            # 准备 session（处理归档等前置操作）
-            session_id, is_new = self.session_manager.prepare_for_message()
-
-            # 构建发送给 Opencode 的提示词
-            prompt = self._build_prompt(message_text, image_path)
-
-            if is_new or session_id is None:
-                # 新建 session，使用 --title
-                response = self._call_opencode_new_session(prompt)
+        if not self.breaker.allow():
+            return DEGRADED_REPLY
+
+        # 同一个 session 槽位的消息依次处理，不同槽位互不影响
+        title = self.session_manager.session_key(user_id, chat_id)
+        self._remember_slot(title, user_id, chat_id)
+        async with self.session_manager.lock(title):
+            return await self._process(title, message_text, image_path)
+
+    async def _process(self, title: str, message_text: str, image_path: str = None) -> str:
+        """在 session 槽位的锁内处理一条消息"""
+        session_id, is_new = None, True
+        tokens = 0  # 这一轮估算的 token 数
+        with track_runs() as run:
+            try:
+                # 准备 session（处理归档等前置操作）
+                with timed("session_prepare"):
+                    session_id, is_new = await self.session_manager.prepare_for_message(title)
+
+                # 构建发送给 Opencode 的提示词
+                with timed("prompt_build"):
+                    prompt, context = self._prepare_prompt(session_id, is_new, message_text, image_path)
+                tokens = self._prompt_tokens(prompt, image_path)
+
+                response, run_session_id = await self._ask(session_id, is_new, prompt, title)
 
                 if response:
-                    # 获取新 session_id 并记录
-                    new_session_id = self.session_manager.get_latest_session_id()
-                    if new_session_id:
-                        self.session_manager.record_new_session(new_session_id)
-                        logger.info(f"新建 session: {new_session_id}")
+                    tokens += estimate_tokens(response)
+                    await self._after_reply(session_id, is_new, title, run_session_id, context, tokens)
                     return response
-            else:
-                # 继续现有 session
-                response = self._call_opencode_with_session(session_id, prompt)
 
-                if response:
-                    # 增加计数
-                    info = self.session_manager.get_session_info()
-                    self.session_manager.increment_count(session_id, info.count)
-                    return response
+                return "抱歉，我暂时无法处理这条消息喵～请稍后再试！🐼"
+
+            except asyncio.CancelledError:
+                await self._record_cancelled(run, session_id, is_new, title, tokens=tokens)
+                raise
+            except Exception as e:
+                logger.error("处理消息时出错: %s", e)
+                return f"哎呀，出错了喵～ ({str(e)}) 🐼"
+
+    async def stream_message(
+        self,
+        user_id: int,
+        username: str,
+        message_text: str,
+        image_path: str = None,
+        chat_id: Optional[int] = None,
+    ) -> AsyncIterator[str]:
+        """
+        处理用户消息，边生成边产出 AI 回复片段
+
+        参数同 process_message；出错时产出一段错误提示而不是抛出异常。
+        """
+        if not self.breaker.allow():
+            yield DEGRADED_REPLY
+            return
+
+        title = self.session_manager.session_key(user_id, chat_id)
+        self._remember_slot(title, user_id, chat_id)
+        async with self.session_manager.lock(title):
+            stream = self._stream(title, message_text, image_path)
+            try:
+                async for chunk in stream:
+                    yield chunk
+            finally:
+                # 调用方提前结束（例如被取消）时立刻关闭，结束 opencode 进程并释放锁
+                await stream.aclose()
+
+    async def _stream(self, title: str, message_text: str, image_path: str = None) -> AsyncIterator[str]:
+        """在 session 槽位的锁内流式处理一条消息"""
+        session_id, is_new = None, True
+        tokens = 0  # 这一轮估算的 token 数
+        # 流式回复用普通文本输出：JSON 事件流要等一整段文本写完才会输出，就没有边生成边显示了；
+        # 新 session 的 ID 回复完再去 session list 里找
+        parser = OutputParser(False)
+        with track_runs() as run:
+            try:
+                with timed("session_prepare"):
+                    session_id, is_new = await self.session_manager.prepare_for_message(title)
+                with timed("prompt_build"):
+                    prompt, context = self._prepare_prompt(session_id, is_new, message_text, image_path)
+                tokens = self._prompt_tokens(prompt, image_path)
+
+                if self.server_backend and self.server_backend.available:
+                    # server 后端没有流式输出，一次性产出完整回复
+                    response, run_session_id = await self._ask(session_id, is_new, prompt, title)
+                    if response:
+                        tokens += estimate_tokens(response)
+                        await self._after_reply(session_id, is_new, title, run_session_id, context, tokens)
+                        yield response
+                    else:
+                        yield "抱歉，我暂时无法处理这条消息喵～请稍后再试！🐼"
+                    return
+
+                if is_new or session_id is None:
+                    cmd = self._new_session_cmd(prompt, title, json_output=False)
+                else:
+                    cmd = self._session_cmd(session_id, prompt, json_output=False)
+
+                length = 0
+                lines = stream_command(cmd, timeout=OPENCODE_TIMEOUT)
+                try:
+                    async for raw in lines:
+                        chunk = parser.feed(raw)
+                        if chunk:
+                            length += len(chunk)
+                            tokens += estimate_tokens(chunk)
+                            yield chunk
+                    chunk = parser.finish()
+                    if chunk:
+                        length += len(chunk)
+                        tokens += estimate_tokens(chunk)
+                        yield chunk
+                except OpencodeTimeout:
+                    logger.error("Opencode CLI 调用超时")
+                    self.breaker.record_failure("timeout")
+                    yield "\n\n\n思考太久啦，请稍后再试喵～🐼"
+                    return
+                except FileNotFoundError:
+                    logger.error("找不到 Opencode CLI: %s", self.opencode_cli)
+                    self.breaker.record_failure("not_found")
+                    yield self._fallback_response()
+                    return
+                except CommandFailed as e:
+                    logger.error("Opencode CLI 错误: %s", e.stderr or "未知错误")
+                    self.breaker.record_failure("error")
+                    if not length:
+                        yield "抱歉，我暂时无法处理这条消息喵～请稍后再试！🐼"
+                    return
+                finally:
+                    await lines.aclose()
+
+                logger.info("Opencode 回复长度: %s 字符", length)
+                self.breaker.record_success()
+                if length:
+                    await self._after_reply(session_id, is_new, title, parser.session_id, context, tokens)
+                else:
+                    yield "抱歉，我暂时无法处理这条消息喵～请稍后再试！🐼"
+
+            except (asyncio.CancelledError, GeneratorExit):
+                # 取消可能发生在 yield 处（调用方被取消后关闭生成器）
+                await self._record_cancelled(run, session_id, is_new, title, parser.session_id, tokens)
+                raise
+            except Exception as e:
+                logger.error("处理消息时出错: %s", e)
+                yield f"哎呀，出错了喵～ ({str(e)}) 🐼"
+
+    async def _ask(
+        self, session_id: Optional[str], is_new: bool, prompt: str, title: str
+    ) -> Tuple[Optional[str], Optional[str]]:
+        """
+        发送消息并等待完整回复：server 健康时走 server，否则走 CLI
+
+        Returns:
+            Tuple[回复文本, session_id]
+        """
+        if self.server_backend and self.server_backend.available:
+            try:
+                reply = await self._ask_server(session_id, is_new, prompt, title)
+                self.breaker.record_success()
+                return reply
+            except httpx.TimeoutException:
+                logger.error("Opencode server 调用超时")
+                self.breaker.record_failure("timeout")
+                return "思考太久啦，请稍后再试喵～🐼", None
+            except Exception as e:
+                logger.warning("Opencode server 调用失败，改用 CLI: %s", e)
+
+        if is_new or session_id is None:
+            # 新建 session，使用 --title
+            return await self._call_opencode_new_session(prompt, title)
+        # 继续现有 session
+        return await self._call_opencode_with_session(session_id, prompt)
+
+    async def _ask_server(
+        self, session_id: Optional[str], is_new: bool, prompt: str, title: str
+    ) -> Tuple[Optional[str], Optional[str]]:
+        """通过常驻 server 发送消息"""
+        created = None
+        if is_new or session_id is None:
+            session_id = created = await self.server_backend.create_session(title)
+            logger.info("新建 session [%s] (server): %s...", title, prompt[:50])
+        else:
+            logger.info("继续 session [%s] (server): %s...", session_id, prompt[:50])
 
-            return "抱歉，我暂时无法处理这条消息喵～请稍后再试！🐼"
+        try:
+            output = await self.server_backend.send(session_id, prompt)
+        except httpx.TimeoutException:
+            raise
+        except Exception:
+            if created:
+                # 接下来改用 CLI 新建 session，刚建的这个不会再用，删掉免得留下空 session
+                await self.server_backend.delete_session(created)
+            raise
+        logger.info("Opencode 回复长度: %s 字符", len(output))
+        return output, session_id
+
+    async def _after_reply(
+        self,
+        session_id: Optional[str],
+        is_new: bool,
+        title: str,
+        run_session_id: Optional[str],
+        context: Optional[Dict[str, str]] = None,
+        tokens: int = 0,
+        prewarm: bool = True,
+    ):
+        """
+        回复成功后记录新 session 或增加计数
 
+        新 session 的 ID 优先取 run 输出里的，拿不到才去 session list 里找。
+        context 是这次随完整前言发出去的配置文件哈希，记为 session 已读；
+        tokens 是这一轮（提示词和回复）估算的 token 数，累计到 session 的上下文大小。
+        prewarm 为 True 时，session 写满了就在后台提前创建下一个。
+        """
+        if is_new or session_id is None:
+            with timed("session_resolve"):
+                new_session_id = run_session_id
+                if not new_session_id:
+                    new_session_id = await self.session_manager.get_latest_session_id(title)
+                if new_session_id:
+                    self.session_manager.record_new_session(new_session_id, title, tokens)
+                    logger.info("新建 session: %s", new_session_id)
+            session_id = new_session_id
+        else:
+            # 增加计数
+            self.session_manager.increment_count(session_id, title, tokens)
+
+        if context is not None and session_id:
+            self.session_manager.set_context_hashes(session_id, context)
+
+        if prewarm and Config.SESSION_PREWARM and self.session_manager.needs_rotation(title):
+            # 这一轮把 session 写满了：马上在后台换好下一个，下一条消息不用等
+            self._schedule_prewarm(title)
+
+    async def _record_cancelled(
+        self,
+        run: RunTracker,
+        session_id: Optional[str],
+        is_new: bool,
+        title: str,
+        run_session_id: Optional[str] = None,
+        tokens: int = 0,
+    ):
+        """
+        这一轮被取消（/cancel 或被新消息取代）后的记录
+
+        消息已经交给 opencode 时 session 里已经多了这一轮，照常记录 session、
+        计数和已经产生的 token 数；不记配置文件哈希，下一条消息重新带上完整前言。
+        还在排队等槽位时被取消的，opencode 没收到消息，什么都不用记。
+        """
+        if not run.started:
+            logger.info("session [%s] 的请求在开始前被取消", title)
+            return
+        logger.info("session [%s] 的请求被取消，记录这一轮", title)
+        # 取消还会继续传下去，记录本身不能被打断
+        await asyncio.shield(
+            self._after_reply(
+                session_id, is_new, title, run_session_id or run.session_id, tokens=tokens
+            )
+        )
+
+    async def start(self):
+        """启动后台任务（需要在事件循环中调用）"""
+        self.session_manager.start()
+        if self.memory_index:
+            # 第一次建索引要读全部记忆文件，放到线程里做；之后每条消息只更新变化的文件
+            await asyncio.to_thread(self.memory_index.refresh)
+        if self.server_backend:
+            await self.server_backend.server.start()
+        if Config.SESSION_PREWARM:
+            # 用空的 context 启动，不算到任何一条消息头上（同 archiver）
+            self._prewarm_loop_task = contextvars.Context().run(
+                asyncio.create_task, self._prewarm_loop()
+            )
+
+    async def shutdown(self):
+        """关闭后台任务"""
+        tasks = list(self._prewarm_tasks)
+        if self._prewarm_loop_task is not None:
+            tasks.append(self._prewarm_loop_task)
+            self._prewarm_loop_task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        await self.breaker.shutdown()
+        await self.session_manager.archiver.shutdown()
+        self.session_manager.close()
+        if self.server_backend:
+            await self.server_backend.server.stop()
+            await self.server_backend.close()
+
+    def _remember_slot(self, title: str, user_id: Optional[int], chat_id: Optional[int]):
+        """记下最近用过的槽位"""
+        self._recent_slots[title] = (user_id, chat_id)
+        self._recent_slots.move_to_end(title)
+        while len(self._recent_slots) > PREWARM_MAX_SLOTS:
+            self._recent_slots.popitem(last=False)
+
+    async def _prewarm_loop(self):
+        """每个时间段结束前 SESSION_PREWARM_LEAD 秒，为这个时间段用过的槽位创建下一个时间段的 session"""
+        while True:
+            now = datetime.now()
+            boundary = next_period_start(now)
+            await asyncio.sleep(
+                max(0.0, (boundary - now).total_seconds() - Config.SESSION_PREWARM_LEAD)
+            )
+
+            # 只保留这个时间段用过的槽位
+            current = {
+                title: ids
+                for title, ids in self._recent_slots.items()
+                if self.session_manager.session_key(*ids) == title
+            }
+            self._recent_slots = OrderedDict(current)
+            titles = [
+                self.session_manager.session_key(user_id, chat_id, now=boundary)
+                for user_id, chat_id in current.values()
+            ]
+            for title in titles:
+                await self._prewarm(title)
+
+            # 等这个时间段结束再计算下一个
+            await asyncio.sleep(max(0.0, (boundary - datetime.now()).total_seconds()) + 1)
+
+    def _schedule_prewarm(self, title: str):
+        """在后台为槽位提前创建 session（用空的 context，不算到当前消息头上）"""
+        task = contextvars.Context().run(asyncio.create_task, self._prewarm(title))
+        self._prewarm_tasks.add(task)
+        task.add_done_callback(self._prewarm_tasks.discard)
+
+    async def _prewarm(self, title: str):
+        """
+        提前创建槽位的 session 并让 agent 读完前言
+
+        之后第一条真正的消息直接走“继续 session”：不用等新建 session、
+        session list 和归档，提示词也只需要简短版。槽位已经有能用的 session 时什么都不做；
+        熔断中、有请求在等进程槽位或者没有空闲的槽位时跳过，不和用户消息抢进程。
+        """
+        try:
+            async with self._prewarm_lock:
+                await self._prewarm_slot(title)
         except Exception as e:
-            logger.error(f"处理消息时出错: {e}")
-            return f"哎呀，出错了喵～ ({str(e)}) 🐼"
+            SESSION_PREWARMS.inc(result="failed")
+            logger.warning("提前创建 session [%s] 出错: %s", title, e)
+
+    async def _prewarm_slot(self, title: str):
+        """提前创建一个槽位的 session（由 _prewarm 调用，同一时间只有一个）"""
+        procs = process_stats()
+        if procs["waiting"] or procs["in_flight"] + 1 >= procs["limit"]:
+            # 至少给用户消息留一个空闲的进程槽位
+            SESSION_PREWARMS.inc(result="busy")
+            logger.info("opencode 进程忙，跳过提前创建 session [%s]", title)
+            return
+        if self.breaker.state != CLOSED:
+            SESSION_PREWARMS.inc(result="skipped")
+            return
+
+        # 持有槽位的锁：这期间来的消息等它建好再用
+        async with self.session_manager.lock(title):
+            session_id, is_new = await self.session_manager.prepare_for_message(title)
+            if not is_new:
+                return
+
+            hashes = self.context_files.hashes()
+            prompt = self._build_prompt(PREWARM_MESSAGE, memory=False)
+            with timed("session_prewarm"):
+                response, run_session_id = await self._call_opencode_new_session(prompt, title)
+            if not response:
+                SESSION_PREWARMS.inc(result="failed")
+                logger.warning("提前创建 session [%s] 失败", title)
+                return
+
+            tokens = self._prompt_tokens(prompt) + estimate_tokens(response)
+            # 刚建好的 session 就已经写满（前言比上下文预算还大）时不再接着建，免得循环
+            await self._after_reply(None, True, title, run_session_id, hashes, tokens, prewarm=False)
+            SESSION_PREWARMS.inc(result="created")
+            logger.info("已提前创建 session [%s]", title)
+
+    def _prepare_prompt(
+        self, session_id: Optional[str], is_new: bool, message: str, image_path: str = None
+    ) -> Tuple[str, Optional[Dict[str, str]]]:
+        """
+        新 session 或配置文件有变化时发送完整前言，否则只发简短提示
 
-    def _build_prompt(self, message: str, image_path: str = None) -> str:
-        """构建发送给 Opencode 的提示词"""
-        agents_dir = Config.AGENTS_CONFIG_DIR
-        
-        # 图片信息部分
-        image_info = ""
-        if image_path:
-            image_info = f"""
+        Returns:
+            Tuple[提示词, 随完整前言发出的配置文件哈希（简短提示时为 None）]
+        """
+        hashes = self.context_files.hashes()
+        if is_new or session_id is None:
+            return self._build_prompt(message, image_path), hashes
+
+        seen = self.session_manager.get_context_hashes(session_id)
+        changed = changed_files(seen, hashes)
+        if not changed:
+            return self._build_short_prompt(message, image_path), None
+
+        if seen is not None:
+            logger.info("配置文件有更新，重新发送前言: %s", ", ".join(changed))
+        return self._build_prompt(message, image_path, changed if seen is not None else None), hashes
+
+    def _prompt_tokens(self, prompt: str, image_path: str = None) -> int:
+        """提示词估算的 token 数（图片按固定大小算）"""
+        return estimate_tokens(prompt) + (IMAGE_TOKENS if image_path else 0)
+
+    def _image_info(self, image_path: str = None) -> str:
+        """图片信息部分"""
+        if not image_path:
+            return ""
+        return f"""
 
 **用户发送了一张图片，已保存到:** {image_path}
 你可以直接读取这张图片来查看内容喵～"""
-        
+
+    def _memory_info(self, message: str) -> str:
+        """和消息相关的记忆片段"""
+        if not self.memory_index:
+            return ""
+        with timed("memory_search"):
+            self.memory_index.refresh()
+            snippets = self.memory_index.search(message, Config.MEMORY_SNIPPETS)
+        if not snippets:
+            return ""
+
+        found = "\n\n".join(f"[{snippet.source}]\n{snippet.text}" for snippet in snippets)
+        return f"""
+
+**相关记忆**（从 MEMORY.md 和 memory/ 里检索到的片段，仅供参考）：
+
+{found}"""
+
+    def _build_short_prompt(self, message: str, image_path: str = None) -> str:
+        """继续 session 且配置文件没有变化时的提示词"""
+        return f"""（继续本次会话：配置文件没有变化，不用重新阅读；回复格式要求同前）{self._image_info(image_path)}{self._memory_info(message)}
+
+管理员从 Telegram 发来消息：
+
+{message}"""
+
+    def _build_prompt(
+        self,
+        message: str,
+        image_path: str = None,
+        changed: Optional[List[str]] = None,
+        memory: bool = True,
+    ) -> str:
+        """构建带完整前言的提示词（changed 为自上次阅读后有更新的文件，memory 为是否附上相关记忆）"""
+        agents_dir = Config.AGENTS_CONFIG_DIR
+        image_info = self._image_info(image_path)
+        if self.memory_index:
+            memory_logs = "memory/YYYY-MM-DD.md - 每日记忆日志（不用通读：和消息相关的片段附在消息前面，需要时再查看具体文件）"
+        else:
+            memory_logs = "memory/YYYY-MM-DD.md - 每日记忆日志"
+        if changed:
+            image_info = f"""
+
+以下文件自上次阅读后有更新：{', '.join(changed)}""" + image_info
+
         return f"""AGENTS_CONFIG_DIR: {agents_dir}
 
 此目录包含以下重要文件（基于该目录）：
@@ -87,99 +563,95 @@ class MessageHandler:
 - SOUL.md - 你的本质和个性
 - USER.md - 关于你帮助的用户的信息
 - MEMORY.md - 长期记忆（仅在主会话中加载）
-- memory/YYYY-MM-DD.md - 每日记忆日志
+- {memory_logs}
 
 请在开始工作前阅读这些文件喵～{image_info}
 
         重要提示：
 1. 如果回复内容较长（超过一段话），请在输出时使用 3 个连续换行符（\n\n\n）来分隔不同部分。这样我会将内容拆分成多条 Telegram 消息发送给用户，阅读体验更好。
-2. 如果你生成了图片，请在回复末尾单独一行添加：[IMAGE:图片路径]，例如：[IMAGE:/tmp/output.png]。这样我会将图片发送给用户。
+2. 如果你生成了图片，请在回复末尾单独一行添加：[IMAGE:图片路径]，例如：[IMAGE:/tmp/output.png]。这样我会将图片发送给用户。{self._memory_info(message) if memory else ""}
 
 管理员从 Telegram 发来消息：
 
 {message}"""
 
-    def _call_opencode_new_session(self, prompt: str) -> Optional[str]:
+    async def _call_opencode_new_session(
+        self, prompt: str, title: str
+    ) -> Tuple[Optional[str], Optional[str]]:
         """
         新建 session 并发送消息
 
         使用: opencode run --title <title> "message"
         """
-        try:
-            from datetime import datetime
+        return await self._run_opencode(self._new_session_cmd(prompt, title))
 
-            now = datetime.now()
-            period = (
-                "AM" if now.hour < 12 or (now.hour == 12 and now.minute < 30) else "PM"
-            )
-            title = f"{now.strftime('%Y-%m-%d')}-{period}"
-
-            cmd = [self.opencode_cli, "run", "--title", title, prompt]
-            logger.info(f"新建 session [{title}]: {prompt[:50]}...")
-
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=120,
-            )
-
-            if result.returncode == 0:
-                output = result.stdout.strip()
-                logger.info(f"Opencode 回复长度: {len(output)} 字符")
-                return output
-            else:
-                error_msg = result.stderr.strip() if result.stderr else "未知错误"
-                logger.error(f"Opencode CLI 错误: {error_msg}")
-                return None
-
-        except subprocess.TimeoutExpired:
-            logger.error("Opencode CLI 调用超时")
-            return "思考太久啦，请稍后再试喵～🐼"
-        except FileNotFoundError:
-            logger.error(f"找不到 Opencode CLI: {self.opencode_cli}")
-            return self._fallback_response()
-        except Exception as e:
-            logger.error(f"调用 Opencode CLI 失败: {e}")
-            return None
-
-    def _call_opencode_with_session(
+    async def _call_opencode_with_session(
         self, session_id: str, prompt: str
-    ) -> Optional[str]:
+    ) -> Tuple[Optional[str], Optional[str]]:
         """
         使用现有 session 发送消息
 
         使用: opencode run --session <id> "message"
         """
+        return await self._run_opencode(self._session_cmd(session_id, prompt))
+
+    def _new_session_cmd(
+        self, prompt: str, title: str, json_output: Optional[bool] = None
+    ) -> List[str]:
+        """新建 session 的命令行"""
+        logger.info("新建 session [%s]: %s...", title, prompt[:50])
+        return [self.opencode_cli, "run", *self._format_args(json_output), "--title", title, prompt]
+
+    def _session_cmd(
+        self, session_id: str, prompt: str, json_output: Optional[bool] = None
+    ) -> List[str]:
+        """继续现有 session 的命令行"""
+        logger.info("继续 session [%s]: %s...", session_id, prompt[:50])
+        return [
+            self.opencode_cli, "run", *self._format_args(json_output), "--session", session_id, prompt
+        ]
+
+    def _format_args(self, json_output: Optional[bool] = None) -> List[str]:
+        """输出格式参数：JSON 事件流里带有 session ID（json_output 默认按 OPENCODE_JSON_OUTPUT）"""
+        if json_output is None:
+            json_output = Config.OPENCODE_JSON_OUTPUT
+        return ["--format", "json"] if json_output else []
+
+    async def _run_opencode(self, cmd: List[str]) -> Tuple[Optional[str], Optional[str]]:
+        """
+        异步运行 opencode
+
+        Returns:
+            Tuple[回复文本, session_id]: 失败时回复为 None；
+            输出里没有 session ID 时 session_id 为 None
+        """
         try:
-            cmd = [self.opencode_cli, "run", "--session", session_id, prompt]
-            logger.info(f"继续 session [{session_id}]: {prompt[:50]}...")
-
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=120,
-            )
+            result = await run_command(cmd, timeout=OPENCODE_TIMEOUT)
 
             if result.returncode == 0:
-                output = result.stdout.strip()
-                logger.info(f"Opencode 回复长度: {len(output)} 字符")
-                return output
+                self.breaker.record_success()
+                parser = OutputParser(Config.OPENCODE_JSON_OUTPUT)
+                output = (parser.feed(result.stdout) + parser.finish()).strip()
+                logger.info("Opencode 回复长度: %s 字符", len(output))
+                return output, parser.session_id
             else:
                 error_msg = result.stderr.strip() if result.stderr else "未知错误"
-                logger.error(f"Opencode CLI 错误: {error_msg}")
-                return None
+                logger.error("Opencode CLI 错误: %s", error_msg)
+                self.breaker.record_failure("error")
+                return None, None
 
-        except subprocess.TimeoutExpired:
+        except OpencodeTimeout:
             logger.error("Opencode CLI 调用超时")
-            return "思考太久啦，请稍后再试喵～🐼"
+            self.breaker.record_failure("timeout")
+            return "思考太久啦，请稍后再试喵～🐼", None
         except FileNotFoundError:
-            logger.error(f"找不到 Opencode CLI: {self.opencode_cli}")
-            return self._fallback_response()
+            logger.error("找不到 Opencode CLI: %s", self.opencode_cli)
+            self.breaker.record_failure("not_found")
+            return self._fallback_response(), None
         except Exception as e:
-            logger.error(f"调用 Opencode CLI 失败: {e}")
-            return None
+            logger.error("调用 Opencode CLI 失败: %s", e)
+            self.breaker.record_failure("error")
+            return None, None
 
     def _fallback_response(self) -> str:
         """当 Opencode CLI 不可用时使用的备用回复"""
@@ -201,7 +673,14 @@ class SimpleMessageHandler:
     简化版消息处理器 - 当 Opencode CLI 不可用时使用
     """
 
-    def process_message(self, user_id: int, username: str, message_text: str, image_path: str = None) -> str:
+    async def process_message(
+        self,
+        user_id: int,
+        username: str,
+        message_text: str,
+        image_path: str = None,
+        chat_id: Optional[int] = None,
+    ) -> str:
         """简单的消息处理"""
         image_info = ""
         if image_path:
@@ -215,3 +694,20 @@ class SimpleMessageHandler:
 如需完整 AI 功能，请确保：
 1. opencode 已安装
 2. 在正确的目录运行此 bot）"""
+
+    async def start(self):
+        """简化版没有后台任务"""
+
+    async def shutdown(self):
+        """简化版没有后台任务"""
+
+    async def stream_message(
+        self,
+        user_id: int,
+        username: str,
+        message_text: str,
+        image_path: str = None,
+        chat_id: Optional[int] = None,
+    ) -> AsyncIterator[str]:
+        """简化版没有流式输出，一次性产出完整回复"""
+        yield await self.process_message(user_id, username, message_text, image_path)
@@ -0,0 +1,273 @@
+"""
+监控指标模块 - Prometheus 文本格式的计数器、仪表和直方图喵～
+
+用法：
+    from metrics import timed, STAGE_SECONDS
+
+    with timed("session_prepare"):
+        ...
+
+回复链路的每个阶段都记在 chenqianyu_stage_seconds{stage=...} 里：
+    auth              权限检查
+    media_download    下载用户发来的图片（缓存未命中时）
+    queue_wait        在 chat 队列里排队
+    session_prepare   准备 session（含提交归档）
+    prompt_build      构建提示词
+    memory_search     检索相关的记忆片段
+    opencode_wait     等待 opencode 进程槽位
+    opencode_spawn    启动 opencode 进程
+    opencode_run      opencode 运行（从启动到结束）
+    session_resolve   解析并记录新 session ID
+    session_lookup    读取 session 状态
+    session_count     session 计数加一
+    session_list      从 opencode session list 查找 session ID
+    session_prewarm   提前创建下一个 session（后台）
+    archive           后台归档
+    outbox_wait       发送前等待限速令牌
+    handle            整条 update 的处理
+Telegram API 调用按方法记在 chenqianyu_telegram_request_seconds{method=...} 里。
+这些阶段同时记成当前 update 的 trace 里的 span（见 tracing.py）。
+"""
+
+import time
+import math
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from tracing import span
+
+# 默认直方图分桶（秒），覆盖到 opencode 的 120 秒超时
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120,
+)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict[str, str]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(key) + ([extra] if extra else [])
+    if not items:
+        return ""
+    escaped = (
+        (k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in items
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    """指标基类"""
+
+    type_name = ""
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.type_name}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """只增不减的计数器"""
+
+    type_name = "counter"
+
+    def __init__(self, name: str, help_text: str):
+        super().__init__(name, help_text)
+        self._values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(_label_key(labels), 0)
+
+    def _samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(key)} {_format_value(value)}"
+            for key, value in sorted(self._values.items())
+        ]
+
+
+class Gauge(Metric):
+    """可增可减的仪表；传入 func 时每次导出都调用它取值"""
+
+    type_name = "gauge"
+
+    def __init__(self, name: str, help_text: str, func: Optional[Callable[[], float]] = None):
+        super().__init__(name, help_text)
+        self.func = func
+        self._values: Dict[LabelKey, float] = {}
+
+    def set(self, value: float, **labels):
+        self._values[_label_key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def remove(self, **labels):
+        """不再导出这组标签"""
+        self._values.pop(_label_key(labels), None)
+
+    def _samples(self) -> List[str]:
+        if self.func is not None:
+            return [f"{self.name} {_format_value(self.func())}"]
+        return [
+            f"{self.name}{_format_labels(key)} {_format_value(value)}"
+            for key, value in sorted(self._values.items())
+        ]
+
+
+class Histogram(Metric):
+    """分桶直方图"""
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # 每组标签：[各桶计数..., sum, count]
+        self._values: Dict[LabelKey, List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        data = self._values.get(key)
+        if data is None:
+            data = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                data[i] += 1
+        data[-2] += value
+        data[-1] += 1
+
+    def count(self, **labels) -> int:
+        data = self._values.get(_label_key(labels))
+        return int(data[-1]) if data else 0
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for key, data in sorted(self._values.items()):
+            for bound, bucket_count in zip(self.buckets, data):
+                le = ("le", _format_value(bound))
+                lines.append(f"{self.name}_bucket{_format_labels(key, le)} {_format_value(bucket_count)}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(data[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {_format_value(data[-1])}")
+        return lines
+
+
+class Registry:
+    """指标注册表"""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name: str) -> Optional[Metric]:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        """导出 Prometheus 文本格式"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(
+    Histogram("chenqianyu_stage_seconds", "回复链路各阶段耗时（秒）")
+)
+STAGE_ERRORS = REGISTRY.register(
+    Counter("chenqianyu_stage_errors_total", "回复链路各阶段出错次数")
+)
+TELEGRAM_SECONDS = REGISTRY.register(
+    Histogram("chenqianyu_telegram_request_seconds", "Telegram Bot API 调用耗时（秒）")
+)
+UPDATES_TOTAL = REGISTRY.register(
+    Counter("chenqianyu_updates_total", "收到的 update 数")
+)
+OPENCODE_RUNS = REGISTRY.register(
+    Counter("chenqianyu_opencode_runs_total", "opencode 调用次数（按结果）")
+)
+MEDIA_CACHE_LOOKUPS = REGISTRY.register(
+    Counter("chenqianyu_media_cache_lookups_total", "收到的图片缓存查询次数（hit/miss）")
+)
+OUTBOX_RETRIES = REGISTRY.register(
+    Counter("chenqianyu_outbox_retries_total", "发送重试次数（retry_after / network）")
+)
+ADMISSION_REJECTED = REGISTRY.register(
+    Counter("chenqianyu_admission_rejected_total", "准入控制拒绝的请求数（rate / queue / deadline / expired）")
+)
+PHOTO_SENDS = REGISTRY.register(
+    Counter("chenqianyu_photo_sends_total", "回复里的图片发送次数（upload 上传 / file_id 复用）")
+)
+MESSAGES_COALESCED = REGISTRY.register(
+    Counter("chenqianyu_messages_coalesced_total", "并入已有批次、没有单独调用 opencode 的消息数")
+)
+BREAKER_TRANSITIONS = REGISTRY.register(
+    Counter("chenqianyu_breaker_transitions_total", "熔断状态切换次数（按切换到的状态 closed / open / half_open）")
+)
+BREAKER_FAST_FAILS = REGISTRY.register(
+    Counter("chenqianyu_breaker_fast_fails_total", "熔断期间没有调用 opencode、直接降级回复的请求数")
+)
+LOGS_DROPPED = REGISTRY.register(
+    Counter("chenqianyu_logs_dropped_total", "日志队列满时丢弃的日志条数")
+)
+CANCELLED = REGISTRY.register(
+    Counter("chenqianyu_cancelled_total", "取消的请求数（command 用 /cancel / superseded 被新消息取代）")
+)
+CHAT_QUEUE_WAIT = REGISTRY.register(
+    Gauge("chenqianyu_chat_queue_wait_seconds", "各 chat 最近一次在队列里排队的时间（秒，只保留最近活跃的 chat）")
+)
+SESSION_ROTATIONS = REGISTRY.register(
+    Counter("chenqianyu_session_rotations_total", "换新 session 的次数（tokens 上下文超出预算 / messages 消息数到上限）")
+)
+SESSION_PREWARMS = REGISTRY.register(
+    Counter("chenqianyu_session_prewarms_total", "提前创建 session 的次数（created / failed / busy 进程忙跳过 / skipped 熔断中跳过）")
+)
+INBOX_EVENTS = REGISTRY.register(
+    Counter(
+        "chenqianyu_inbox_total",
+        "收件箱事件数（duplicate 重复的 update / resumed 重启后继续处理 / expired 太旧不再处理 / failed 重试次数用完）",
+    )
+)
+
+
+@contextmanager
+def timed(stage: str):
+    """记录代码块耗时到 chenqianyu_stage_seconds（同时记成 trace 里的 span）；抛异常时同时计数"""
+    started = time.monotonic()
+    try:
+        with span(stage):
+            yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.monotonic() - started, stage=stage)
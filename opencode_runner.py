@@ -0,0 +1,362 @@
+"""
+Opencode 进程执行模块 - 基于 asyncio 子进程，不阻塞事件循环喵～
+
+每次调用都在独立的进程组里启动 opencode，超时或被取消时
+会把整个进程组（包括 opencode 拉起的子进程）一起结束掉。
+"""
+
+import asyncio
+import codecs
+import contextvars
+import json
+import os
+import signal
+import logging
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, Iterator, List, Optional
+from config import Config
+from metrics import timed, OPENCODE_RUNS, STAGE_SECONDS
+from tracing import record_span
+
+logger = logging.getLogger(__name__)
+
+# 发送 SIGTERM 后等待进程组退出的时间（秒），超过就 SIGKILL
+KILL_GRACE_SECONDS = 3
+
+# 流式读取时每次最多读取的字节数
+STREAM_CHUNK_SIZE = 4096
+
+# 全局进程槽位，限制同时运行的 opencode 进程数
+_process_slots: Optional[asyncio.Semaphore] = None
+_in_flight = 0
+_waiting = 0
+
+
+# 当前这轮对话是否已经把消息交给了 opencode（见 track_runs）
+_run_tracker: contextvars.ContextVar[Optional["RunTracker"]] = contextvars.ContextVar(
+    "run_tracker", default=None
+)
+
+
+class RunTracker:
+    """记录一段代码里有没有真正启动 opencode（拿到槽位并启动了进程或发出了请求）"""
+
+    def __init__(self):
+        self.started = False
+        self.session_id: Optional[str] = None  # 已知的 opencode session（server 后端）
+
+
+@contextmanager
+def track_runs() -> Iterator[RunTracker]:
+    """
+    跟踪代码块里是否启动了 opencode
+
+    被取消时据此判断消息有没有发到 opencode：还在排队等槽位就被取消的，
+    session 里不会多出这一轮。
+    """
+    tracker = RunTracker()
+    token = _run_tracker.set(tracker)
+    try:
+        yield tracker
+    finally:
+        _run_tracker.reset(token)
+
+
+def mark_run_started(session_id: Optional[str] = None):
+    """标记当前这轮对话已经交给了 opencode"""
+    tracker = _run_tracker.get()
+    if tracker is not None:
+        tracker.started = True
+        tracker.session_id = session_id or tracker.session_id
+
+
+def _get_slots() -> asyncio.Semaphore:
+    """懒加载进程槽位（需要在事件循环里创建）"""
+    global _process_slots
+    if _process_slots is None:
+        _process_slots = asyncio.Semaphore(max(1, Config.OPENCODE_MAX_PROCESSES))
+    return _process_slots
+
+
+def process_stats() -> Dict[str, int]:
+    """当前进程槽位使用情况"""
+    return {
+        "in_flight": _in_flight,
+        "waiting": _waiting,
+        "limit": max(1, Config.OPENCODE_MAX_PROCESSES),
+    }
+
+
+@dataclass
+class RunResult:
+    """一次 opencode 调用的结果"""
+
+    returncode: int
+    stdout: str
+    stderr: str
+
+
+class OpencodeTimeout(Exception):
+    """opencode 进程运行超时"""
+
+
+class CommandFailed(Exception):
+    """进程以非 0 退出码结束（流式模式下使用）"""
+
+    def __init__(self, returncode: int, stderr: str):
+        super().__init__(stderr or f"退出码 {returncode}")
+        self.returncode = returncode
+        self.stderr = stderr
+
+
+class OutputParser:
+    """
+    解析 opencode run 的输出
+
+    json_mode 为 True 时输出是 `--format json` 的事件流（每行一个 JSON），
+    从中提取回复文本和 session ID；解析不了的行按普通文本处理。
+    """
+
+    def __init__(self, json_mode: bool):
+        self.json_mode = json_mode
+        self.session_id: Optional[str] = None
+        self._line_buffer = ""
+        self._text_parts = 0
+
+    def feed(self, chunk: str) -> str:
+        """输入一段原始输出，返回其中可以展示给用户的文本"""
+        if not self.json_mode:
+            return chunk
+
+        self._line_buffer += chunk
+        lines = self._line_buffer.split("\n")
+        self._line_buffer = lines.pop()
+        return "".join(self._parse_line(line) for line in lines)
+
+    def finish(self) -> str:
+        """输出结束，处理最后一行"""
+        if not self.json_mode:
+            return ""
+        line, self._line_buffer = self._line_buffer, ""
+        return self._parse_line(line)
+
+    def _parse_line(self, line: str) -> str:
+        """解析一行事件，返回其中的文本"""
+        if not line.strip():
+            return ""
+        try:
+            event = json.loads(line)
+        except ValueError:
+            return line + "\n"
+        if not isinstance(event, dict):
+            return line + "\n"
+
+        part = event.get("part") if isinstance(event.get("part"), dict) else {}
+        session_id = event.get("sessionID") or part.get("sessionID")
+        if session_id and not self.session_id:
+            self.session_id = session_id
+
+        if event.get("type") == "error":
+            logger.error("Opencode 事件错误: %s", event.get("error"))
+            return ""
+        if event.get("type") == "text" and part.get("text"):
+            # 多个文本块之间空一行
+            prefix = "\n\n" if self._text_parts else ""
+            self._text_parts += 1
+            return prefix + part["text"]
+        return ""
+
+
+async def run_command(
+    cmd: List[str], timeout: float, cwd: Optional[str] = None
+) -> RunResult:
+    """
+    异步运行命令并收集输出
+
+    同时运行的进程数受 OPENCODE_MAX_PROCESSES 限制，超出时排队等待槽位。
+
+    Args:
+        cmd: 命令及参数
+        timeout: 超时时间（秒）
+        cwd: 工作目录（可选）
+
+    Returns:
+        RunResult: 退出码和 stdout/stderr 文本
+
+    Raises:
+        OpencodeTimeout: 超时（进程组已被结束）
+        FileNotFoundError: 找不到可执行文件
+    """
+    await _acquire_slot()
+    try:
+        with timed("opencode_run"):
+            result = await _run(cmd, timeout, cwd)
+        OPENCODE_RUNS.inc(result="ok" if result.returncode == 0 else "error")
+        return result
+    except OpencodeTimeout:
+        OPENCODE_RUNS.inc(result="timeout")
+        raise
+    except asyncio.CancelledError:
+        OPENCODE_RUNS.inc(result="cancelled")
+        raise
+    finally:
+        _release_slot()
+
+
+async def stream_command(
+    cmd: List[str], timeout: float, cwd: Optional[str] = None
+) -> AsyncIterator[str]:
+    """
+    异步运行命令，边运行边产出 stdout 文本
+
+    超时从拿到进程槽位开始计算，是整个运行过程的总时长。
+    调用方提前停止迭代（或被取消）时会结束整个进程组。
+
+    Yields:
+        stdout 的文本片段（已按 UTF-8 增量解码）
+
+    Raises:
+        OpencodeTimeout: 超时（进程组已被结束）
+        CommandFailed: 进程以非 0 退出码结束
+        FileNotFoundError: 找不到可执行文件
+    """
+    await _acquire_slot()
+    proc = None
+    stderr_task = None
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    outcome = "error"
+    try:
+        deadline = started + timeout
+        proc = await _spawn(cmd, cwd)
+        # stderr 在后台读完，避免管道写满卡住进程
+        stderr_task = asyncio.create_task(proc.stderr.read())
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError
+            data = await asyncio.wait_for(
+                proc.stdout.read(STREAM_CHUNK_SIZE), remaining
+            )
+            if not data:
+                break
+            text = decoder.decode(data)
+            if text:
+                yield text
+
+        tail = decoder.decode(b"", final=True)
+        if tail:
+            yield tail
+
+        remaining = max(deadline - loop.time(), 0)
+        await asyncio.wait_for(proc.wait(), remaining)
+        stderr = (await stderr_task).decode("utf-8", errors="replace")
+        if proc.returncode != 0:
+            raise CommandFailed(proc.returncode, stderr.strip())
+        outcome = "ok"
+
+    except asyncio.TimeoutError:
+        outcome = "timeout"
+        raise OpencodeTimeout(f"{cmd[0]} 运行超过 {timeout} 秒")
+    except (asyncio.CancelledError, GeneratorExit):
+        outcome = "cancelled"
+        raise
+    finally:
+        if proc is not None:
+            await kill_process_group(proc)
+        if stderr_task is not None and not stderr_task.done():
+            stderr_task.cancel()
+        _release_slot()
+        OPENCODE_RUNS.inc(result=outcome)
+        STAGE_SECONDS.observe(loop.time() - started, stage="opencode_run")
+        record_span("opencode_run", loop.time() - started, result=outcome)
+
+
+@asynccontextmanager
+async def process_slot():
+    """占用一个 opencode 槽位（server 后端的请求也计入同一个上限）"""
+    await _acquire_slot()
+    try:
+        yield
+    finally:
+        _release_slot()
+
+
+async def _acquire_slot():
+    """等待一个进程槽位"""
+    global _in_flight, _waiting
+
+    _waiting += 1
+    try:
+        with timed("opencode_wait"):
+            await _get_slots().acquire()
+    finally:
+        _waiting -= 1
+    _in_flight += 1
+
+
+def _release_slot():
+    """归还进程槽位"""
+    global _in_flight
+
+    _in_flight -= 1
+    _get_slots().release()
+
+
+async def _spawn(cmd: List[str], cwd: Optional[str]) -> asyncio.subprocess.Process:
+    """在独立进程组里启动进程（方便整组结束）"""
+    with timed("opencode_spawn"):
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=cwd,
+            start_new_session=True,
+        )
+    mark_run_started()
+    return proc
+
+
+async def _run(cmd: List[str], timeout: float, cwd: Optional[str]) -> RunResult:
+    """启动进程并等待结束（调用方已持有进程槽位）"""
+    proc = await _spawn(cmd, cwd)
+
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        await kill_process_group(proc)
+        raise OpencodeTimeout(f"{cmd[0]} 运行超过 {timeout} 秒")
+    except asyncio.CancelledError:
+        await kill_process_group(proc)
+        raise
+
+    return RunResult(
+        returncode=proc.returncode,
+        stdout=stdout.decode("utf-8", errors="replace"),
+        stderr=stderr.decode("utf-8", errors="replace"),
+    )
+
+
+async def kill_process_group(proc: asyncio.subprocess.Process):
+    """结束进程所在的整个进程组：先 SIGTERM，超时再 SIGKILL"""
+    if proc.returncode is not None:
+        return
+
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+
+    try:
+        await asyncio.wait_for(proc.wait(), KILL_GRACE_SECONDS)
+    except asyncio.TimeoutError:
+        logger.warning("进程组 %s 未响应 SIGTERM，强制结束", proc.pid)
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await proc.wait()
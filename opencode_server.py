@@ -0,0 +1,254 @@
+"""
+Opencode Server 后端 - 常驻一个 `opencode serve` 进程，通过 HTTP 发消息喵～
+
+省掉每条消息都启动一次 CLI 的开销：
+- OpencodeServer 负责启动、健康检查和崩溃后重启 server 进程
+- ServerBackend 通过连接池（httpx）调用 server 的 HTTP 接口
+
+设置了 OPENCODE_SERVER_URL 时直接连接这个地址（不启动进程），
+可以用来连接单独部署的 server 或本地的测试桩。
+"""
+
+import asyncio
+import logging
+from typing import List, Optional
+import httpx
+from config import Config
+from opencode_runner import kill_process_group, mark_run_started, process_slot
+
+logger = logging.getLogger(__name__)
+
+# 健康检查间隔（秒）
+HEALTH_CHECK_INTERVAL = 30
+
+# 连续几次健康检查失败就重启 server
+MAX_HEALTH_FAILURES = 3
+
+# 启动后等待 server 可用的最长时间（秒）
+STARTUP_TIMEOUT = 30
+
+# 重启退避的上限（秒）
+MAX_RESTART_DELAY = 60
+
+
+class ServerError(Exception):
+    """server 返回了错误"""
+
+
+class OpencodeServer:
+    """管理本地常驻的 opencode server 进程"""
+
+    def __init__(
+        self,
+        cli: Optional[str] = None,
+        port: Optional[int] = None,
+        base_url: Optional[str] = None,
+    ):
+        """
+        Args:
+            cli: opencode 可执行文件
+            port: 本地 server 端口
+            base_url: 外部 server 地址；设置后不启动本地进程
+        """
+        self.cli = cli or Config.OPENCODE_CLI
+        self.port = port or Config.OPENCODE_SERVER_PORT
+        self.external = bool(base_url)
+        self.base_url = (base_url or f"http://127.0.0.1:{self.port}").rstrip("/")
+
+        self.healthy = False
+        self._proc: Optional[asyncio.subprocess.Process] = None
+        self._supervisor: Optional[asyncio.Task] = None
+        self._client: Optional[httpx.AsyncClient] = None
+
+    async def start(self):
+        """启动监护任务（立即返回，server 在后台启动）"""
+        if self._supervisor is None:
+            self._client = httpx.AsyncClient(base_url=self.base_url, timeout=5)
+            self._supervisor = asyncio.create_task(self._supervise())
+
+    async def stop(self):
+        """停止监护任务和 server 进程"""
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+            await asyncio.gather(self._supervisor, return_exceptions=True)
+            self._supervisor = None
+        if self._proc is not None:
+            await kill_process_group(self._proc)
+            self._proc = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        self.healthy = False
+
+    def mark_unhealthy(self):
+        """请求失败时调用，直到下次健康检查通过前都走 CLI"""
+        if self.healthy:
+            logger.warning("Opencode server 请求失败，暂时改用 CLI")
+        self.healthy = False
+
+    async def check_health(self) -> bool:
+        """检查 server 是否可用"""
+        try:
+            response = await self._client.get("/config")
+            return response.status_code == 200
+        except httpx.HTTPError:
+            return False
+
+    async def _supervise(self):
+        """启动 server，定期检查健康状态，挂掉就按退避时间重启"""
+        restart_delay = 1
+        while True:
+            try:
+                if not self.external:
+                    await self._spawn()
+                if await self._wait_until_healthy():
+                    restart_delay = 1
+                    await self._monitor()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Opencode server 监护出错: %s", e)
+
+            self.healthy = False
+            if self._proc is not None:
+                await kill_process_group(self._proc)
+                self._proc = None
+
+            logger.warning("Opencode server 不可用，%s 秒后重试", restart_delay)
+            await asyncio.sleep(restart_delay)
+            restart_delay = min(restart_delay * 2, MAX_RESTART_DELAY)
+
+    async def _spawn(self):
+        """启动 opencode serve 进程"""
+        cmd = [self.cli, "serve", "--hostname", "127.0.0.1", "--port", str(self.port)]
+        self._proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+            start_new_session=True,
+        )
+        logger.info("已启动 Opencode server (pid %s): %s", self._proc.pid, self.base_url)
+
+    async def _wait_until_healthy(self) -> bool:
+        """等待 server 可以响应请求"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + STARTUP_TIMEOUT
+        while loop.time() < deadline:
+            if self._proc is not None and self._proc.returncode is not None:
+                logger.error("Opencode server 启动失败，退出码 %s", self._proc.returncode)
+                return False
+            if await self.check_health():
+                self.healthy = True
+                logger.info("Opencode server 已就绪")
+                return True
+            await asyncio.sleep(0.5)
+        logger.error("Opencode server %s 秒内没有就绪", STARTUP_TIMEOUT)
+        return False
+
+    async def _monitor(self):
+        """运行期间定期检查，进程退出或连续检查失败时返回"""
+        failures = 0
+        while failures < MAX_HEALTH_FAILURES:
+            await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+            if self._proc is not None and self._proc.returncode is not None:
+                logger.error("Opencode server 已退出，退出码 %s", self._proc.returncode)
+                return
+            if await self.check_health():
+                failures = 0
+                self.healthy = True
+            else:
+                failures += 1
+                self.healthy = False
+        logger.error("Opencode server 连续 %s 次健康检查失败", failures)
+
+
+class ServerBackend:
+    """通过 HTTP 连接池调用 opencode server"""
+
+    def __init__(self, server: OpencodeServer, timeout: float):
+        self.server = server
+        self.timeout = timeout
+        self._client = httpx.AsyncClient(
+            base_url=server.base_url,
+            timeout=httpx.Timeout(timeout, connect=5),
+            limits=httpx.Limits(
+                max_connections=Config.OPENCODE_MAX_PROCESSES,
+                max_keepalive_connections=Config.OPENCODE_MAX_PROCESSES,
+            ),
+        )
+
+    @property
+    def available(self) -> bool:
+        """server 当前是否健康"""
+        return self.server.healthy
+
+    async def create_session(self, title: str) -> str:
+        """新建 session，返回 session ID"""
+        response = await self._request("POST", "/session", {"title": title})
+        return response["id"]
+
+    async def send(self, session_id: str, prompt: str) -> str:
+        """
+        向 session 发送消息并等待回复
+
+        Raises:
+            httpx.TimeoutException: 超时（已尝试中止生成）
+            httpx.HTTPError: 连接失败等
+            ServerError: server 返回了错误
+        """
+        body = {"parts": [{"type": "text", "text": prompt}]}
+        async with process_slot():
+            mark_run_started(session_id)
+            try:
+                response = await self._request("POST", f"/session/{session_id}/message", body)
+            except (httpx.TimeoutException, asyncio.CancelledError):
+                # 超时或被取消（/cancel、新消息取代）时让 server 停止生成
+                await self._abort(session_id)
+                raise
+
+        error = (response.get("info") or {}).get("error")
+        if error:
+            raise ServerError(str(error))
+        return _join_text_parts(response.get("parts") or [])
+
+    async def delete_session(self, session_id: str):
+        """删除 session（尽力而为），用于发送失败、改用 CLI 时清理刚建的 session"""
+        try:
+            await self._client.delete(f"/session/{session_id}", timeout=5)
+        except httpx.HTTPError as e:
+            logger.warning("删除 session %s 失败: %s", session_id, e)
+
+    async def _abort(self, session_id: str):
+        """中止 session 正在进行的生成（尽力而为）"""
+        try:
+            await self._client.post(f"/session/{session_id}/abort", timeout=5)
+        except httpx.HTTPError as e:
+            logger.warning("中止 session %s 失败: %s", session_id, e)
+
+    async def _request(self, method: str, path: str, body: dict) -> dict:
+        """发送请求，连接类错误会把 server 标记为不健康"""
+        try:
+            response = await self._client.request(method, path, json=body)
+        except (httpx.ConnectError, httpx.RemoteProtocolError):
+            self.server.mark_unhealthy()
+            raise
+        if response.status_code >= 500:
+            self.server.mark_unhealthy()
+        if response.status_code >= 400:
+            raise ServerError(f"{method} {path} 返回 {response.status_code}: {response.text[:200]}")
+        return response.json()
+
+    async def close(self):
+        """关闭连接池"""
+        await self._client.aclose()
+
+
+def _join_text_parts(parts: List[dict]) -> str:
+    """拼接回复中的文本块（多个文本块之间空一行）"""
+    texts = [
+        part["text"]
+        for part in parts
+        if isinstance(part, dict) and part.get("type") == "text" and part.get("text")
+    ]
+    return "\n\n".join(texts).strip()
@@ -0,0 +1,240 @@
+"""
+发送模块 - 所有发往 Telegram 的消息都从这里出去喵～
+
+按 Telegram 的限制用令牌桶限速：全局每秒约 30 条，单个私聊每秒约 1 条
+（允许短暂突发），群聊每分钟约 20 条。令牌够用时立即发送，不再固定等待；
+遇到 RetryAfter（flood wait）时按返回的秒数暂停这个 chat 再重试。
+"""
+
+import re
+import time
+import asyncio
+import logging
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from telegram import Message
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+from config import Config
+from metrics import STAGE_SECONDS, OUTBOX_RETRIES
+from tracing import record_span
+from streaming import IMAGE_PATTERN, MAX_MESSAGE_LENGTH, SECTION_SEPARATOR
+
+logger = logging.getLogger(__name__)
+
+# 网络错误第一次重试前等待的时间（秒），之后每次翻倍
+NETWORK_RETRY_BASE_DELAY = 1
+
+# 超过这么多个 chat 的令牌桶时清理空闲的
+MAX_IDLE_BUCKETS = 1000
+
+
+class TokenBucket:
+    """令牌桶：每秒补充 rate 个令牌，最多存 capacity 个"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+
+    @property
+    def ready(self) -> bool:
+        """现在就有令牌可用"""
+        now = time.monotonic()
+        self._refill(now)
+        return self._tokens >= 1 and now >= self._blocked_until
+
+    @property
+    def idle(self) -> bool:
+        """令牌已经补满且没有被暂停"""
+        now = time.monotonic()
+        self._refill(now)
+        return self._tokens >= self.capacity and now >= self._blocked_until
+
+    async def acquire(self):
+        """取一个令牌，不够时等待"""
+        while True:
+            now = time.monotonic()
+            self._refill(now)
+            wait = self._blocked_until - now
+            if wait <= 0:
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            await asyncio.sleep(wait)
+
+    def try_acquire(self) -> bool:
+        """有令牌时取一个并返回 True，没有时不等待直接返回 False"""
+        if not self.ready:
+            return False
+        self._tokens -= 1
+        return True
+
+    def pause(self, seconds: float):
+        """暂停发放令牌（收到 RetryAfter 时）"""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class Outbox:
+    """带限速和重试的发送通道"""
+
+    def __init__(
+        self,
+        global_rate: float,
+        chat_rate: float,
+        chat_burst: int,
+        group_rate: float,
+        max_retries: int,
+    ):
+        """
+        Args:
+            global_rate: 全局每秒消息数
+            chat_rate: 单个私聊每秒消息数
+            chat_burst: 单个 chat 允许的突发条数
+            group_rate: 单个群聊每秒消息数
+            max_retries: RetryAfter 或网络错误的最大重试次数
+        """
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: Dict[int, TokenBucket] = {}
+
+    async def send(self, chat_id: int, func: Callable[[], Awaitable[Any]], group: bool = False) -> Any:
+        """
+        限速后调用 func 发送，RetryAfter 和网络错误时重试
+
+        Args:
+            chat_id: 目标 chat
+            func: 实际调用 Bot API 的协程函数
+            group: 是否是群聊（限速更严）
+        """
+        bucket = self._chat_bucket(chat_id, group)
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            await bucket.acquire()
+            await self._global.acquire()
+            waited = time.monotonic() - started
+            STAGE_SECONDS.observe(waited, stage="outbox_wait")
+            record_span("outbox_wait", waited)
+
+            try:
+                return await func()
+            except RetryAfter as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                delay = _seconds(e.retry_after)
+                OUTBOX_RETRIES.inc(reason="retry_after")
+                logger.warning("chat %s 触发限流，%.0f 秒后重试", chat_id, delay)
+                bucket.pause(delay)
+            except TimedOut:
+                # 请求可能已经送达，重试会重复发送
+                raise
+            except (BadRequest, Forbidden):
+                # 请求本身有问题（BadRequest 也是 NetworkError 的子类），重试结果一样
+                raise
+            except NetworkError as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                delay = NETWORK_RETRY_BASE_DELAY * 2 ** (attempt - 1)
+                OUTBOX_RETRIES.inc(reason="network")
+                logger.warning("发送到 chat %s 失败，%s 秒后重试: %s", chat_id, delay, e)
+                await asyncio.sleep(delay)
+
+    def ready(self, chat_id: int) -> bool:
+        """chat 和全局现在都有令牌（可有可无的发送，例如更新占位消息，没令牌时跳过）"""
+        bucket = self._chats.get(chat_id)
+        return (bucket is None or bucket.ready) and self._global.ready
+
+    async def reply_text(self, message: Message, text: str) -> Message:
+        """回复一条文字消息"""
+        return await self.send(
+            message.chat_id, lambda: message.reply_text(text), group=_is_group(message)
+        )
+
+    async def edit_text(self, message: Message, text: str) -> Any:
+        """编辑一条已发送的消息"""
+        return await self.send(
+            message.chat_id, lambda: message.edit_text(text), group=_is_group(message)
+        )
+
+    async def delete(self, message: Message) -> Any:
+        """删除一条已发送的消息"""
+        return await self.send(message.chat_id, message.delete, group=_is_group(message))
+
+    async def send_reply(self, message: Message, response: str) -> Tuple[int, Optional[str]]:
+        """
+        把完整回复按段落拆成多条消息依次发送
+
+        Returns:
+            Tuple[发送的消息数, 回复里的图片路径]
+        """
+        parts, image_path = split_reply(response)
+        for i, part in enumerate(parts):
+            await self.reply_text(message, part)
+            logger.info("已发送第 %s/%s 条消息给 chat %s", i + 1, len(parts), message.chat_id)
+        return len(parts), image_path
+
+    def _chat_bucket(self, chat_id: int, group: bool) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= MAX_IDLE_BUCKETS:
+                self._chats = {k: v for k, v in self._chats.items() if not v.idle}
+            rate = self.group_rate if group else self.chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+
+
+def split_reply(response: str) -> Tuple[List[str], Optional[str]]:
+    """
+    拆分回复：取出 [IMAGE:路径] 标记，按 3 个换行符分段，超长的段再按长度切开
+
+    Returns:
+        Tuple[各条消息, 图片路径]
+    """
+    image_path = None
+    match = re.search(IMAGE_PATTERN, response)
+    if match:
+        image_path = match.group(1).strip()
+        response = re.sub(IMAGE_PATTERN, "", response).strip()
+
+    parts = []
+    for section in response.split(SECTION_SEPARATOR):
+        section = section.strip()
+        while section:
+            parts.append(section[:MAX_MESSAGE_LENGTH])
+            section = section[MAX_MESSAGE_LENGTH:].lstrip()
+    return parts, image_path
+
+
+def create_outbox() -> Outbox:
+    """按配置创建发送通道"""
+    return Outbox(
+        global_rate=Config.OUTBOX_GLOBAL_RATE,
+        chat_rate=Config.OUTBOX_CHAT_RATE,
+        chat_burst=Config.OUTBOX_CHAT_BURST,
+        group_rate=Config.OUTBOX_GROUP_RATE_PER_MINUTE / 60,
+        max_retries=Config.OUTBOX_MAX_RETRIES,
+    )
+
+
+def _is_group(message: Message) -> bool:
+    return message.chat.type in ("group", "supergroup")
+
+
+def _seconds(value) -> float:
+    """RetryAfter.retry_after 可能是秒数或 timedelta"""
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    return float(value)
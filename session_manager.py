@@ -1,27 +1,91 @@
 """
-Session 管理模块 - Unix 哲学：文件即状态喵～
+Session 管理模块喵～
 
-sessions/ 目录结构：
-├── 2025-02-05-AM      (session_id count)
-└── 2025-02-05-PM      (session_id count)
+每个时间段（例如 2025-02-05-AM）对应一个 session 槽位，
+状态保存在 session_store 里（默认 sessions/sessions.db）：
 
-每行格式：session_id count
-满 50 次后自动归档到 memory
+    key              session_id   count   tokens
+    2025-02-05-AM    ses_xxx      12      18230
+    2025-02-05-PM    ses_yyy      50      4120
+
+按 SESSION_SCOPE 可以每个用户或每个 chat 各用一套 session，槽位名后面
+加上 -u<用户ID> 或 -c<chatID>（例如 2025-02-05-AM-u123）。
+
+估算的上下文大小（提示词和回复累计的 token 数）达到 SESSION_TOKEN_BUDGET，
+或者消息数达到 SESSION_MAX_MESSAGES 时换新 session，旧的在后台自动归档到
+memory（见 archiver.py）。
 """
 
 import os
-import subprocess
-from datetime import datetime
+import re
+import time
+import asyncio
+import weakref
+from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Dict, Optional, Tuple
 from dataclasses import dataclass
 import logging
 from config import Config
+from metrics import SESSION_ROTATIONS, timed
+from opencode_runner import run_command
+from archiver import SessionArchiver
+from session_store import create_store
 
 logger = logging.getLogger(__name__)
 
-# 会话次数上限
-MESSAGE_LIMIT = 50
+# 一张图片大约算多少 token
+IMAGE_TOKENS = 1000
+
+# 启动时补归档多久以内（秒）写满了还没归档的 session
+ARCHIVE_RESUME_SECONDS = 2 * 24 * 3600
+
+# 中日韩文字大约一个字一个 token，其余文字大约四个字符一个 token
+CJK_PATTERN = re.compile(r"[\u3000-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """粗略估算文本的 token 数（不依赖具体模型的分词器）"""
+    if not text:
+        return 0
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def period_title(now: Optional[datetime] = None) -> str:
+    """
+    时间段标题，同时用作 session 文件名和 opencode session 标题
+
+    12:30 之前算 AM，之后算 PM，例如 2025-02-05-AM
+    """
+    now = now or datetime.now()
+    period = "AM" if now.hour < 12 or (now.hour == 12 and now.minute < 30) else "PM"
+    return f"{now.strftime('%Y-%m-%d')}-{period}"
+
+
+def next_period_start(now: Optional[datetime] = None) -> datetime:
+    """下一个时间段开始的时间（12:30 或第二天 0 点）"""
+    now = now or datetime.now()
+    noon = now.replace(hour=12, minute=30, second=0, microsecond=0)
+    if now < noon:
+        return noon
+    return (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def resolve_scope(scope: str, allowed_user_id: Optional[str]) -> str:
+    """
+    解析 SESSION_SCOPE
+
+    auto：白名单里只有一个用户时所有消息共用一个 session（和以前一样），
+    否则每个用户一个 session。
+    """
+    scope = (scope or "auto").lower()
+    if scope in ("global", "user", "chat"):
+        return scope
+    if scope != "auto":
+        logger.warning("未知的 SESSION_SCOPE: %s，使用 auto", scope)
+    allowed = [uid for uid in (allowed_user_id or "").split(",") if uid.strip()]
+    return "global" if len(allowed) == 1 else "user"
 
 
 @dataclass
@@ -31,6 +95,7 @@ class SessionInfo:
     session_id: Optional[str]  # None 表示需要新建
     count: int  # 当前计数
     need_archive: bool  # 是否需要先归档
+    tokens: int = 0  # 估算的上下文大小
     archive_session_id: Optional[str] = None  # 需要归档的 session
 
 
@@ -42,6 +107,22 @@ class SessionManager:
         self.sessions_dir = self.workspace_dir / "sessions"
         self.sessions_dir.mkdir(exist_ok=True)
 
+        # session 状态存储（默认 SQLite，自动导入旧版时间段文件）
+        self.store = create_store(Config.SESSION_STORE, self.sessions_dir)
+
+        # 已解析的 session ID 缓存：标题 -> session_id
+        self._resolved_ids: Dict[str, str] = {}
+
+        # session 按什么划分：global / user / chat
+        self.scope = resolve_scope(Config.SESSION_SCOPE, Config.ALLOWED_USER_ID)
+        # 每个 session 槽位一把锁（没人用时自动回收）
+        self._locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = (
+            weakref.WeakValueDictionary()
+        )
+
+        # 后台归档队列（归档成功后才在存储里记为已归档）
+        self.archiver = SessionArchiver(on_archived=self._mark_archived)
+
         # 确保所有必要的软链接存在
         self._ensure_all_links()
 
@@ -76,29 +157,48 @@ class SessionManager:
         if link_path.exists() or link_path.is_symlink():
             if not link_path.is_symlink():
                 # 如果存在但不是软链接，跳过（保留用户文件）
-                logger.warning(f"{link_name} 已存在且不是软链接，跳过")
+                logger.warning("%s 已存在且不是软链接，跳过", link_name)
                 return
             if link_path.readlink() != target:
                 link_path.unlink()
                 link_path.symlink_to(target)
-                logger.info(f"更新 {link_name} 软链接: {target}")
+                logger.info("更新 %s 软链接: %s", link_name, target)
         else:
             if target.exists():
                 link_path.symlink_to(target)
-                logger.info(f"创建 {link_name} 软链接: {target}")
+                logger.info("创建 %s 软链接: %s", link_name, target)
             else:
                 # 目标文件不存在，创建空文件
                 if not is_dir:
                     target.touch()
                     link_path.symlink_to(target)
-                    logger.info(f"创建空 {link_name} 并链接: {target}")
+                    logger.info("创建空 %s 并链接: %s", link_name, target)
+
+    def session_key(
+        self,
+        user_id: Optional[int] = None,
+        chat_id: Optional[int] = None,
+        now: Optional[datetime] = None,
+    ) -> str:
+        """
+        session 槽位名，同时用作 opencode session 标题
 
-    def _get_period_file(self) -> Path:
-        """获取当前时间段的 session 文件路径"""
-        now = datetime.now()
-        period = "AM" if now.hour < 12 or (now.hour == 12 and now.minute < 30) else "PM"
-        filename = f"{now.strftime('%Y-%m-%d')}-{period}"
-        return self.sessions_dir / filename
+        global 范围就是时间段标题（例如 2025-02-05-AM），
+        user / chat 范围再加上用户或 chat（例如 2025-02-05-AM-u123）。
+        """
+        title = period_title(now)
+        if self.scope == "user" and user_id is not None:
+            return f"{title}-u{user_id}"
+        if self.scope == "chat" and chat_id is not None:
+            return f"{title}-c{chat_id}"
+        return title
+
+    def lock(self, key: str) -> asyncio.Lock:
+        """session 槽位的锁：同一槽位的消息依次处理"""
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        return lock
 
     def _get_memory_file(self) -> Path:
         """获取今天的 memory 文件路径"""
@@ -107,125 +207,99 @@ class SessionManager:
         memory_dir.mkdir(parents=True, exist_ok=True)
         return memory_dir / f"{now.strftime('%Y-%m-%d')}.md"
 
-    def _read_last_session(self, period_file: Path) -> Optional[Tuple[str, int]]:
-        """读取最后一行 session 信息"""
-        if not period_file.exists():
-            return None
-
-        try:
-            with open(period_file, "r") as f:
-                lines = f.readlines()
-                if not lines:
-                    return None
-                last_line = lines[-1].strip()
-                if not last_line:
-                    return None
-                parts = last_line.split()
-                if len(parts) >= 2:
-                    return parts[0], int(parts[1])
-                return None
-        except Exception as e:
-            logger.error(f"读取 session 文件失败: {e}")
-            return None
-
-    def get_session_info(self) -> SessionInfo:
+    def get_session_info(self, title: Optional[str] = None) -> SessionInfo:
         """
-        获取当前 session 状态信息
+        获取时间段（默认当前时间段）的 session 状态信息
 
         Returns:
             SessionInfo: 包含 session_id, count, need_archive 等信息
         """
-        period_file = self._get_period_file()
-        existing = self._read_last_session(period_file)
+        with timed("session_lookup"):
+            existing = self.store.current(title or period_title())
 
         if existing:
-            session_id, count = existing
-            if count < MESSAGE_LIMIT:
+            session_id, count, tokens = existing.session_id, existing.count, existing.tokens
+            reason = _rotation_reason(count, tokens)
+            if reason is None:
                 # 继续使用现有 session
                 return SessionInfo(
-                    session_id=session_id, count=count, need_archive=False
-                )
-            else:
-                # 满 50 次，需要先归档，然后新建
-                return SessionInfo(
-                    session_id=None,
-                    count=count,
-                    need_archive=True,
-                    archive_session_id=session_id,
+                    session_id=session_id, count=count, need_archive=False, tokens=tokens
                 )
+
+            # 上下文太大或消息太多，需要先归档，然后新建
+            return SessionInfo(
+                session_id=None,
+                count=count,
+                need_archive=not existing.archived,
+                archive_session_id=session_id,
+                tokens=tokens,
+            )
         else:
             # 没有现有 session，需要新建
             return SessionInfo(session_id=None, count=0, need_archive=False)
 
-    def _archive_session(self, session_id: str):
-        """归档 session 到 memory"""
-        memory_file = self._get_memory_file()
-
-        archive_prompt = f"""总结这次会话(session: {session_id})的长期有用内容。
-将总结追加写入文件: {memory_file}
-
-格式随意，可以包括：
-- 讨论的主题
-- 做出的决策
-- 完成的任务
-- 有用的代码或命令
+    def needs_rotation(self, title: str) -> bool:
+        """槽位当前的 session 是否已经写满（下一条消息会换新 session）"""
+        existing = self.store.current(title)
+        if existing is None:
+            return False
+        return _rotation_reason(existing.count, existing.tokens) is not None
+
+    def record_new_session(self, session_id: str, title: Optional[str] = None, tokens: int = 0):
+        """记录新创建的 session（title 为创建时的时间段标题，tokens 为第一轮的大小）"""
+        title = title or period_title()
+        previous = self.store.current(title)
+        if previous is not None and previous.session_id != session_id:
+            reason = _rotation_reason(previous.count, previous.tokens)
+            if reason:
+                # 新 session 真正替换了写满的旧 session 才算一次轮换
+                SESSION_ROTATIONS.inc(reason=reason)
+                logger.info(
+                    "session %s 已有 %s 条消息、约 %s token，换成新 session %s（%s）",
+                    previous.session_id, previous.count, previous.tokens, session_id, reason,
+                )
+        self.store.add(title, session_id, 1, tokens)
+        self._resolved_ids[title] = session_id
+        logger.info("记录新 session: %s", session_id)
 
-如果没有什么值得记录的，可以不写或简单写一句。"""
+    def increment_count(self, session_id: str, title: Optional[str] = None, tokens: int = 0) -> int:
+        """session 计数原子加一、上下文大小加上这一轮的 tokens，返回新的计数"""
+        try:
+            with timed("session_count"):
+                return self.store.increment(title or period_title(), session_id, tokens)
+        except Exception as e:
+            logger.error("更新 session 计数失败: %s", e)
+            return 0
 
+    def get_context_hashes(self, session_id: str) -> Optional[Dict[str, str]]:
+        """session 上次看到的配置文件哈希"""
         try:
-            cmd = ["opencode", "run", "--session", session_id, archive_prompt]
-            subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=60,
-            )
-            logger.info(f"已归档 session: {session_id}")
+            return self.store.get_context(session_id)
         except Exception as e:
-            logger.error(f"归档 session 失败: {e}")
-
-    def record_new_session(self, session_id: str):
-        """记录新创建的 session"""
-        period_file = self._get_period_file()
-        with open(period_file, "a") as f:
-            f.write(f"{session_id} 1\n")
-        logger.info(f"记录新 session: {session_id}")
-
-    def increment_count(self, session_id: str, current_count: int):
-        """增加 session 计数"""
-        period_file = self._get_period_file()
+            logger.error("读取 session 配置文件哈希失败: %s", e)
+            return None
+
+    def set_context_hashes(self, session_id: str, hashes: Dict[str, str]):
+        """记录 session 已经看过这些版本的配置文件"""
         try:
-            with open(period_file, "r") as f:
-                lines = f.readlines()
-
-            # 找到对应的行并更新
-            for i, line in enumerate(lines):
-                parts = line.strip().split()
-                if parts and parts[0] == session_id:
-                    lines[i] = f"{session_id} {current_count + 1}\n"
-                    break
-
-            with open(period_file, "w") as f:
-                f.writelines(lines)
+            self.store.set_context(session_id, hashes)
         except Exception as e:
-            logger.error(f"更新 session 计数失败: {e}")
+            logger.error("记录 session 配置文件哈希失败: %s", e)
 
-    def get_latest_session_id(self) -> Optional[str]:
-        """从 session list 获取当前时间段最新的 session ID"""
-        from datetime import datetime
+    async def get_latest_session_id(self, title: Optional[str] = None) -> Optional[str]:
+        """
+        从 session list 获取时间段最新的 session ID
 
-        now = datetime.now()
-        period = "AM" if now.hour < 12 or (now.hour == 12 and now.minute < 30) else "PM"
-        expected_title = f"{now.strftime('%Y-%m-%d')}-{period}"
+        只在 run 的输出里拿不到 session ID 时作为兜底使用，结果按标题缓存。
+        """
+        expected_title = title or period_title()
+        if expected_title in self._resolved_ids:
+            return self._resolved_ids[expected_title]
 
         try:
-            cmd = ["opencode", "session", "list"]
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=50,
-            )
+            cmd = [Config.OPENCODE_CLI, "session", "list"]
+            with timed("session_list"):
+                result = await run_command(cmd, timeout=50)
             if result.returncode == 0:
                 lines = result.stdout.strip().split("\n")
                 # 找到匹配的 session（最新的在前）
@@ -241,30 +315,79 @@ class SessionManager:
                     # 检查标题是否匹配
                     parts = line.split(maxsplit=2)
                     if len(parts) >= 3 and parts[0].startswith("ses_"):
-                        title = parts[1]
-                        if title == expected_title:
+                        if parts[1] == expected_title:
+                            self._resolved_ids[expected_title] = parts[0]
                             return parts[0]
         except Exception as e:
-            logger.error(f"获取 session 列表失败: {e}")
+            logger.error("获取 session 列表失败: %s", e)
         return None
 
-    def prepare_for_message(self) -> Tuple[Optional[str], bool]:
+    def start(self):
+        """
+        把写满了还没归档的 session 重新排队（需要在事件循环中调用）
+
+        上次关闭时还在排队、或者重试次数用完的归档都没有记为已归档，启动时补上。
+        """
+        try:
+            records = self.store.unarchived(time.time() - ARCHIVE_RESUME_SECONDS)
+        except Exception as e:
+            logger.error("读取未归档的 session 失败: %s", e)
+            return
+
+        memory_file = None
+        resumed = 0
+        for record in records:
+            if _rotation_reason(record.count, record.tokens) is None:
+                continue
+            memory_file = memory_file or self._get_memory_file()
+            if self.archiver.submit(record.session_id, memory_file, record.key):
+                resumed += 1
+        if resumed:
+            logger.info("重新排队了 %s 个还没归档的 session", resumed)
+
+    def close(self):
+        """关闭 session 存储（先写回还没落盘的计数）"""
+        try:
+            self.store.close()
+        except Exception as e:
+            logger.error("关闭 session 存储失败: %s", e)
+
+    def _mark_archived(self, session_id: str, key: Optional[str]):
+        """归档成功后记录下来，之后不再归档"""
+        if key:
+            self.store.mark_archived(key, session_id)
+
+    async def prepare_for_message(self, title: Optional[str] = None) -> Tuple[Optional[str], bool]:
         """
         准备发送消息，处理归档等前置操作
 
+        Args:
+            title: 时间段标题（默认当前时间段）
+
         Returns:
             Tuple[session_id, is_new]: session_id（None 表示需要新建）和是否新 session
         """
-        info = self.get_session_info()
+        title = title or period_title()
+        info = self.get_session_info(title)
 
         if info.need_archive and info.archive_session_id:
-            # 先归档满 50 次的 session
-            self._archive_session(info.archive_session_id)
-            return None, True
+            # 写满的 session 交给后台归档，消息直接进新 session
+            # （排队中的 session 不会重复提交；归档成功后在存储里记为已归档）
+            self.archiver.submit(info.archive_session_id, self._get_memory_file(), title)
 
         if info.session_id:
             # 继续现有 session
             return info.session_id, False
 
-        # 需要新建 session
+        # 需要新建 session，旧的缓存不再有效
+        self._resolved_ids.pop(title, None)
         return None, True
+
+
+def _rotation_reason(count: int, tokens: int) -> Optional[str]:
+    """session 需要换新的原因（tokens / messages），还能继续用时为 None"""
+    if tokens >= Config.SESSION_TOKEN_BUDGET:
+        return "tokens"
+    if count >= Config.SESSION_MAX_MESSAGES:
+        return "messages"
+    return None
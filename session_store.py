@@ -0,0 +1,486 @@
+"""
+Session 存储模块 - 可替换的 session 状态后端喵～
+
+- SQLiteSessionStore（默认）：内存缓存 + SQLite（WAL 模式），
+  O(1) 查询当前 session；计数先改缓存，攒一小段时间后在一个事务里写回（write-behind）；
+  第一次启动时自动导入 sessions/ 下旧的时间段文件。
+- FileSessionStore：兼容旧版的纯文本时间段文件（每行 session_id count [tokens [archived]]）。
+
+key 是 session 槽位的名字，目前就是时间段标题（例如 2025-02-05-AM）。
+"""
+
+import re
+import json
+import time
+import asyncio
+import sqlite3
+import logging
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 旧版时间段文件名
+PERIOD_FILE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}-(AM|PM)$")
+
+# FileSessionStore 记录配置文件哈希的文件
+CONTEXT_FILE_NAME = "context.json"
+
+# 时间段文件里已归档的 session 行末尾的标记
+ARCHIVED_FLAG = "archived"
+
+# 计数改动攒多久写回一次数据库（秒）；进程崩溃最多丢这么久的计数
+FLUSH_DELAY = 1.0
+
+
+@dataclass
+class SessionRecord:
+    """一个 session 的状态"""
+
+    key: str  # session 槽位（时间段标题）
+    session_id: str
+    count: int  # 已发送的消息数
+    tokens: int = 0  # 估算的上下文大小（提示词和回复累计的 token 数）
+    archived: bool = False  # 已经归档进 memory（归档成功后才记）
+    row_id: Optional[int] = None  # 存储后端内部使用
+
+
+class SessionStore:
+    """Session 存储后端接口"""
+
+    def current(self, key: str) -> Optional[SessionRecord]:
+        """获取槽位当前（最新）的 session"""
+        raise NotImplementedError
+
+    def add(self, key: str, session_id: str, count: int = 1, tokens: int = 0) -> SessionRecord:
+        """记录槽位新建的 session，它成为当前 session"""
+        raise NotImplementedError
+
+    def increment(self, key: str, session_id: str, tokens: int = 0) -> int:
+        """session 计数加一、上下文大小加 tokens，返回新的计数"""
+        raise NotImplementedError
+
+    def mark_archived(self, key: str, session_id: str):
+        """记录 session 已经归档完成"""
+        raise NotImplementedError
+
+    def unarchived(self, since: float) -> List[SessionRecord]:
+        """since（时间戳）之后更新过、还没归档的 session"""
+        raise NotImplementedError
+
+    def get_context(self, session_id: str) -> Optional[Dict[str, str]]:
+        """session 上次看到的配置文件哈希（没有记录时为 None）"""
+        raise NotImplementedError
+
+    def set_context(self, session_id: str, hashes: Dict[str, str]):
+        """记录 session 看到的配置文件哈希"""
+        raise NotImplementedError
+
+    def close(self):
+        """写回还没落盘的改动并关闭后端"""
+
+
+class SQLiteSessionStore(SessionStore):
+    """内存缓存 + SQLite（WAL）存储"""
+
+    def __init__(self, db_path: Path, legacy_dir: Optional[Path] = None):
+        """
+        Args:
+            db_path: 数据库文件路径
+            legacy_dir: 旧版时间段文件所在目录，里面没导入过的文件会被导入
+        """
+        self.db_path = Path(db_path)
+        self._conn = sqlite3.connect(str(self.db_path))
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_tables()
+
+        # 缓存每个槽位的当前 session
+        self._cache: Dict[str, Optional[SessionRecord]] = {}
+        self._context_cache: Dict[str, Optional[Dict[str, str]]] = {}
+        # 还没写回的计数改动：行 id -> [计数增量, tokens 增量, 更新时间]
+        self._pending: Dict[int, List] = {}
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+
+        if legacy_dir is not None:
+            self.import_period_files(legacy_dir)
+
+    def _create_tables(self):
+        """建表"""
+        with self._conn:
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS sessions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    key TEXT NOT NULL,
+                    session_id TEXT NOT NULL,
+                    count INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )"""
+            )
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(sessions)")}
+            if "tokens" not in columns:
+                # 旧版数据库没有上下文大小这一列
+                self._conn.execute(
+                    "ALTER TABLE sessions ADD COLUMN tokens INTEGER NOT NULL DEFAULT 0"
+                )
+            if "archived" not in columns:
+                self._conn.execute(
+                    "ALTER TABLE sessions ADD COLUMN archived INTEGER NOT NULL DEFAULT 0"
+                )
+                # 以前的 session 已经按旧的方式处理过，不再补归档
+                self._conn.execute("UPDATE sessions SET archived = 1")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_sessions_key ON sessions (key, id)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS imported_files (name TEXT PRIMARY KEY)"
+            )
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS session_context (
+                    session_id TEXT PRIMARY KEY,
+                    hashes TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )"""
+            )
+
+    def current(self, key: str) -> Optional[SessionRecord]:
+        if key not in self._cache:
+            row = self._conn.execute(
+                "SELECT id, session_id, count, tokens, archived FROM sessions WHERE key = ? "
+                "ORDER BY id DESC LIMIT 1",
+                (key,),
+            ).fetchone()
+            record = None
+            if row:
+                record = SessionRecord(
+                    key=key,
+                    session_id=row[1],
+                    count=row[2],
+                    tokens=row[3],
+                    archived=bool(row[4]),
+                    row_id=row[0],
+                )
+                pending = self._pending.get(record.row_id)
+                if pending:
+                    record.count += pending[0]
+                    record.tokens += pending[1]
+            self._cache[key] = record
+        return self._cache[key]
+
+    def add(self, key: str, session_id: str, count: int = 1, tokens: int = 0) -> SessionRecord:
+        now = time.time()
+        with self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO sessions (key, session_id, count, tokens, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, session_id, count, tokens, now, now),
+            )
+        record = SessionRecord(
+            key=key, session_id=session_id, count=count, tokens=tokens, row_id=cursor.lastrowid
+        )
+        self._cache[key] = record
+        return record
+
+    def increment(self, key: str, session_id: str, tokens: int = 0) -> int:
+        record = self.current(key)
+        if record is not None and record.session_id == session_id:
+            record.count += 1
+            record.tokens += tokens
+            self._defer(record.row_id, tokens)
+            return record.count
+
+        # 不是当前 session（例如已经轮换），按 session_id 找到那一行（很少走到这里）
+        self.flush()
+        row = self._conn.execute(
+            "SELECT id, count FROM sessions WHERE key = ? AND session_id = ? "
+            "ORDER BY id DESC LIMIT 1",
+            (key, session_id),
+        ).fetchone()
+        if row is None:
+            logger.warning("找不到 session %s，无法更新计数", session_id)
+            return 0
+        self._defer(row[0], tokens)
+        return row[1] + 1
+
+    def _defer(self, row_id: int, tokens: int):
+        """记下一次计数改动，稍后和其它改动一起写回"""
+        pending = self._pending.setdefault(row_id, [0, 0, 0.0])
+        pending[0] += 1
+        pending[1] += tokens
+        pending[2] = time.time()
+        if self._flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # 不在事件循环里（例如脚本直接调用）就马上写
+            self.flush()
+            return
+        self._flush_handle = loop.call_later(FLUSH_DELAY, self.flush)
+
+    def flush(self):
+        """把攒下的计数改动在一个事务里写回数据库"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        try:
+            with self._conn:
+                self._conn.executemany(
+                    "UPDATE sessions SET count = count + ?, tokens = tokens + ?, updated_at = ? "
+                    "WHERE id = ?",
+                    [
+                        (count, tokens, updated_at, row_id)
+                        for row_id, (count, tokens, updated_at) in pending.items()
+                    ],
+                )
+        except Exception as e:
+            logger.error("写回 session 计数失败: %s", e)
+            # 放回去，下次再写
+            for row_id, (count, tokens, updated_at) in pending.items():
+                merged = self._pending.setdefault(row_id, [0, 0, 0.0])
+                merged[0] += count
+                merged[1] += tokens
+                merged[2] = max(merged[2], updated_at)
+
+    def mark_archived(self, key: str, session_id: str):
+        with self._conn:
+            self._conn.execute(
+                "UPDATE sessions SET archived = 1, updated_at = ? WHERE key = ? AND session_id = ?",
+                (time.time(), key, session_id),
+            )
+        record = self._cache.get(key)
+        if record is not None and record.session_id == session_id:
+            record.archived = True
+
+    def unarchived(self, since: float) -> List[SessionRecord]:
+        self.flush()
+        rows = self._conn.execute(
+            "SELECT id, key, session_id, count, tokens FROM sessions "
+            "WHERE archived = 0 AND updated_at >= ? ORDER BY id",
+            (since,),
+        ).fetchall()
+        return [
+            SessionRecord(key=row[1], session_id=row[2], count=row[3], tokens=row[4], row_id=row[0])
+            for row in rows
+        ]
+
+    def get_context(self, session_id: str) -> Optional[Dict[str, str]]:
+        if session_id not in self._context_cache:
+            row = self._conn.execute(
+                "SELECT hashes FROM session_context WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            self._context_cache[session_id] = json.loads(row[0]) if row else None
+        return self._context_cache[session_id]
+
+    def set_context(self, session_id: str, hashes: Dict[str, str]):
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO session_context (session_id, hashes, updated_at) "
+                "VALUES (?, ?, ?)",
+                (session_id, json.dumps(hashes), time.time()),
+            )
+        self._context_cache[session_id] = dict(hashes)
+
+    def import_period_files(self, sessions_dir: Path) -> int:
+        """
+        导入旧版时间段文件（每个文件只导入一次，原文件保留）
+
+        Returns:
+            导入的 session 数
+        """
+        imported = {
+            row[0] for row in self._conn.execute("SELECT name FROM imported_files")
+        }
+        total = 0
+
+        for path in sorted(Path(sessions_dir).iterdir()):
+            if not PERIOD_FILE_PATTERN.match(path.name) or path.name in imported:
+                continue
+
+            entries = _read_period_file(path)
+            mtime = path.stat().st_mtime
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT INTO sessions (key, session_id, count, tokens, archived, created_at, "
+                    "updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        (path.name, sid, count, tokens, int(archived), mtime, mtime)
+                        for sid, count, tokens, archived in entries
+                    ],
+                )
+                self._conn.execute(
+                    "INSERT INTO imported_files (name) VALUES (?)", (path.name,)
+                )
+            self._cache.pop(path.name, None)
+            total += len(entries)
+
+        if total:
+            logger.info("已从旧版 session 文件导入 %s 个 session", total)
+        return total
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+
+class FileSessionStore(SessionStore):
+    """旧版纯文本时间段文件存储（每个槽位一个文件，每行 session_id count [tokens [archived]]）"""
+
+    def __init__(self, sessions_dir: Path):
+        self.sessions_dir = Path(sessions_dir)
+        self._cache: Dict[str, Optional[SessionRecord]] = {}
+        self._context_file = self.sessions_dir / CONTEXT_FILE_NAME
+        self._context: Optional[Dict[str, Dict[str, str]]] = None
+
+    def current(self, key: str) -> Optional[SessionRecord]:
+        if key not in self._cache:
+            entries = _read_period_file(self.sessions_dir / key)
+            if entries:
+                session_id, count, tokens, archived = entries[-1]
+                self._cache[key] = SessionRecord(
+                    key=key, session_id=session_id, count=count, tokens=tokens, archived=archived
+                )
+            else:
+                self._cache[key] = None
+        return self._cache[key]
+
+    def add(self, key: str, session_id: str, count: int = 1, tokens: int = 0) -> SessionRecord:
+        with open(self.sessions_dir / key, "a") as f:
+            f.write(f"{session_id} {count} {tokens}\n")
+        record = SessionRecord(key=key, session_id=session_id, count=count, tokens=tokens)
+        self._cache[key] = record
+        return record
+
+    def increment(self, key: str, session_id: str, tokens: int = 0) -> int:
+        period_file = self.sessions_dir / key
+        new_count = 0
+        new_tokens = 0
+        try:
+            with open(period_file, "r") as f:
+                lines = f.readlines()
+
+            # 找到对应的行（从后往前）并更新
+            for i in range(len(lines) - 1, -1, -1):
+                parts = lines[i].strip().split()
+                if parts and parts[0] == session_id:
+                    new_count = int(parts[1]) + 1
+                    new_tokens = (int(parts[2]) if len(parts) >= 3 else 0) + tokens
+                    archived = parts[3:] == [ARCHIVED_FLAG]
+                    lines[i] = _format_line(session_id, new_count, new_tokens, archived)
+                    break
+
+            with open(period_file, "w") as f:
+                f.writelines(lines)
+        except Exception as e:
+            logger.error("更新 session 计数失败: %s", e)
+
+        record = self._cache.get(key)
+        if record is not None and record.session_id == session_id and new_count:
+            record.count = new_count
+            record.tokens = new_tokens
+        return new_count
+
+    def mark_archived(self, key: str, session_id: str):
+        period_file = self.sessions_dir / key
+        try:
+            with open(period_file, "r") as f:
+                lines = f.readlines()
+            for i in range(len(lines) - 1, -1, -1):
+                parts = lines[i].strip().split()
+                if len(parts) >= 2 and parts[0] == session_id:
+                    tokens = int(parts[2]) if len(parts) >= 3 else 0
+                    lines[i] = _format_line(session_id, int(parts[1]), tokens, True)
+                    break
+            with open(period_file, "w") as f:
+                f.writelines(lines)
+        except Exception as e:
+            logger.error("记录 session 已归档失败: %s", e)
+
+        record = self._cache.get(key)
+        if record is not None and record.session_id == session_id:
+            record.archived = True
+
+    def unarchived(self, since: float) -> List[SessionRecord]:
+        records = []
+        for path in sorted(self.sessions_dir.iterdir()):
+            if not path.is_file() or path.name == CONTEXT_FILE_NAME or path.suffix:
+                continue
+            try:
+                if path.stat().st_mtime < since:
+                    continue
+            except OSError:
+                continue
+            records.extend(
+                SessionRecord(key=path.name, session_id=sid, count=count, tokens=tokens)
+                for sid, count, tokens, archived in _read_period_file(path)
+                if not archived
+            )
+        return records
+
+    def _load_context(self) -> Dict[str, Dict[str, str]]:
+        if self._context is None:
+            try:
+                with open(self._context_file, "r") as f:
+                    self._context = json.load(f)
+            except FileNotFoundError:
+                self._context = {}
+            except Exception as e:
+                logger.error("读取 %s 失败: %s", self._context_file, e)
+                self._context = {}
+        return self._context
+
+    def get_context(self, session_id: str) -> Optional[Dict[str, str]]:
+        return self._load_context().get(session_id)
+
+    def set_context(self, session_id: str, hashes: Dict[str, str]):
+        context = self._load_context()
+        context[session_id] = dict(hashes)
+        try:
+            with open(self._context_file, "w") as f:
+                json.dump(context, f)
+        except Exception as e:
+            logger.error("写入 %s 失败: %s", self._context_file, e)
+
+
+def _format_line(session_id: str, count: int, tokens: int, archived: bool) -> str:
+    """时间段文件的一行"""
+    line = f"{session_id} {count} {tokens}"
+    return f"{line} {ARCHIVED_FLAG}\n" if archived else f"{line}\n"
+
+
+def _read_period_file(path: Path) -> List[Tuple[str, int, int, bool]]:
+    """读取旧版时间段文件的所有 (session_id, count, tokens, archived)（没有 tokens 的旧记录算 0）"""
+    if not path.exists():
+        return []
+
+    entries = []
+    try:
+        with open(path, "r") as f:
+            for line in f:
+                parts = line.strip().split()
+                if len(parts) >= 2:
+                    tokens = int(parts[2]) if len(parts) >= 3 else 0
+                    entries.append((parts[0], int(parts[1]), tokens, parts[3:] == [ARCHIVED_FLAG]))
+    except Exception as e:
+        logger.error("读取 session 文件失败: %s", e)
+    return entries
+
+
+def create_store(backend: str, sessions_dir: Path) -> SessionStore:
+    """
+    按配置创建存储后端
+
+    Args:
+        backend: "sqlite" 或 "file"
+        sessions_dir: sessions/ 目录
+    """
+    if backend == "file":
+        return FileSessionStore(sessions_dir)
+    if backend != "sqlite":
+        logger.warning("未知的 SESSION_STORE: %s，使用 sqlite", backend)
+    return SQLiteSessionStore(Path(sessions_dir) / "sessions.db", legacy_dir=sessions_dir)
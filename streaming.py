@@ -0,0 +1,134 @@
+"""
+流式回复模块 - Opencode 一边输出，Telegram 一边显示喵～
+
+完整的段落（以 3 个换行符结尾）立刻作为单独消息发出，超过 Telegram 长度上限的
+段落拆成几条；还没写完的最后一段显示在一条占位消息里，原地编辑更新。
+"""
+
+import re
+import time
+import logging
+from typing import Optional
+from telegram import Message
+from telegram.error import BadRequest
+
+logger = logging.getLogger(__name__)
+
+# 段落分隔符
+SECTION_SEPARATOR = "\n\n\n"
+
+# 图片标记 [IMAGE:路径]
+IMAGE_PATTERN = r"\[IMAGE:([^\]]+)\]"
+
+# Telegram 单条消息长度上限
+MAX_MESSAGE_LENGTH = 4096
+
+
+class StreamingReply:
+    """把流式文本增量发送到 Telegram"""
+
+    def __init__(self, message: Message, outbox, edit_interval: float = 1.0):
+        """
+        Args:
+            message: 要回复的用户消息
+            outbox: 发送通道（outbox.Outbox）
+            edit_interval: 占位消息两次编辑之间的最短间隔（秒）
+        """
+        self.message = message
+        self.outbox = outbox
+        self.edit_interval = edit_interval
+        self.image_path: Optional[str] = None
+        self.sent_count = 0
+
+        self._buffer = ""
+        self._placeholder: Optional[Message] = None
+        self._placeholder_text = ""
+        self._last_edit = 0.0
+
+    async def feed(self, text: str):
+        """追加一段输出，发出已经完整的段落"""
+        self._buffer += text
+
+        while SECTION_SEPARATOR in self._buffer:
+            section, self._buffer = self._buffer.split(SECTION_SEPARATOR, 1)
+            await self._send_section(section)
+
+        partial = self._strip_images(self._buffer).strip()
+        if (
+            partial
+            and time.monotonic() - self._last_edit >= self.edit_interval
+            and self.outbox.ready(self.message.chat_id)
+        ):
+            # 占位消息只是预览，限速令牌不够时跳过这次更新
+            await self._show_partial(partial)
+
+    async def finish(self):
+        """输出结束，发出最后一段并清理占位消息"""
+        await self._send_section(self._buffer)
+        self._buffer = ""
+
+        if self._placeholder is not None:
+            # 最后一段是空的，占位消息没用了
+            await self._discard(self._placeholder)
+            self._placeholder = None
+
+    async def _send_section(self, section: str):
+        """发出一个完整段落（优先把占位消息改成这一段，超长的段落拆成几条）"""
+        # outbox 依赖本模块的常量，只能在这里导入
+        from outbox import split_reply
+
+        parts, image_path = split_reply(section)
+        if image_path:
+            self.image_path = image_path
+
+        for text in parts:
+            if self._placeholder is not None:
+                placeholder, self._placeholder = self._placeholder, None
+                if text == self._placeholder_text:
+                    sent = True
+                else:
+                    sent = await self._edit_placeholder(text, placeholder)
+                if not sent:
+                    # 改不了占位消息（例如已被删除），改为单独发送，不能丢掉这一段
+                    await self._discard(placeholder)
+                    await self.outbox.reply_text(self.message, text)
+            else:
+                await self.outbox.reply_text(self.message, text)
+
+            self.sent_count += 1
+            logger.info("已发送第 %s 条消息", self.sent_count)
+
+    async def _show_partial(self, text: str):
+        """在占位消息里显示还没写完的段落"""
+        text = text[:MAX_MESSAGE_LENGTH]
+        self._last_edit = time.monotonic()
+
+        if self._placeholder is None:
+            self._placeholder = await self.outbox.reply_text(self.message, text)
+            self._placeholder_text = text
+        elif text != self._placeholder_text:
+            await self._edit_placeholder(text)
+
+    async def _edit_placeholder(self, text: str, placeholder: Optional[Message] = None) -> bool:
+        """编辑占位消息的内容，返回是否成功"""
+        try:
+            await self.outbox.edit_text(placeholder or self._placeholder, text)
+            self._placeholder_text = text
+            return True
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                # 内容没变化
+                return True
+            logger.debug("编辑占位消息失败: %s", e)
+            return False
+
+    async def _discard(self, placeholder: Message):
+        """删除用不上的占位消息"""
+        try:
+            await self.outbox.delete(placeholder)
+        except BadRequest as e:
+            logger.warning("删除占位消息失败: %s", e)
+
+    def _strip_images(self, text: str) -> str:
+        """移除图片标记"""
+        return re.sub(IMAGE_PATTERN, "", text)
@@ -0,0 +1,300 @@
+"""
+追踪模块 - 一条回复慢了，看看时间都花在哪一步喵～
+
+每条 update 是一个 trace（trace ID 就是 update_id，和日志的关联 ID 相同），
+处理过程中的各个阶段是 trace 里的 span：metrics.timed() 的每个阶段、
+Telegram API 调用、session 存储读写等都会自动记成 span。
+trace 结束后以一行 JSON 写到 TRACE_FILE：
+
+    {"trace_id": "123", "name": "update", "ts": "...", "ms": 2350.1,
+     "spans": [{"id": 1, "parent": null, "name": "handle", "start_ms": 3.2, "ms": 2340.5}, ...]}
+
+开启 PROFILE_ENABLED 后还会定期采样每个 trace 里任务的 await 调用栈，
+最慢的 PROFILE_TOP_N 条 update 连同调用栈保留在内存里（/debug/slow），
+写出的 trace 里也带上 "stacks"（折叠格式的调用栈 -> 采样次数）。
+"""
+
+import time
+import asyncio
+import heapq
+import json
+import logging
+import weakref
+import itertools
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 每条调用栈最多记录几层
+MAX_STACK_DEPTH = 30
+
+# 每个 trace 最多记录的 span 数（超过的丢弃，防止长任务无限增长）
+MAX_SPANS = 500
+
+
+class Trace:
+    """一条 update 的处理过程"""
+
+    def __init__(self, trace_id: str, name: str, attrs: Dict[str, Any]):
+        self.trace_id = trace_id
+        self.name = name
+        self.attrs = attrs
+        self.started_at = time.time()
+        self.started = time.monotonic()
+        self.duration: Optional[float] = None
+        self.spans: List[Dict[str, Any]] = []
+        self.stacks: Counter = Counter()
+        # 这条 update 用到的任务（采样调用栈用）
+        self.tasks: "weakref.WeakSet[asyncio.Task]" = weakref.WeakSet()
+        self._ids = itertools.count(1)
+
+    def to_dict(self, with_stacks: bool = False) -> Dict[str, Any]:
+        entry = {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "ts": datetime.fromtimestamp(self.started_at).isoformat(timespec="milliseconds"),
+            "ms": _ms(self.duration if self.duration is not None else time.monotonic() - self.started),
+            **self.attrs,
+            "spans": self.spans,
+        }
+        if with_stacks and self.stacks:
+            entry["stacks"] = dict(self.stacks.most_common())
+        return entry
+
+
+class Tracer:
+    """管理进行中的 trace、写出结果和采样调用栈"""
+
+    def __init__(self):
+        self.enabled = False
+        self.slow_seconds = 0.0
+        self.profile_interval = 0.0  # 0 表示不采样调用栈
+        self.top_n = 0
+        self._export: Optional[logging.Logger] = None
+        self._active: Dict[str, Trace] = {}
+        self._slowest: List = []  # (耗时, 序号, trace) 的小顶堆
+        self._order = itertools.count()
+        self._sampler: Optional[asyncio.Task] = None
+
+    def configure(
+        self,
+        export: Optional[logging.Logger],
+        slow_seconds: float = 0.0,
+        profile_interval: float = 0.0,
+        top_n: int = 10,
+    ):
+        """
+        Args:
+            export: 写出 trace 的日志器（每条消息一行 JSON），None 表示不写出
+            slow_seconds: 只写出耗时不少于这么多秒的 trace
+            profile_interval: 调用栈采样间隔（秒），0 表示不采样
+            top_n: 保留最慢的几条 update 的调用栈
+        """
+        self._export = export
+        self.slow_seconds = slow_seconds
+        self.profile_interval = profile_interval
+        self.top_n = max(1, top_n)
+        self.enabled = export is not None or profile_interval > 0
+
+    def start_profiler(self):
+        """启动调用栈采样（需要在事件循环中调用）"""
+        if self.profile_interval > 0 and self._sampler is None:
+            self._sampler = asyncio.create_task(self._sample_loop())
+
+    async def stop_profiler(self):
+        if self._sampler is not None:
+            self._sampler.cancel()
+            await asyncio.gather(self._sampler, return_exceptions=True)
+            self._sampler = None
+
+    def slowest(self) -> List[Dict[str, Any]]:
+        """最慢的几条 update（从慢到快），带调用栈"""
+        return [trace.to_dict(with_stacks=True) for _, _, trace in sorted(self._slowest, reverse=True)]
+
+    def begin(self, trace: Trace):
+        self._active[trace.trace_id] = trace
+
+    def finish(self, trace: Trace):
+        trace.duration = time.monotonic() - trace.started
+        self._active.pop(trace.trace_id, None)
+
+        profiled = False
+        if self.profile_interval > 0:
+            item = (trace.duration, next(self._order), trace)
+            if len(self._slowest) < self.top_n:
+                heapq.heappush(self._slowest, item)
+                profiled = True
+            elif trace.duration > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, item)
+                profiled = True
+
+        if self._export is not None and trace.duration >= self.slow_seconds:
+            self._export.info("%s", _JsonLine(trace, profiled))
+
+    async def _sample_loop(self):
+        """定期记录每个进行中的 trace 里各任务停在哪个 await 上"""
+        while True:
+            await asyncio.sleep(self.profile_interval)
+            for trace in list(self._active.values()):
+                for task in list(trace.tasks):
+                    if task.done():
+                        continue
+                    stack = _folded_stack(task)
+                    if stack:
+                        trace.stacks[stack] += 1
+
+
+class _JsonLine:
+    """写日志时才序列化（在写日志的线程里，不占用事件循环）"""
+
+    __slots__ = ("trace", "with_stacks")
+
+    def __init__(self, trace: Trace, with_stacks: bool):
+        self.trace = trace
+        self.with_stacks = with_stacks
+
+    def __str__(self) -> str:
+        return json.dumps(self.trace.to_dict(self.with_stacks), ensure_ascii=False)
+
+
+tracer = Tracer()
+
+_current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar(
+    "current_trace", default=None
+)
+_current_span: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar(
+    "current_span", default=None
+)
+
+
+@contextmanager
+def trace(trace_id: str, name: str, **attrs) -> Iterator[Optional[Trace]]:
+    """开始一个 trace（一条 update），代码块结束时写出"""
+    if not tracer.enabled:
+        yield None
+        return
+
+    current = Trace(trace_id, name, attrs)
+    token = _current_trace.set(current)
+    span_token = _current_span.set(None)
+    _track_task(current)
+    tracer.begin(current)
+    try:
+        yield current
+    finally:
+        tracer.finish(current)
+        _current_span.reset(span_token)
+        _current_trace.reset(token)
+
+
+@contextmanager
+def span(name: str, **attrs) -> Iterator[None]:
+    """记录当前 trace 里的一个阶段；不在 trace 里时什么都不做"""
+    current = _current_trace.get()
+    if current is None:
+        yield
+        return
+
+    span_id = next(current._ids)
+    parent = _current_span.get()
+    token = _current_span.set(span_id)
+    _track_task(current)
+    started = time.monotonic()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        _current_span.reset(token)
+        _add_span(current, span_id, parent, name, started, time.monotonic() - started, error, attrs)
+
+
+def record_span(name: str, seconds: float, **attrs):
+    """补记一个刚刚结束、耗时 seconds 的阶段（例如排队等待）"""
+    current = _current_trace.get()
+    if current is None:
+        return
+    started = time.monotonic() - seconds
+    _add_span(current, next(current._ids), _current_span.get(), name, started, seconds, None, attrs)
+
+
+def set_attrs(**attrs):
+    """给当前 trace 加上属性（例如 chat_id）"""
+    current = _current_trace.get()
+    if current is not None:
+        current.attrs.update(attrs)
+
+
+def _add_span(
+    current: Trace,
+    span_id: int,
+    parent: Optional[int],
+    name: str,
+    started: float,
+    seconds: float,
+    error: Optional[str],
+    attrs: Dict[str, Any],
+):
+    if current.duration is not None or len(current.spans) >= MAX_SPANS:
+        # trace 已经写出（例如被取消的任务还在收尾），或者 span 太多
+        return
+    entry = {
+        "id": span_id,
+        "parent": parent,
+        "name": name,
+        "start_ms": _ms(started - current.started),
+        "ms": _ms(seconds),
+    }
+    if error:
+        entry["error"] = error
+    if attrs:
+        entry.update(attrs)
+    current.spans.append(entry)
+
+
+def _track_task(current: Trace):
+    """记下正在为这个 trace 工作的任务"""
+    if tracer.profile_interval <= 0:
+        return
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        return
+    if task is not None:
+        current.tasks.add(task)
+
+
+def _folded_stack(task: asyncio.Task) -> str:
+    """
+    任务当前的 await 调用栈，折叠成一行（外层在前，分号分隔）
+
+    挂起的任务 get_stack() 只返回最外层一帧，所以顺着 cr_await 往里找。
+    """
+    parts = []
+    awaitable: Any = task.get_coro()
+    while awaitable is not None and len(parts) < MAX_STACK_DEPTH:
+        frame = (
+            getattr(awaitable, "cr_frame", None)
+            or getattr(awaitable, "gi_frame", None)
+            or getattr(awaitable, "ag_frame", None)
+        )
+        if frame is None:
+            break
+        code = frame.f_code
+        parts.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+        awaitable = (
+            getattr(awaitable, "cr_await", None)
+            or getattr(awaitable, "gi_yieldfrom", None)
+            or getattr(awaitable, "ag_await", None)
+        )
+    return ";".join(parts)
+
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000, 1)
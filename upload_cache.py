@@ -0,0 +1,80 @@
+"""
+上传缓存模块 - 记住发送过的图片在 Telegram 上的 file_id 喵～
+
+回复里的 [IMAGE:路径] 第一次发送时上传文件，之后同一个文件（路径、大小、
+修改时间都相同）直接用 file_id 发送，不再上传。记录保存在 JSON 文件里，
+超过上限时丢掉最久没用的。
+"""
+
+import os
+import json
+import logging
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class UploadCache:
+    """(路径, 大小, 修改时间) -> Telegram file_id 的持久化 LRU 缓存"""
+
+    def __init__(self, cache_file: str, max_entries: int):
+        """
+        Args:
+            cache_file: 保存记录的 JSON 文件
+            max_entries: 最多记录多少个文件
+        """
+        self.cache_file = Path(cache_file)
+        self.max_entries = max(1, max_entries)
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._load()
+
+    @staticmethod
+    def key(path: str) -> Optional[str]:
+        """文件的缓存键（文件不存在时为 None）"""
+        try:
+            real_path = os.path.realpath(path)
+            stat = os.stat(real_path)
+        except OSError:
+            return None
+        return f"{real_path}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    def get(self, key: str) -> Optional[str]:
+        """查找 file_id"""
+        file_id = self._entries.get(key)
+        if file_id is not None:
+            self._entries.move_to_end(key)
+        return file_id
+
+    def put(self, key: str, file_id: str):
+        """记录上传得到的 file_id"""
+        self._entries[key] = file_id
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self._save()
+
+    def discard(self, key: str):
+        """file_id 失效时删掉记录"""
+        if self._entries.pop(key, None) is not None:
+            self._save()
+
+    def _load(self):
+        try:
+            with open(self.cache_file, "r") as f:
+                self._entries = OrderedDict(json.load(f))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning("读取上传缓存 %s 失败: %s", self.cache_file, e)
+
+    def _save(self):
+        try:
+            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = self.cache_file.with_name(self.cache_file.name + ".tmp")
+            with open(tmp_file, "w") as f:
+                json.dump(list(self._entries.items()), f)
+            os.replace(tmp_file, self.cache_file)
+        except Exception as e:
+            logger.warning("保存上传缓存 %s 失败: %s", self.cache_file, e)